@@ -1,32 +1,33 @@
 # Import necessary PyQt5 and pyqtgraph modules
 from PyQt5.QtWidgets import (QApplication, QVBoxLayout, QPushButton, QWidget, QLabel, QHBoxLayout,
-                             QTabWidget, QLineEdit, QFormLayout, QComboBox, QTableWidget, QScrollBar,
-                             QTableWidgetItem, QAbstractScrollArea, QSizePolicy, QSplitter, QSpacerItem, QGridLayout, QCheckBox, QFrame)
+                             QTabWidget, QLineEdit, QFormLayout, QComboBox, QTableView,
+                             QAbstractScrollArea, QSizePolicy, QSplitter, QSpacerItem, QGridLayout, QCheckBox, QFrame)
 
 from PyQt5.QtCore import QTimer, pyqtSignal, QThread, Qt
 from PyQt5.QtGui import QFont
 import pyqtgraph as pg
 from PyQt5.QtWidgets import QFileDialog
-# Import other necessary modules
-import pyvisa
+# Import other necessary modules. The VISA back end, SciPy (diode fit), h5py (store) and the simulator load
+# when first needed, so the window comes up without them
+import asyncio
+import os
 import threading
 import time
 import numpy as np
-from unittest.mock import MagicMock
-from scipy import constants, optimize
-from scipy.stats import linregress
-from numpy import polyfit
-from scipy.optimize import curve_fit
-
-def diode_equation(voltage, Rs, Rsh, n, Is):
-    return Is * (np.exp((voltage + Rs * Is) / (n * 25.85)) - 1) - voltage / Rsh
-
-
-class MockKeithley:
-    def __init__(self):
-        self.write = MagicMock()
-        self.query = MagicMock(return_value='0.0')
-
+import current_stream
+import keithley_session
+import iv_analysis
+import live_plot
+import plot_manager
+import iv_table_model
+import measurement_core
+import command_trace
+import dark_light
+import async_driver
+import mpp_tracker
+import stream_buffer
+
+DISCOVERY_TIMEOUT = 30.0  # Seconds a connection waits for the VISA resource discovery before giving up
 
 class KeithleyApp(QWidget):
     def __init__(self):
@@ -34,11 +35,36 @@ class KeithleyApp(QWidget):
         self.resize(800, 800)  # resize the main window
         self.plotWidget = None
         self.ivPlotWidget = None
-        self.rm = pyvisa.ResourceManager()
+        self.rm = None  # pyvisa ResourceManager, created by the resource discovery thread
+        self.discovery = None
+        self.resources = []  # SourceMeters found by the last discovery
+        self.discoveryAction = None  # Run once the discovery finishes: the connection or measurement it held up
+        self.discoveryDeadline = 0.0
         self.keithley = None
         self.stop = True
         self.worker = None
+        self.stream_worker = None
+        self.mpp_worker = None
+        self.queue_worker = None
+        self.switchSession = None  # Session of the switch matrix used by the device queue
+        self.streamTask = None
+        self.asyncLoop = None  # asyncio loop running on the Qt event loop, if qasync is installed
+        self.diode_fitter = None
+        self.sweep_count = 0
+        # Dark curves per device and setup; light sweeps of the device are analysed against them
+        self.darkCurves = dark_light.DarkCurveCache()
+        self.darkCurveStores = set()  # Store files whose dark curves have been loaded into the cache
+        self.sweepContext = None  # (device id, illumination, SweepSettings) of the running measurement
+        self.shutterDriven = False  # Whether the shutter was set for the running measurement
+        self.simulator_options = {}  # Keyword arguments of the SimulatedKeithley used by 'Use Simulator'
+        self.commandTrace = command_trace.CommandTrace()
         self.initUI()
+        # Scanning the VISA back ends is slow, so it runs once the window is up
+        QTimer.singleShot(0, self.discover_resources)
+        # Polls a discovery that a connection is waiting for, so the GUI thread never blocks on it
+        self.discoveryTimer = QTimer(self)
+        self.discoveryTimer.setInterval(100)
+        self.discoveryTimer.timeout.connect(self.check_discovery)
 
 
     def initUI(self):
@@ -83,6 +109,113 @@ class KeithleyApp(QWidget):
         # Tab 1: Live Current Plot
 
         self.tab1 = QWidget()
+        self.tab1.layout = QVBoxLayout()
+        self.plotWidget = pg.PlotWidget(viewBox=pg.ViewBox(border='k'))
+        self.plotWidget.setBackground('w')
+        self.plotWidget.setTitle('Reference Current')
+        self.plotWidget.setLabel('bottom', 'Time (s)')
+        self.plotWidget.setLabel('left', 'Current (A)')
+        self.currentCurve = plot_manager.fast_item(self.plotWidget, pg.mkPen('r', width=1))
+        self.tab1.layout.addWidget(self.plotWidget)
+
+        streamHBox = QHBoxLayout()
+        streamHBox.setAlignment(Qt.AlignLeft)
+        streamHBox.addWidget(QLabel('Sample Rate (Hz):'))
+        self.sampleRateEdit = QLineEdit('50')
+        self.sampleRateEdit.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        streamHBox.addWidget(self.sampleRateEdit)
+        self.currentStatsLabel = QLabel()
+        streamHBox.addWidget(self.currentStatsLabel)
+        self.tab1.layout.addLayout(streamHBox)
+        self.tab1.setLayout(self.tab1.layout)
+        self.currentBuffer = stream_buffer.RingBuffer(60000)
+
+        # Tab 3: Instrument traffic trace
+
+        self.tab3 = QWidget()
+        self.tab3.layout = QVBoxLayout()
+        self.traceHistogramWidget = pg.PlotWidget(viewBox=pg.ViewBox(border='k'))
+        self.traceHistogramWidget.setBackground('w')
+        self.traceHistogramWidget.setTitle('Command Round Trip')
+        self.traceHistogramWidget.setLabel('bottom', 'log10 Round Trip (s)')
+        self.traceHistogramWidget.setLabel('left', 'Commands')
+        self.traceHistogram = self.traceHistogramWidget.plot(stepMode='center', fillLevel=0,
+                                                             brush=(0, 0, 255, 120))
+        self.tab3.layout.addWidget(self.traceHistogramWidget)
+        self.traceSummaryLabel = QLabel()
+        self.traceSummaryLabel.setFont(QFont('Monospace', 9))
+        self.traceSummaryLabel.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        self.tab3.layout.addWidget(self.traceSummaryLabel)
+
+        traceHBox = QHBoxLayout()
+        traceHBox.setAlignment(Qt.AlignLeft)
+        self.traceCheckbox = QCheckBox('Trace Commands (from next connection)', self)
+        traceHBox.addWidget(self.traceCheckbox)
+        self.clearTraceButton = QPushButton('Clear Trace', self)
+        self.clearTraceButton.clicked.connect(self.clear_trace)
+        traceHBox.addWidget(self.clearTraceButton)
+        self.exportTraceButton = QPushButton('Export Trace', self)
+        self.exportTraceButton.clicked.connect(self.export_trace)
+        traceHBox.addWidget(self.exportTraceButton)
+        self.tab3.layout.addLayout(traceHBox)
+        self.tab3.setLayout(self.tab3.layout)
+        self.traceTimer = QTimer(self)
+        self.traceTimer.timeout.connect(self.update_trace_display)
+        self.traceTimer.start(1000)
+
+        # Tab 4: Maximum power point tracking
+
+        self.tab4 = QWidget()
+        self.tab4.layout = QVBoxLayout()
+        self.mppPlotWidget = pg.PlotWidget(viewBox=pg.ViewBox(border='k'))
+        self.mppPlotWidget.setBackground('w')
+        self.mppPlotWidget.setTitle('Power at the Maximum Power Point')
+        self.mppPlotWidget.setLabel('bottom', 'Time (s)')
+        self.mppPlotWidget.setLabel('left', 'Power (W)')
+        self.mppCurve = plot_manager.fast_item(self.mppPlotWidget, pg.mkPen('g', width=1))
+        self.storedSeriesCurve = None  # A series shown from the store instead of the live rows
+        self.tab4.layout.addWidget(self.mppPlotWidget)
+        self.mppStatusLabel = QLabel()
+        self.tab4.layout.addWidget(self.mppStatusLabel)
+
+        mppHBox = QHBoxLayout()
+        mppHBox.setAlignment(Qt.AlignLeft)
+        mppHBox.addWidget(QLabel('Step (V):'))
+        self.mppStepEdit = QLineEdit('0.005')
+        self.mppStepEdit.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        mppHBox.addWidget(self.mppStepEdit)
+        mppHBox.addWidget(QLabel('Average (s):'))
+        self.mppAverageEdit = QLineEdit('1')
+        self.mppAverageEdit.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        mppHBox.addWidget(self.mppAverageEdit)
+        mppHBox.addWidget(QLabel('Sweep Every (s):'))
+        self.mppSweepIntervalEdit = QLineEdit('600')
+        self.mppSweepIntervalEdit.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        mppHBox.addWidget(self.mppSweepIntervalEdit)
+        self.startMppButton = QPushButton('Start MPP', self)
+        self.startMppButton.clicked.connect(self.start_mpp_tracking)
+        mppHBox.addWidget(self.startMppButton)
+        self.stopMppButton = QPushButton('Stop MPP', self)
+        self.stopMppButton.clicked.connect(self.stop_mpp_tracking)
+        mppHBox.addWidget(self.stopMppButton)
+        self.tab4.layout.addLayout(mppHBox)
+
+        seriesHBox = QHBoxLayout()
+        seriesHBox.setAlignment(Qt.AlignLeft)
+        seriesHBox.addWidget(QLabel('Stored Series:'))
+        self.seriesComboBox = QComboBox()
+        self.seriesComboBox.setSizeAdjustPolicy(QComboBox.AdjustToContents)
+        seriesHBox.addWidget(self.seriesComboBox)
+        self.refreshSeriesButton = QPushButton('Refresh', self)
+        self.refreshSeriesButton.clicked.connect(self.refresh_series_list)
+        seriesHBox.addWidget(self.refreshSeriesButton)
+        self.showSeriesButton = QPushButton('Show Stored', self)
+        self.showSeriesButton.clicked.connect(self.show_stored_series)
+        seriesHBox.addWidget(self.showSeriesButton)
+        self.tab4.layout.addLayout(seriesHBox)
+        self.tab4.setLayout(self.tab4.layout)
+        # The plot keeps the most recent averaged rows; the store keeps all of them
+        self.mppBuffer = stream_buffer.RingBuffer(20000)
 
         # Creating a Grid Layout for below the plot
 
@@ -108,6 +241,13 @@ class KeithleyApp(QWidget):
         plotHBox.addWidget(self.powerPlotWidget)  # Add to the horizontal box layout
 
         self.tab2.layout.addLayout(plotHBox)  # Add the horizontal layout to the tab2's vertical layout
+
+        # Curves that show the sweep in progress; reused for every sweep and redrawn at a limited rate
+        self.liveIVCurve = live_plot.LiveCurve(self.ivPlotWidget, pg.mkPen('r', width=2))
+        self.livePowerCurve = live_plot.LiveCurve(self.powerPlotWidget, pg.mkPen('r', width=2))
+        self.redrawTimer = live_plot.make_redraw_timer(self, self.redraw_live_curves)
+        # Finished sweeps: all are kept, the pinned and the most recent ones are drawn
+        self.ivOverlay = plot_manager.CurveOverlay([self.ivPlotWidget, self.powerPlotWidget])
         self.layout_inputs = QGridLayout()
         self.layout_inputs.addWidget(QLabel('Start Voltage (V):'), 0, 0)
         self.startVoltageEdit = QLineEdit('-1')
@@ -163,17 +303,23 @@ class KeithleyApp(QWidget):
         self.mppDisplay = QLabel()
         self.tab2.layout.addWidget(self.mppDisplay)
 
-        self.ivTableWidget = QTableWidget()
-        self.ivTableWidget.setColumnCount(9)
-        self.ivTableWidget.setHorizontalHeaderLabels(
-            ['Voltage (V)', 'Current (A)', 'Voc', 'Isc', 'FF', 'Mpp', 'Vmp', 'Imp', 'PCE'])
+        self.diodeDisplay = QLabel()
+        self.tab2.layout.addWidget(self.diodeDisplay)
 
-        self.ivTableWidget.setVerticalScrollBar(QScrollBar())
-        self.ivTableWidget.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.hysteresisDisplay = QLabel()
+        self.tab2.layout.addWidget(self.hysteresisDisplay)
+        self.pairDisplay = QLabel()
+        self.tab2.layout.addWidget(self.pairDisplay)
+        self.queueStatusLabel = QLabel()
+        self.tab2.layout.addWidget(self.queueStatusLabel)
 
-        # self.tab2.layout.addWidget(self.ivTableWidget)
+        # The table shows the sweeps' arrays through a model, formatting only the visible cells
+        self.ivTableModel = iv_table_model.IVTableModel()
+        self.ivTableView = QTableView()
+        self.ivTableView.setModel(self.ivTableModel)
+        self.ivTableView.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
 
-        self.layout_inputs.addWidget(self.ivTableWidget, 0, 3, 20, 20)
+        self.layout_inputs.addWidget(self.ivTableView, 0, 3, 20, 20)
         self.layout_inputs.setColumnStretch(3, 5)
         self.tab2.setLayout(self.tab2.layout)
 
@@ -198,11 +344,108 @@ class KeithleyApp(QWidget):
         self.layout_inputs.setAlignment(Qt.AlignLeft)
         self.tabWidget.addTab(self.tab2, "IV Measurements")
         self.tabWidget.addTab(self.tab1, "F factor")
+        self.tabWidget.addTab(self.tab4, "MPP Tracking")
+        self.tabWidget.addTab(self.tab3, "Instrument Trace")
         self.layout_inputs.addWidget(QLabel('Measurement Direction:'), 6, 0)
         self.directionComboBox = QComboBox()
-        self.directionComboBox.addItems(['Forward', 'Reverse', 'Both'])
+        self.directionComboBox.addItems(['Forward', 'Reverse', 'Both', 'Hysteresis'])
         self.layout_inputs.addWidget(self.directionComboBox, 6, 1)
 
+        # Sweep engine settings
+
+        self.layout_inputs.addWidget(QLabel('Sweep Mode:'), 13, 0)
+        self.sweepModeComboBox = QComboBox()
+        self.sweepModeComboBox.addItems(['Instrument', 'Stepped', 'Adaptive'])
+        self.layout_inputs.addWidget(self.sweepModeComboBox, 13, 1)
+
+        self.layout_inputs.addWidget(QLabel('NPLC:'), 14, 0)
+        self.nplcEdit = QLineEdit('1')
+        self.nplcEdit.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.layout_inputs.addWidget(self.nplcEdit, 14, 1)
+
+        self.layout_inputs.addWidget(QLabel('Source Delay (s):'), 15, 0)
+        self.sourceDelayEdit = QLineEdit('0.05')
+        self.sourceDelayEdit.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.layout_inputs.addWidget(self.sourceDelayEdit, 15, 1)
+
+        self.layout_inputs.addWidget(QLabel('Settle Tolerance (%):'), 16, 0)
+        self.settleToleranceEdit = QLineEdit('0.5')
+        self.settleToleranceEdit.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.layout_inputs.addWidget(self.settleToleranceEdit, 16, 1)
+
+        self.layout_inputs.addWidget(QLabel('Max Settle Time (s):'), 17, 0)
+        self.maxSettleTimeEdit = QLineEdit('2')
+        self.maxSettleTimeEdit.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.layout_inputs.addWidget(self.maxSettleTimeEdit, 17, 1)
+
+        self.layout_inputs.addWidget(QLabel('Show Sweep:'), 18, 0)
+        self.sweepSelectorComboBox = QComboBox()
+        self.sweepSelectorComboBox.currentIndexChanged.connect(self.ivTableModel.set_current)
+        self.layout_inputs.addWidget(self.sweepSelectorComboBox, 18, 1)
+
+        self.layout_inputs.addWidget(QLabel('Hysteresis Dwell (s):'), 20, 0)
+        self.dwellTimeEdit = QLineEdit('0')
+        self.dwellTimeEdit.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.layout_inputs.addWidget(self.dwellTimeEdit, 20, 1)
+
+        # Dark curves are cached per device, so set the device before measuring it in the dark or the light
+        self.layout_inputs.addWidget(QLabel('Device ID:'), 21, 0)
+        self.deviceIdEdit = QLineEdit('')
+        self.layout_inputs.addWidget(self.deviceIdEdit, 21, 1)
+
+        self.layout_inputs.addWidget(QLabel('Illumination:'), 22, 0)
+        self.illuminationComboBox = QComboBox()
+        self.illuminationComboBox.addItems(['Light', 'Dark'])
+        self.layout_inputs.addWidget(self.illuminationComboBox, 22, 1)
+        # Digital I/O line of the light shutter (high opens it); closed for dark sweeps, opened for light ones
+        self.shutterLineEdit = QLineEdit('')
+        self.shutterLineEdit.setPlaceholderText('Shutter line')
+        self.shutterLineEdit.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.layout_inputs.addWidget(self.shutterLineEdit, 22, 2)
+
+        # A point budget below the number of steps measures a coarse sweep refined around the knee
+        self.layout_inputs.addWidget(QLabel('Point Budget (0 = all):'), 23, 0)
+        self.pointBudgetEdit = QLineEdit('0')
+        self.pointBudgetEdit.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.layout_inputs.addWidget(self.pointBudgetEdit, 23, 1)
+
+        self.layout_inputs.addWidget(QLabel('Max Curves Shown:'), 24, 0)
+        self.maxCurvesEdit = QLineEdit(str(plot_manager.DEFAULT_MAX_CURVES))
+        self.maxCurvesEdit.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.maxCurvesEdit.editingFinished.connect(self.set_max_curves)
+        self.layout_inputs.addWidget(self.maxCurvesEdit, 24, 1)
+
+        # A device queue measures every listed device through the switch matrix, one after another
+        self.layout_inputs.addWidget(QLabel('Device Queue:'), 25, 0)
+        self.deviceQueueEdit = QLineEdit('')
+        self.deviceQueueEdit.setPlaceholderText('px1=1A01, px2=1A02, ...')
+        self.layout_inputs.addWidget(self.deviceQueueEdit, 25, 1)
+
+        self.layout_inputs.addWidget(QLabel('Switch Resource:'), 26, 0)
+        self.switchResourceEdit = QLineEdit('')
+        self.layout_inputs.addWidget(self.switchResourceEdit, 26, 1)
+
+        self.queueStartButton = QPushButton('Run Device Queue', self)
+        self.queueStartButton.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.queueStartButton.clicked.connect(self.start_device_queue)
+        self.layout_inputs.addWidget(self.queueStartButton, 25, 2)
+        # Unchecked, every device of the queue is measured again
+        self.resumeQueueCheckbox = QCheckBox('Resume Queue', self)
+        self.resumeQueueCheckbox.setChecked(True)
+        self.layout_inputs.addWidget(self.resumeQueueCheckbox, 26, 2)
+
+        # Pinned sweeps stay on the plots however many sweeps follow
+        self.pinSweepButton = QPushButton('Pin/Unpin Sweep', self)
+        self.pinSweepButton.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.pinSweepButton.clicked.connect(self.toggle_pinned_sweep)
+        self.layout_inputs.addWidget(self.pinSweepButton, 18, 2)
+
+        # Every finished sweep can be appended to the HDF5 data store together with its metadata
+        self.storeCheckbox = QCheckBox('Record to Store:', self)
+        self.layout_inputs.addWidget(self.storeCheckbox, 19, 0)
+        self.storePathEdit = QLineEdit('iv_sweeps.h5')
+        self.layout_inputs.addWidget(self.storePathEdit, 19, 1)
+
         # For IV plot
 
         self.clearIVPlotButton = QPushButton('Clear Plots', self)
@@ -265,8 +508,8 @@ class KeithleyApp(QWidget):
         self.keithleyInfoLineEdit.setPlaceholderText("Keithley Info will be displayed here...")
         hbox.addWidget(self.keithleyInfoLineEdit)
 
-        # Checkbox for using test dataset
-        self.useTestDataCheckbox = QCheckBox("Use Test Dataset", self)
+        # Checkbox for measuring on the simulated SourceMeter instead of the instrument
+        self.useTestDataCheckbox = QCheckBox("Use Simulator", self)
         self.useTestDataCheckbox.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
         hbox.addWidget(self.useTestDataCheckbox)
 
@@ -277,8 +520,36 @@ class KeithleyApp(QWidget):
         self.FFactorCheckbox.setChecked(True)
 
     def clear_iv_plot(self):
-        self.ivPlotWidget.clear()
-        self.powerPlotWidget.clear()
+        self.ivOverlay.clear()
+        self.liveIVCurve.attach()
+        self.livePowerCurve.attach()
+
+    def set_max_curves(self):
+        try:
+            self.ivOverlay.set_max_curves(int(self.maxCurvesEdit.text()))
+        except ValueError:
+            self.maxCurvesEdit.setText(str(self.ivOverlay.max_curves))
+
+    def toggle_pinned_sweep(self):
+        label = self.sweepSelectorComboBox.currentText()
+        if label in self.ivOverlay.pinned:
+            self.ivOverlay.unpin(label)
+        elif label:
+            self.ivOverlay.pin(label)
+
+    def start_live_curves(self):
+        self.liveIVCurve.clear()
+        self.livePowerCurve.clear()
+
+    def append_live_points(self, voltages, currents):
+        voltages = np.asarray(voltages, dtype=float)
+        currents = np.asarray(currents, dtype=float)
+        self.liveIVCurve.append(voltages, currents)
+        self.livePowerCurve.append(voltages, voltages * currents)
+
+    def redraw_live_curves(self):
+        self.liveIVCurve.redraw()
+        self.livePowerCurve.redraw()
 
     def use_F_Factor(self):
         if self.FFactorCheckbox.isChecked():
@@ -304,126 +575,398 @@ class KeithleyApp(QWidget):
             self.fFactorLineEdit.setEnabled(False)
             self.mFactorLineEdit.setEnabled(False)
 
-    def search_for_keithley(self):
-        """Search for a Keithley device with a specific ID pattern."""
-        keithley_id_pattern = "USB0::0x05E6::0x2614::*::INSTR"  # This pattern will match any Keithley device with the specified prefix
-
-        # List all connected VISA resources
-        resources = self.rm.list_resources()
+    def update_trace_display(self):
+        if not self.traceCheckbox.isChecked() or self.tabWidget.currentWidget() is not self.tab3:
+            return
+        histogram = self.commandTrace.stats()['histogram']
+        counts = np.array(histogram['counts'])
+        # Readings below and above the edges are shown in the first and last bins
+        counts[1] += counts[0]
+        counts[-2] += counts[-1]
+        self.traceHistogram.setData(np.log10(histogram['edges']), counts[1:-1])
+        self.traceSummaryLabel.setText(self.commandTrace.summary())
+
+    def clear_trace(self):
+        self.commandTrace.clear()
+        self.traceHistogram.setData([], [])
+        self.traceSummaryLabel.clear()
+
+    def export_trace(self):
+        fileName, _ = QFileDialog.getSaveFileName(self, "Export Trace", "trace.json",
+                                                  "Chrome Trace (*.json);;CSV Files (*.csv)")
+        if fileName:
+            self.commandTrace.export(fileName)
+
+    def discover_resources(self):
+
+        if self.discovery is not None and self.discovery.isRunning():
+            return
+        self.discovery = ResourceDiscovery(self.rm)
+        self.discovery.resources_found.connect(self.show_resources)
+        self.discovery.start()
+
+    def show_resources(self, resource_manager, resources, error):
+
+        self.rm = resource_manager
+        self.resources = resources
+        if self.keithley is None:
+            if error:
+                self.keithleyInfoLineEdit.setPlaceholderText(f'VISA not available: {error}')
+            elif resources:
+                self.keithleyInfoLineEdit.setPlaceholderText(f"Found: {', '.join(resources)}")
+            else:
+                self.keithleyInfoLineEdit.setPlaceholderText('No SourceMeter found')
+
+    def after_discovery(self, action):
+        """Whether the resource discovery has finished; if not, action runs once it has (or is dropped after
+        DISCOVERY_TIMEOUT seconds) and the caller returns without waiting."""
+        if self.discovery is None:
+            self.discover_resources()
+        if self.discovery.found.is_set():
+            # The queued resources_found signal may not have been delivered yet
+            self.show_resources(*self.discovery.result)
+            return True
+        self.discoveryAction = action
+        self.discoveryDeadline = time.monotonic() + DISCOVERY_TIMEOUT
+        self.connectionStatus.setText('Searching...')
+        self.connectionStatus.setStyleSheet("color: orange")
+        self.discoveryTimer.start()
+        return False
+
+    def check_discovery(self):
+
+        if self.discovery.found.is_set():
+            self.discoveryTimer.stop()
+            action, self.discoveryAction = self.discoveryAction, None
+            self.connectionStatus.setText('Not Connected')
+            self.connectionStatus.setStyleSheet("color: red")
+            if action is not None:
+                action()
+        elif time.monotonic() > self.discoveryDeadline:
+            self.discoveryTimer.stop()
+            self.discoveryAction = None
+            self.connectionStatus.setText('Not Connected')
+            self.connectionStatus.setStyleSheet("color: red")
+            self.keithleyInfoLineEdit.setPlaceholderText(
+                f'No answer from the VISA resource discovery after {DISCOVERY_TIMEOUT:.0f} s; connect again later')
 
-        for resource in resources:
-            if resource.startswith(keithley_id_pattern):
-                return resource  # Return the found Keithley ID
-        return None
+    def search_for_keithley(self):
+        """Return the first Keithley 26xx SourceMeter found by the finished discovery (None if there is none)."""
+        if self.rm is None:
+            raise RuntimeError(f'VISA is not available: {self.discovery.result[2]}')
+        return self.resources[0] if self.resources else None
 
     def connect_keithley(self):
+        # One session owns the instrument; the IV sweep and the current stream both go through it
+        if not self.useTestDataCheckbox.isChecked() and not self.after_discovery(self.connect_keithley):
+            return  # Connects once the discovery has finished
         if self.useTestDataCheckbox.isChecked():
-            # Use test dataset
-            self.keithley = MockKeithley()
-            self.keithley_1 = MockKeithley()
-            if self.keithley:
-                self.keithleyInfoLineEdit.setText('Testing with Mock keithley')
-            else:
-                pass
+            # Simulated SourceMeter with a solar cell on channel A and a reference cell on channel B
+            import simulated_keithley
+            self.keithley = keithley_session.KeithleySession(
+                simulated_keithley.SimulatedKeithley(**self.simulator_options), 'Simulated 2614B')
+            self.keithleyInfoLineEdit.setText('Testing with simulated Keithley')
 
         else:
-            # Use real dataset
-            self.keithley = self.rm.open_resource('USB0::0x05E6::0x2614::4577888::INSTR')
-            self.keithley_1 = self.rm.open_resource('USB0::0x05E6::0x2614::4577888::INSTR')
-            if self.keithley:
-                self.keithleyInfoLineEdit.setText('USB0::0x05E6::0x2614::4577888::INSTR')
-            else:
-                pass
+            # Use the connected instrument
+            resource_name = self.search_for_keithley() or measurement_core.DEFAULT_RESOURCE
+            self.keithley = keithley_session.KeithleySession(self.rm.open_resource(resource_name), resource_name)
+            self.keithleyInfoLineEdit.setText(resource_name)
 
-        # self.keithley_1 = self.search_for_keithley()
+        if self.traceCheckbox.isChecked():
+            self.keithley = command_trace.TracedSession(self.keithley, self.commandTrace)
 
-
-        # self.keithley = self.rm.open_resource('USB0::0x05E6::0x2614::4577888::INSTR')
-        #
-        # self.keithley_1 = self.rm.open_resource('USB0::0x05E6::0x2614::4577888::INSTR')
-
-
-
-        self.keithley.write("*RST")
-        self.keithley.write('smua.reset()')
-        self.keithley.write('smua.source.func = smua.OUTPUT_DCVOLTS')
-        self.keithley.write('smua.source.levelv = 0')
-        self.keithley.write('smua.source.limiti = 105e-6')
-        self.keithley.write('smua.measure.autozero = smua.AUTOZERO_ONCE')
-        self.keithley.write('smua.source.output = smua.OUTPUT_ON')
         self.connectionStatus.setText('Connected')
         self.connectionStatus.setStyleSheet("color: green")
 
-        # Get the selected channel
-
+        # Configure the IV channel and the reference (current) channel
         selected_channel_1 = self.tab2ChannelComboBox.currentText().lower()
-
-        # Set the channel based on the selected channel
-
-        self.keithley.write(f'smu{selected_channel_1}.reset()')
-        self.keithley.write(f'smu{selected_channel_1}.source.func = smua.OUTPUT_DCVOLTS')
-        self.keithley.write(f'smu{selected_channel_1}.source.levelv = 0')
-        self.keithley.write(f'smu{selected_channel_1}.source.limiti = 105e-3')
-        self.keithley.write(f'smu{selected_channel_1}.measure.autozero = smua.AUTOZERO_ONCE')
-        self.keithley.write(f'smu{selected_channel_1}.source.output = smua.OUTPUT_ON')
         selected_channel_2 = self.tab1ChannelComboBox.currentText().lower()
-
-        # self.keithley_1 = self.rm.open_resource('USB0::0x05E6::0x2614::4577888::INSTR')
-
-        self.keithley_1.write(f'smub.reset()')
-        self.keithley_1.write(f'smub.source.func = smu{selected_channel_2}.OUTPUT_DCVOLTS')
-        self.keithley_1.write(f'smu{selected_channel_2}.source.levelv = 0')
-        self.keithley_1.write(f'smu{selected_channel_2}.source.limiti = 105e-3')
-        self.keithley_1.write(f'smu{selected_channel_2}.measure.autozero = smu{selected_channel_2}.AUTOZERO_ONCE')
-        self.keithley_1.write(f'smu{selected_channel_2}.source.output = smu{selected_channel_2}.OUTPUT_ON')
+        measurement_core.configure_instrument(self.keithley, [selected_channel_1, selected_channel_2])
 
     def start_plotting(self):
 
         selected_channel = self.tab1ChannelComboBox.currentText().lower()
-        self.stop = False
-        self.plot_thread = threading.Thread(target=self.plotting_loop)
-        self.plot_thread.start()
+        if self.stream_worker is not None:
+            self.stream_worker.stop()
+            self.stream_worker.wait()
+        if self.streamTask is not None:
+            self.streamTask.cancel()
+        self.currentBuffer.clear()
+        rate = float(self.sampleRateEdit.text())
+        if self.asyncLoop is not None:
+            # The monitor runs as a task on the GUI's event loop; stopping it takes effect immediately
+            self.streamTask = self.asyncLoop.create_task(self.stream_current(selected_channel, rate))
+            return
+        self.stream_worker = current_stream.CurrentStreamWorker(self.keithley, selected_channel, rate)
+        self.stream_worker.samples_acquired.connect(self.update_current_stream)
+        self.stream_worker.start()
+
+    async def stream_current(self, channel, rate):
+        driver = async_driver.AsyncKeithley(self.keithley)
+        try:
+            await driver.stream(f'smu{channel}', rate, self.update_current_stream)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            driver.close()
 
     def stop_plotting(self):
 
-        self.stop = True
-        self.plot_thread.join()
-        # self.keithley.close()
-
-    def plotting_loop(self):
-
-        while not self.stop:
-            if self.tab1ChannelComboBox.currentText().lower() == 'a':
-
-                current = float(self.mFactorLineEdit.text()) * float(
-
-                self.keithley_1.query('print(smua.measure.i())')) / float(self.IscLineEdit.text())
-
-            if self.tab1ChannelComboBox.currentText().lower() == 'b':
-
-                current = float(self.mFactorLineEdit.text()) * float(
-
-                self.keithley_1.query('print(smub.measure.i())')) / float(self.IscLineEdit.text())
-            print(f'Measured current: {current} A')
-
-            self.fFactorLineEdit.setText(str(current))
-            time.sleep(1)
+        # The worker aborts the instrument trigger model and exits on its own, so the GUI does not wait for it
+        if self.stream_worker is not None:
+            self.stream_worker.stop()
+        if self.streamTask is not None:
+            self.streamTask.cancel()
+
+    def update_current_stream(self, timestamps, currents):
+
+        self.currentBuffer.extend(timestamps, currents)
+        times, values = self.currentBuffer.get()
+        self.currentCurve.setData(times - times[0], values)
+        self.currentStatsLabel.setText(f'Mean: {np.mean(values):.6g} A, Std: {np.std(values):.3g} A, '
+                                       f'Samples: {len(values)}')
+        try:
+            f_factor = float(self.mFactorLineEdit.text()) * np.mean(currents) / float(self.IscLineEdit.text())
+        except (ValueError, ZeroDivisionError):
+            return
+        self.fFactorLineEdit.setText(str(f_factor))
+
+    def prepare_instrument(self, channel, retry):
+        """Connect (or configure) the SourceMeter for a measurement on channel. Returns False while the resource
+        discovery a connection needs is still running; retry() is then called once it has finished."""
+        if self.keithley is None:
+            if not self.useTestDataCheckbox.isChecked() and not self.after_discovery(retry):
+                return False
+            self.connect_keithley()
+        else:
+            # The session remembers the configuration, so this only sends settings that changed
+            measurement_core.configure_instrument(
+                self.keithley, [channel, self.tab1ChannelComboBox.currentText().lower()])
+        return True
+
+    def sweep_settings(self, channel):
+
+        return measurement_core.SweepSettings(
+            start_voltage=float(self.startVoltageEdit.text()),
+            stop_voltage=float(self.stopVoltageEdit.text()),
+            step_voltage=float(self.stepVoltageEdit.text()),
+            direction=self.directionComboBox.currentText(),
+            sweep_mode=self.sweepModeComboBox.currentText(),
+            channel=channel,
+            nplc=float(self.nplcEdit.text()),
+            source_delay=float(self.sourceDelayEdit.text()),
+            settle_tolerance=float(self.settleToleranceEdit.text()) / 100,
+            max_settle_time=float(self.maxSettleTimeEdit.text()),
+            dwell_time=float(self.dwellTimeEdit.text()),
+            refine_points=int(self.pointBudgetEdit.text()))
+
+    def set_illumination(self, illumination):
+        """Close the shutter for 'dark' and open it otherwise; returns False if there is no shutter line."""
+        line = self.shutterLineEdit.text().strip()
+        if not line:
+            return False
+        measurement_core.set_shutter(self.keithley, int(line), illumination != 'dark')
+        return True
 
     def start_iv_measurement(self):
 
         selected_channel = self.tab2ChannelComboBox.currentText().lower()
-        if self.worker is not None:
-            self.worker.stop()
-        start_voltage = float(self.startVoltageEdit.text())
-        stop_voltage = float(self.stopVoltageEdit.text())
-        step_voltage = float(self.stepVoltageEdit.text())
-        measurement_direction = self.directionComboBox.currentText()
-        self.worker = IVWorker(self.keithley, start_voltage, stop_voltage, step_voltage, measurement_direction)
+        for worker in (self.worker, self.mpp_worker, self.queue_worker):
+            if worker is not None:
+                worker.stop()
+                worker.wait()
+        if not self.prepare_instrument(selected_channel, self.start_iv_measurement):
+            return
+        settings = self.sweep_settings(selected_channel)
+
+        # Sample the reference cell at every IV point when the F factor is in use
+        reference_channel = self.tab1ChannelComboBox.currentText().lower()
+        if self.FFactorCheckbox.isChecked() and reference_channel != selected_channel:
+            settings.reference_channel = reference_channel
+            if self.streamTask is not None and not self.streamTask.done():
+                # Start the sweep once the monitor task has aborted the reference channel's trigger model
+                self.streamTask.cancel()
+                self.streamTask.add_done_callback(lambda task: self.start_iv_measurement())
+                return
+            if self.stream_worker is not None and self.stream_worker.isRunning():
+                # The sweep needs the reference channel's trigger model
+                self.stream_worker.stop()
+                self.stream_worker.wait()
+
+        illumination = self.illuminationComboBox.currentText().lower()
+        # Without a shutter a dark sweep is only used as a dark curve if it shows no photocurrent
+        self.shutterDriven = self.set_illumination(illumination)
+        self.sweepContext = (self.deviceIdEdit.text().strip(), illumination, settings)
+        self.worker = IVWorker(self.keithley, settings)
         self.worker.data_acquired.connect(self.update_iv_plot)
-        self.connect_keithley()
+        self.worker.sweep_started.connect(self.start_live_curves)
+        self.worker.points_acquired.connect(self.append_live_points)
         self.worker.start()
 
+    def open_switch(self, routes, channel):
+        """Session of the switch matrix: the one at the Switch Resource, or a simulated substrate behind the
+        simulated SourceMeter when it is in use."""
+        if self.useTestDataCheckbox.isChecked():
+            import simulated_keithley
+            pixels = simulated_keithley.simulated_substrate(routes.values(), seed=0)
+            return keithley_session.KeithleySession(
+                simulated_keithley.SimulatedSwitchMatrix(self.keithley.resource, pixels, f'smu{channel}'),
+                'Simulated switch matrix')
+        resource_name = self.switchResourceEdit.text().strip()
+        if self.switchSession is None or self.switchSession.name != resource_name:
+            if self.rm is None:
+                self.search_for_keithley()
+            self.switchSession = keithley_session.KeithleySession(self.rm.open_resource(resource_name),
+                                                                  resource_name)
+        return self.switchSession
+
+    def start_device_queue(self):
+
+        import device_queue
+        import sweep_store
+        from scheduler import SweepJob
+        routes = device_queue.parse_devices(self.deviceQueueEdit.text())
+        if not routes:
+            self.queueStatusLabel.setText('List the devices of the queue first, e.g. px1=1A01, px2=1A02')
+            return
+        # Pixel ids repeat on every substrate, so the queue is named (and resumed) by the substrate's Device ID
+        name = self.deviceIdEdit.text().strip()
+        if not name:
+            self.queueStatusLabel.setText('Enter the substrate as the Device ID; it names the queue')
+            return
+        selected_channel = self.tab2ChannelComboBox.currentText().lower()
+        for worker in (self.worker, self.mpp_worker, self.queue_worker):
+            if worker is not None:
+                worker.stop()
+                worker.wait()
+        if not self.prepare_instrument(selected_channel, self.start_device_queue):
+            return
+        settings = self.sweep_settings(selected_channel)
+        illumination = self.illuminationComboBox.currentText().lower()
+        if not self.set_illumination(illumination) and illumination == 'dark':
+            # The queue records its curves without looking at them, so only a shutter can darken the devices
+            self.queueStatusLabel.setText('A dark queue needs the Shutter line that darkens the devices')
+            return
+        jobs = [SweepJob(device_id, settings, irradiance=float(self.irradianceEdit.text()),
+                         area=float(self.areaEdit.text()), illumination=illumination) for device_id in routes]
+        switch = device_queue.SwitchMatrix(self.open_switch(routes, selected_channel), routes)
+        # With Resume Queue the devices recorded by an earlier run of the same queue are skipped
+        store = sweep_store.SweepStore(self.storePathEdit.text()) if self.storeCheckbox.isChecked() else None
+        queue = device_queue.DeviceQueue(self.keithley, switch, jobs, store, name,
+                                         resume=self.resumeQueueCheckbox.isChecked())
+        self.sweepContext = None
+        self.queue_worker = QueueWorker(queue)
+        self.queue_worker.device_recorded.connect(self.show_queue_result)
+        self.queue_worker.finished.connect(self.show_queue_summary)
+        self.queueStatusLabel.setText(f"Queue '{queue.name}': measuring {len(jobs)} devices")
+        self.queue_worker.start()
+
+    def show_queue_result(self, result):
+
+        queue = self.queue_worker.queue
+        for voltages, currents, extras, foms, diode in result.sweeps:
+            timed_out = ' (timed out)' if extras.get('timed_out') else ''
+            self.show_sweep(f"{result.job.device_id} ({result.route}): {extras.get('direction', '')}{timed_out}",
+                            voltages, currents, foms)
+        foms, diode = result.sweeps[-1][3], result.sweeps[-1][4]
+        self.diodeDisplay.setText(f"Rs: {diode['rs']:.4g} Ohm, Rsh: {diode['rsh']:.4g} Ohm, n: {diode['n']:.3f}, "
+                                  f"I0: {diode['i0']:.3e} A" if diode is not None else 'Diode fit failed')
+        self.queueStatusLabel.setText(
+            f"Queue '{queue.name}': {result.job.device_id} done, {queue.recorded} of "
+            f"{len(queue.jobs) - queue.skipped} devices (PCE {foms['pce']:.3f} %)")
+
+    def show_queue_summary(self):
+
+        queue = self.queue_worker.queue
+        stats = queue.stats()
+        self.queueStatusLabel.setToolTip('\n'.join(f'{device_id} failed:\n{error}'
+                                                   for device_id, error in queue.errors))
+        if stats['devices'] == 0 and not queue.errors:
+            self.queueStatusLabel.setText(f"Queue '{queue.name}': no devices measured, "
+                                          f"{queue.skipped} recorded earlier")
+            return
+        text = (f"Queue '{queue.name}': {stats['devices']} devices in {stats['wall']:.1f} s, instrument busy "
+                f"{stats['instrument_share']:.0%} of the time")
+        if queue.skipped:
+            text += f', {queue.skipped} recorded earlier and skipped'
+        if queue.errors:
+            # The last line of a traceback names the error; the whole tracebacks are in the tooltip
+            text += ', failed: ' + ', '.join(f'{device_id} ({error.strip().splitlines()[-1]})'
+                                             for device_id, error in queue.errors)
+        self.queueStatusLabel.setText(text)
+
+
+
+    def start_mpp_tracking(self):
 
+        selected_channel = self.tab2ChannelComboBox.currentText().lower()
+        # The tracker and the IV sweeps drive the same channel
+        for worker in (self.worker, self.mpp_worker, self.queue_worker):
+            if worker is not None:
+                worker.stop()
+                worker.wait()
+        if not self.prepare_instrument(selected_channel, self.start_mpp_tracking):
+            return
+        settings = mpp_tracker.MppSettings(step=float(self.mppStepEdit.text()),
+                                           average_window=float(self.mppAverageEdit.text()),
+                                           sweep_interval=float(self.mppSweepIntervalEdit.text()),
+                                           nplc=float(self.nplcEdit.text()))
+        self.mppBuffer.clear()
+        if self.storedSeriesCurve is not None:
+            self.storedSeriesCurve.remove()
+            self.storedSeriesCurve = None
+        sweep_settings = self.sweep_settings(selected_channel)
+        self.set_illumination('light')
+        self.sweepContext = (self.deviceIdEdit.text().strip(), 'light', sweep_settings)
+        self.mpp_worker = MppWorker(self.keithley, settings, sweep_settings)
+        self.mpp_worker.row_acquired.connect(self.update_mpp_plot)
+        self.mpp_worker.block_acquired.connect(
+            lambda block, name=f'mpp_smu{selected_channel}': self.record_mpp_block(name, block))
+        self.mpp_worker.data_acquired.connect(self.update_iv_plot)
+        self.mpp_worker.start()
+
+    def stop_mpp_tracking(self):
+
+        if self.mpp_worker is not None:
+            self.mpp_worker.stop()
+
+    def refresh_series_list(self):
+
+        import sweep_store
+        path = self.storePathEdit.text()
+        self.seriesComboBox.clear()
+        if os.path.exists(path):
+            self.seriesComboBox.addItems(sweep_store.SweepStore(path).series_names())
+
+    def show_stored_series(self):
+
+        import sweep_store
+        name = self.seriesComboBox.currentText()
+        if not name:
+            return
+        if self.storedSeriesCurve is not None:
+            self.storedSeriesCurve.remove()
+        self.mppCurve.setData([], [])
+        self.storedSeriesCurve = plot_manager.StoredSeriesCurve(
+            self.mppPlotWidget, sweep_store.SweepStore(self.storePathEdit.text()), name)
+        self.mppPlotWidget.enableAutoRange()
+
+    def update_mpp_plot(self, row):
+
+        self.mppBuffer.extend([row['time']], [row['power']])
+        times, powers = self.mppBuffer.get()
+        self.mppCurve.setData(times, powers)
+        self.mppStatusLabel.setText(f"t: {row['time']:.0f} s, V: {row['voltage']:.4f} V, "
+                                    f"I: {row['current']:.4e} A, P: {row['power']:.4e} W "
+                                    f"({row['power_min']:.4e} to {row['power_max']:.4e} W)")
+
+    def record_mpp_block(self, name, block):
+
+        if self.storeCheckbox.isChecked():
+            import sweep_store
+            store = sweep_store.SweepStore(self.storePathEdit.text())
+            store.append_series(name, block)
 
     def update_iv_plot(self, data):
 
@@ -432,114 +975,156 @@ class KeithleyApp(QWidget):
         # This is a very simplified calculation and might not be accurate for real devices
 
 
-        self.data = data
-        if self.useTestDataCheckbox.isChecked():
-            # Use test dataset
-            data = [[-1, -0.95918, -0.91837, -0.87755, -0.83673, -0.79592, -0.7551, -0.71429, -0.67347, -0.63265, -0.59184,
-                     -0.55102, -0.5102, -0.46939, -0.42857, -0.38776, -0.34694, -0.30612, -0.26531, -0.22449, -0.18367,
-                     -0.14286, -0.10204, -0.06122, -0.02041, 0, 0.02041, 0.06122, 0.10204, 0.14286, 0.18367, 0.22449,
-                     0.26531,
-                     0.30612, 0.34694, 0.38776, .42857, 0.45066, 0.46939, 0.5102, 0.55102, 0.59184, 0.63265, 0.67347,
-                     0.71429,
-                     0.7551, 0.79592, 0.83673, 0.87755, 0.91837, 0.95918, 1],
-                    [-0.00129, -0.0013, -0.0013, -0.00129, -0.00129, -0.00129, -0.0013, -0.0013, -0.00129, -0.00129,
-                     -0.00129, -0.00129, -0.00129, -0.00129, -0.00129, -0.00129, -0.00129, -0.00128, -0.00128, -0.00129,
-                     -0.00129, -0.00128, -0.00128, -0.00128, -0.00128, -0.00127, -0.00128, -0.00127, -0.00126, -0.00125,
-                     -0.00122, -0.00119, -0.00114, -0.00104, -9.00585E-4, -6.54968E-4, -2.74127E-4, 4.6524E-6, 2.94651E-4,
-                     0.0011, 0.00215, 0.00351, 0.00522, 0.00742, 0.01038, 0.01445, 0.02002, 0.02744, 0.03681, 0.0481,
-                     0.06119,
-                     0.0759]]  # Store data for saving
-        else:
-            # Use real dataset
-            pass
+        extras = data[2] if len(data) > 2 else {}
+        if len(extras.get('reference_currents', [])) > 0:
+            try:
+                f_factor = float(self.mFactorLineEdit.text()) * np.mean(extras['reference_currents']) / float(
+                    self.IscLineEdit.text())
+                self.fFactorLineEdit.setText(str(f_factor))
+            except (ValueError, ZeroDivisionError):
+                pass
 
         voltages = np.array(data[0])
         currents = np.array(data[1])
 
-        y_intercept = currents[np.argmin(np.abs(voltages))]
-        x_intercept = voltages[np.argmin(np.abs(currents))]
-        power = voltages * currents
-        # voc = x_intercept  # Open-circuit voltage
-        # isc = y_intercept  # Short-circuit current
-        isc = currents[np.argmin(np.abs(voltages))]  # Short-circuit current
-        voc = voltages[np.argmin(np.abs(currents))]  # Open-circuit voltage
-
-        power = voltages * currents
-        max_power = abs(np.min(power))  # Maximum power
-        mpp_voltage = voltages[np.argmin(power)]  # Voltage at MPP
-        mpp_current = currents[np.argmin(power)]  # Current at MPP
-        ff = abs(max_power) / abs(voc * isc)  # Fill factor
         input_power = float(self.irradianceEdit.text())  # W/m^2
         area = float(self.areaEdit.text())
-        pce = abs(ff*isc*voc) / abs(input_power*area) * 100  # Power conversion efficiency
-
-
-        # Initial guess for parameters
-        # initial_guess = [3, 766, 1, 1e-9]  # Rs, Rsh, n, Is
-        #
-        # # Fit the diode equation to the data
-        # params, _ = curve_fit(diode_equation, voltages, currents, p0=initial_guess)
-        #
-        # Rs_fit, Rsh_fit, n_fit, Is_fit = params
-        #
-        # print("Rs:", Rs_fit)
-        # print("Rsh:", Rsh_fit)
-
-        # Update the IV plot and the parameter displays
-        pen = pg.mkPen('b', width=3)
-        self.ivPlotWidget.plot(voltages, currents, pen=pen)
-        pen = pg.mkPen('g', width=3)
-        self.powerPlotWidget.plot(voltages, power, pen=pen)
-        # self.vocDisplay.setText(f'Voc: {voc:.9f} V')
-        # self.iscDisplay.setText(f'Isc: {isc:.9f} A')
-        # self.ffDisplay.setText(f'FF: {ff:.9f}')
-        # self.pceDisplay.setText(f'PCE: {pce:.9f}')
-        # self.mppDisplay.setText(f'MPP: {mpp_voltage:.9f} V, {mpp_current:.9f} A, {max_power:.9f} W')
+        foms = iv_analysis.figures_of_merit(voltages, currents, input_power, area)
+
+        # Fit the single-diode model, warm-started from the previous curve
+        try:
+            import diode_fit
+            if len(voltages) < len(diode_fit.PARAMETER_NAMES):
+                raise ValueError('Not enough points for a diode fit')
+            if self.diode_fitter is None:
+                self.diode_fitter = diode_fit.DiodeFitter()
+            diode = self.diode_fitter.fit(voltages, currents)
+            self.diodeDisplay.setText(f"Rs: {diode['rs']:.4g} Ohm, Rsh: {diode['rsh']:.4g} Ohm, "
+                                      f"n: {diode['n']:.3f}, I0: {diode['i0']:.3e} A")
+        except (ValueError, np.linalg.LinAlgError):
+            self.diodeDisplay.setText('Diode fit failed')
 
         # Record data in the table
 
-        self.ivTableWidget.setRowCount(len(voltages))
-        for i, (voltage, current) in enumerate(zip(voltages, currents)):
-            self.ivTableWidget.setItem(i, 0, QTableWidgetItem(str(voltage)))
-            self.ivTableWidget.setItem(i, 1, QTableWidgetItem(str(current)))
-            print(i)
-        self.ivTableWidget.setItem(0, 2, QTableWidgetItem(str(voc)))
-        self.ivTableWidget.setItem(0, 3, QTableWidgetItem(str(isc)))
-        self.ivTableWidget.setItem(0, 4, QTableWidgetItem(str(ff)))
-        self.ivTableWidget.setItem(0, 5, QTableWidgetItem(str(max_power)))
-        self.ivTableWidget.setItem(0, 6, QTableWidgetItem(str(mpp_voltage)))
-        self.ivTableWidget.setItem(0, 7, QTableWidgetItem(str(mpp_current)))
-        self.ivTableWidget.setItem(0, 8, QTableWidgetItem(str(f'{pce:.3f}')))
-
+        label = f"Sweep {self.sweep_count + 1}: {extras.get('direction', '')}"
+        if extras.get('timed_out'):
+            # The instrument did not finish the sweep in time; only the points it measured are shown
+            label += f" (timed out, {len(voltages)} of {extras['requested_points']} points)"
+        self.sweep_count += 1
+
+        # Update the IV plot and the parameter displays; the finished sweep replaces the live curve
+        self.show_sweep(label, voltages, currents, foms)
+        self.start_live_curves()
+
+        if 'hysteresis_index' in extras and extras.get('direction') == 'Reverse':
+            self.hysteresisDisplay.setText(f"Hysteresis index: {extras['hysteresis_index']:.4f} (Pmax), "
+                                           f"{extras['hysteresis_area_index']:.4f} (area)")
+
+        sweep_id = None
+        illumination = self.sweepContext[1] if self.sweepContext is not None else None
+        if illumination == 'dark' and not self.shutterDriven and not dark_light.is_dark(voltages, currents):
+            # Nothing darkened the device: neither cached nor recorded as its dark curve
+            illumination = 'light'
+            reason = (f"{abs(foms['isc']):.3g} A flows at 0 V" if np.isfinite(foms['isc'])
+                      else 'the sweep does not include 0 V')
+            self.pairDisplay.setText(f'Not used as a dark curve: {reason} and no Shutter line is set')
+        elif self.sweepContext is not None:
+            extras['dark_pair'] = self.pair_with_dark_curve(voltages, currents)
+        if self.storeCheckbox.isChecked():
+            sweep_id = self.record_sweep(voltages, currents, extras, foms, illumination)
+        if illumination == 'dark':
+            device_id, _, settings = self.sweepContext
+            dark_curve = self.darkCurves.put(device_id, settings,
+                                             dark_light.DarkCurve(voltages, currents, sweep_id=sweep_id))
+            self.pairDisplay.setText(f"Dark curve of '{device_id}' cached, Rsh: {dark_curve.rsh:.4g} Ohm")
+
+    def show_sweep(self, label, voltages, currents, foms):
+        """Add a finished sweep to the IV and power plots and to the table."""
+        self.ivOverlay.add(label, [(voltages, currents, pg.mkPen('b', width=1)),
+                                   (voltages, voltages * currents, pg.mkPen('g', width=1))])
+        self.ivTableModel.add_sweep(voltages, currents, foms, label)
+        self.sweepSelectorComboBox.blockSignals(True)
+        self.sweepSelectorComboBox.clear()
+        self.sweepSelectorComboBox.addItems(self.ivTableModel.labels())
+        self.sweepSelectorComboBox.setCurrentIndex(self.ivTableModel.current)
+        self.sweepSelectorComboBox.blockSignals(False)
+
+    def pair_with_dark_curve(self, voltages, currents):
+        """Analyse a light sweep against the cached dark curve of its device and setup (None if there is none)."""
+        device_id, illumination, settings = self.sweepContext
+        if illumination == 'dark':
+            return None
+        path = self.storePathEdit.text()
+        if self.storeCheckbox.isChecked() and path not in self.darkCurveStores and os.path.exists(path):
+            # Dark curves recorded in earlier sessions are used as well
+            import sweep_store
+            self.darkCurves.load_store(sweep_store.SweepStore(path))
+            self.darkCurveStores.add(path)
+        dark_curve = self.darkCurves.get(device_id, settings)
+        if dark_curve is None:
+            self.pairDisplay.setText(f"No dark curve of '{device_id}' for this setup")
+            return None
+        pair = dark_light.summary(dark_light.pair_metrics(dark_curve, voltages, currents), dark_curve)
+        self.pairDisplay.setText(f"Photocurrent: {pair['photo_isc']:.4e} A, superposition deviation: "
+                                 f"{pair['superposition_deviation']:.1%}, dark Rsh: {pair['dark_rsh']:.4g} Ohm "
+                                 f"(dark curve {pair['dark_age'] / 60:.0f} min old)")
+        return pair
+
+    def record_sweep(self, voltages, currents, extras, foms, illumination=None):
+
+        def value_of(edit):
+            try:
+                return float(edit.text())
+            except ValueError:
+                return None
+
+        metadata = {
+            'direction': extras.get('direction'),
+            'channel': extras.get('channel'),
+            'irradiance': value_of(self.irradianceEdit),
+            'area': value_of(self.areaEdit),
+            'f_factor': value_of(self.fFactorLineEdit),
+            'm_factor': value_of(self.mFactorLineEdit),
+            'instrument': getattr(self.keithley, 'name', ''),
+            'foms': foms,
+            'hysteresis_index': extras.get('hysteresis_index'),
+            'timed_out': extras.get('timed_out', False),
+        }
+        if self.sweepContext is not None:
+            device_id, _, settings = self.sweepContext
+            metadata.update(device=device_id, illumination=illumination, setup=dark_light.setup_key(settings),
+                            dark_pair=extras.get('dark_pair'))
+            if illumination == 'dark':
+                metadata['irradiance'] = 0.0
+        import sweep_store
+        store = sweep_store.SweepStore(self.storePathEdit.text())
+        return store.append(voltages, currents, metadata, extras.get('timestamps'), extras.get('settle_times'),
+                     extras.get('reference_currents'))
 
     def stop_iv_measurement(self):
 
-        if self.worker is not None:
-            self.worker.stop()
+        for worker in (self.worker, self.queue_worker):
+            if worker is not None:
+                worker.stop()
 
     def save_data(self):
-        if self.data is not None:
+        sweep = self.ivTableModel.current_sweep()
+        if sweep is not None:
             # Create a dialog for the user to choose a filename and location
             options = QFileDialog.Options()
             fileName, _ = QFileDialog.getSaveFileName(self, "QFileDialog.getSaveFileName()", "IV.txt",
                                                       "All Files (*);;Text Files (*.txt)", options=options)
             if fileName:
                 # Save data to a file
-                with open(fileName, 'w') as f:
-                    # Write Voltage and Current
-                    column_names = ["Voltage", "Current"]
-                    f.write('\t'.join(column_names) + '\n')  # write column names
-
-                    for i in range(self.ivTableWidget.rowCount()):
-                        voltage = self.ivTableWidget.item(i, 0).text()
-                        current = self.ivTableWidget.item(i, 1).text()
-                        f.write('\t'.join([voltage, current]) + '\n')
-
-                    # Write Voc, Isc, FF, Max_Power, MPP_Voltage, MPP_Current, PCE
-                    parameters = ["Voc", "Isc", "FF", "Max_Power", "MPP_Voltage", "MPP_Current", "PCE"]
-                    for j, param in enumerate(parameters, start=2):
-                        value = self.ivTableWidget.item(0, j).text()
-                        f.write(f"{param}: {value}\n")
+                import sweep_store
+                sweep_store.export_txt(fileName, sweep['voltages'], sweep['currents'], sweep['foms'])
+
+    def closeEvent(self, event):
+
+        # A thread still importing modules must not be destroyed while it runs
+        if self.discovery is not None:
+            self.discovery.wait()
+        super().closeEvent(event)
 
     def disconnect_keithley(self):
 
@@ -551,71 +1136,100 @@ class KeithleyApp(QWidget):
             self.keithleyInfoLineEdit.clear()
 
 
+class ResourceDiscovery(QThread):
+    """Create the VISA resource manager and list the connected SourceMeters off the GUI thread.
+
+    Afterwards it imports the analysis modules the first sweep needs, so the GUI does not stall on them.
+    """
+    resources_found = pyqtSignal(object, list, str)  # Resource manager (None on failure), resources, error
+
+    def __init__(self, resource_manager=None):
+        super().__init__()
+        self.resource_manager = resource_manager
+        self.result = (None, [], '')
+        self.found = threading.Event()
+
+    def run(self):
+        try:
+            import pyvisa
+            if self.resource_manager is None:
+                self.resource_manager = pyvisa.ResourceManager()
+            self.result = (self.resource_manager, measurement_core.find_keithleys(self.resource_manager), '')
+        except Exception as error:  # Missing VISA library or back end
+            self.result = (self.resource_manager, [], str(error))
+        self.found.set()
+        self.resources_found.emit(*self.result)
+        import diode_fit  # noqa: F401
+        import sweep_store  # noqa: F401
+
+
 class IVWorker(QThread):
     data_acquired = pyqtSignal(list)
+    sweep_started = pyqtSignal()
+    points_acquired = pyqtSignal(object, object)  # Voltages and currents measured since the last emit
+
+    def __init__(self, keithley, settings):
+        super().__init__()
+        self.core = measurement_core.MeasurementCore(keithley)
+        self.settings = settings
+
+    def run(self):
+        self.core.run(self.settings,
+                      on_sweep_started=lambda direction: self.sweep_started.emit(),
+                      on_points=self.points_acquired.emit,
+                      on_sweep_finished=lambda voltages, currents, extras: self.data_acquired.emit(
+                          [voltages, currents, extras]))
+
+    def stop(self):
+        self.core.stop()
+
+
+class QueueWorker(QThread):
+    device_recorded = pyqtSignal(object)  # A device_queue.DeviceResult
 
-    def __init__(self, keithley, start_voltage, stop_voltage, step_voltage, direction):
+    def __init__(self, queue):
         super().__init__()
-        self.keithley = keithley
-        self.start_voltage = start_voltage
-        self.stop_voltage = stop_voltage
-        self.step_voltage = step_voltage
-        self.direction = direction
-        self._running = False
+        self.queue = queue
 
     def run(self):
-        self._running = True
-        # Forward measurement
-        if self.direction in ['Forward', 'Both']:
-            current_values = []
-            voltage_values = np.arange(self.start_voltage, self.stop_voltage, self.step_voltage)
-            for voltage in voltage_values:
-                print('Voltage', voltage)
-                if not self._running:
-                    break
-                self.keithley.write(f'smua.source.levelv = {voltage}')
-                time.sleep(0.5)  # Let the system stabilize; adjust the delay as necessary
-                current = float(self.keithley.query('print(smua.measure.i())'))
-                current_values.append(current)
-                print('current', current)
-                # self.keithley.write('smua.source.output = smua.OUTPUT_OFF')  # Turn off the output
-
-            time.sleep(0.5)  # Wait for the system to stabilize after turning off the output
-            self.data_acquired.emit([voltage_values[:len(current_values)], current_values])
-
-        # Reverse measurement
-        if self.direction in ['Reverse', 'Both']:
-            current_values = []
-            # Swap start and stop voltages
-            temp = self.start_voltage
-            self.start_voltage = self.stop_voltage
-            self.stop_voltage = temp
-            self.step_voltage = -self.step_voltage
-            voltage_values = np.arange(self.start_voltage, self.stop_voltage, self.step_voltage)
-            for voltage in voltage_values:
-                print('Reverse Voltage', voltage)
-                if not self._running:
-                    break
-                self.keithley.write(f'smua.source.levelv = {voltage}')
-                time.sleep(0.5)  # Let the system stabilize; adjust the delay as necessary
-                current = float(self.keithley.query('print(smua.measure.i())'))
-                current_values.append(current)
-                print('current', current)
-                # self.keithley.write('smua.source.output = smua.OUTPUT_OFF')  # Turn off the output
-
-            time.sleep(0.5)  # Wait for the system to stabilize after turning off the output
-            self.data_acquired.emit([voltage_values[:len(current_values)], current_values])
-
-        self.keithley.write('smua.source.output = smua.OUTPUT_OFF')  # Turn off the output
+        self.queue.run(self.device_recorded.emit)
+
+    def stop(self):
+        self.queue.stop()
+
+
+class MppWorker(QThread):
+    row_acquired = pyqtSignal(object)  # One averaged row (a dict of mpp_tracker.SERIES_COLUMNS)
+    block_acquired = pyqtSignal(object)  # A block of rows as a dict of arrays
+    data_acquired = pyqtSignal(list)  # The periodic IV sweeps, like IVWorker.data_acquired
+
+    def __init__(self, keithley, settings, sweep_settings):
+        super().__init__()
+        self.tracker = mpp_tracker.MppTracker(
+            keithley, settings, sweep_settings, on_update=self.row_acquired.emit,
+            on_block=self.block_acquired.emit,
+            on_sweep=lambda voltages, currents, extras: self.data_acquired.emit([voltages, currents, extras]))
+
+    def run(self):
+        self.tracker.run()
+
     def stop(self):
-        self._running = False
+        self.tracker.stop()
 
 
 def main():
     app = QApplication([])
+    loop = async_driver.qt_event_loop(app)
     keithleyApp = KeithleyApp()
+    keithleyApp.asyncLoop = loop
     keithleyApp.show()
-    app.exec_()
+    if loop is None:
+        app.exec_()
+    else:
+        closed = asyncio.Event()
+        app.aboutToQuit.connect(closed.set)
+        with loop:
+            loop.run_until_complete(closed.wait())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,107 @@
+# Adaptive voltage grids: a coarse sweep refined where the curve bends and around Isc, the MPP and Voc
+#
+# The step voltage of the sweep settings defines the finest grid. A refined sweep measures a coarse subset
+# of it first and then, in a few rounds, adds the grid points that best reduce the error of the curve:
+# every gap between measured points is scored by the error of a straight line across it (curvature times
+# the square of its width), weighted up where the gap holds 0 V, the MPP or Voc. The gaps with the highest
+# scores are split at their middle grid point until the point budget is used. The flat reverse-bias part
+# of a solar cell curve then gets a few points and the knee gets most of them.
+import numpy as np
+
+import iv_analysis
+
+COARSE_FRACTION = 0.35  # Share of the point budget spent on the evenly spaced first pass
+MIN_COARSE_POINTS = 7
+FEATURE_WEIGHT = 4.0  # Extra weight of gaps that hold 0 V (Isc), the MPP or Voc
+
+
+def coarse_indices(count, budget):
+    """Indices of the evenly spread first pass over a grid of count points, both ends included.
+
+    The pass takes at least MIN_COARSE_POINTS points, but never more than the budget.
+    """
+    points = min(count, budget, max(MIN_COARSE_POINTS, int(round(budget * COARSE_FRACTION))))
+    return np.unique(np.round(np.linspace(0, count - 1, points)).astype(int))
+
+
+def curvature(voltages, currents):
+    """Second derivative of the current at every point (second divided differences, ends copied inwards)."""
+    if len(voltages) < 3:
+        return np.zeros(len(voltages))
+    slopes = np.diff(currents) / np.diff(voltages)
+    second = 2 * np.diff(slopes) / (voltages[2:] - voltages[:-2])
+    return np.concatenate([second[:1], second, second[-1:]])
+
+
+def gap_scores(voltages, currents):
+    """Score of every gap between neighbouring points (voltages sorted ascending): the largest deviation of
+    the curve from a straight line across the gap, weighted up if the gap holds 0 V, the MPP or Voc."""
+    widths = np.diff(voltages)
+    bend = np.abs(curvature(voltages, currents))
+    scores = np.maximum(bend[:-1], bend[1:]) * widths ** 2 / 8
+    foms = iv_analysis.figures_of_merit(voltages, currents)
+    for feature in (0.0, foms['mpp_voltage'], foms['voc']):
+        if np.isfinite(feature):
+            holds = (voltages[:-1] <= feature) & (voltages[1:] >= feature)
+            scores = np.where(holds, scores * (1 + FEATURE_WEIGHT), scores)
+    return scores
+
+
+def refinement_indices(grid, measured, currents, count):
+    """Pick up to count unmeasured grid indices that split the highest scoring gaps.
+
+    grid is the ascending fine grid, measured the sorted indices measured so far and currents their currents.
+    """
+    splittable = np.diff(measured) >= 2
+    if count <= 0 or not np.any(splittable):
+        return np.array([], dtype=int)
+    scores = np.where(splittable, gap_scores(grid[measured], currents), -np.inf)
+    best = np.argsort(scores, kind='stable')[::-1][:min(count, np.count_nonzero(splittable))]
+    return np.sort((measured[best] + measured[best + 1]) // 2)
+
+
+def merge(parts, ascending=True):
+    """Merge the (voltages, currents, extras) of several passes into one curve sorted by voltage.
+
+    Point arrays in the extras are merged the same way; other extras are taken from the first pass.
+    """
+    voltages = np.concatenate([part[0] for part in parts])
+    currents = np.concatenate([part[1] for part in parts])
+    order = np.argsort(voltages if ascending else -voltages, kind='stable')
+    extras = dict(parts[0][2])
+    for name, value in parts[0][2].items():
+        if isinstance(value, np.ndarray) and all(isinstance(part[2].get(name), np.ndarray)
+                                                 and len(part[2][name]) == len(part[0]) for part in parts):
+            extras[name] = np.concatenate([part[2][name] for part in parts])[order]
+    return voltages[order], currents[order], extras
+
+
+def refined_sweep(measure, voltage_values, budget, is_running=lambda: True):
+    """Measure a sweep over at most budget points of voltage_values, concentrated where they matter.
+
+    measure(voltages, first_pass) measures the given voltages in the order given and returns (voltages,
+    currents, extras); it may return fewer points if it was stopped. The points are measured in the direction
+    of voltage_values in every pass. Returns the merged curve in that direction, with extras['passes'] the
+    number of passes.
+    """
+    voltage_values = np.asarray(voltage_values, dtype=float)
+    ascending = len(voltage_values) < 2 or voltage_values[-1] >= voltage_values[0]
+    grid = voltage_values if ascending else voltage_values[::-1]
+    measured = coarse_indices(len(grid), budget)
+    parts = []
+    pending = measured
+    while len(pending) and is_running():
+        part = measure(grid[pending] if ascending else grid[pending][::-1], not parts)
+        parts.append(part)
+        if len(part[1]) < len(pending):
+            break
+        voltages, currents, _ = merge(parts)
+        measured = np.searchsorted(grid, voltages)
+        remaining = budget - len(measured)
+        # Half of what is left per pass, so the later passes can use what the earlier ones found
+        pending = refinement_indices(grid, measured, currents, max(1, (remaining + 1) // 2) if remaining > 0 else 0)
+    if not parts:
+        return voltage_values[:0], np.array([]), {}
+    voltages, currents, extras = merge(parts, ascending)
+    extras['passes'] = len(parts)
+    return voltages, currents, extras
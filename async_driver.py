@@ -0,0 +1,167 @@
+# asyncio driver for the SourceMeter: awaitable instrument I/O with cancellation and timeouts
+#
+# VISA calls block, so every AsyncKeithley runs its instrument's commands, in order, on one I/O thread of its
+# own and coroutines await them without blocking the event loop. Many instruments and monitoring tasks can
+# then run side by side from a single thread. Cancelling a coroutine returns at once: a command already on
+# the bus completes in the I/O thread, and sweeps and streams send abort to the instrument on the way out.
+# qt_event_loop() runs asyncio on the Qt event loop when the optional qasync package is installed.
+import asyncio
+import concurrent.futures
+import functools
+import numpy as np
+
+import buffer_readback
+import measurement_core
+import stream_buffer
+import tsp_sweep
+
+DEFAULT_TIMEOUT = 10.0  # Seconds a single instrument operation may take
+
+
+def qt_event_loop(app):
+    """Run asyncio on the Qt event loop of app. Returns the loop, or None if qasync is not installed."""
+    try:
+        import qasync
+    except ImportError:
+        return None
+    loop = qasync.QEventLoop(app)
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+class AsyncKeithley:
+    """Awaitable operations on a session (KeithleySession, TracedSession or a bare resource).
+
+    Every operation is bounded by timeout seconds (asyncio.TimeoutError); pass timeout=None to a call to
+    use the driver's default.
+    """
+
+    def __init__(self, session, timeout=DEFAULT_TIMEOUT):
+        self.session = session
+        self.timeout = timeout
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix=f"visa-{getattr(session, 'name', '') or 'io'}")
+
+    async def _call(self, function, *args, timeout=None, **kwargs):
+        future = asyncio.get_running_loop().run_in_executor(self._executor,
+                                                            functools.partial(function, *args, **kwargs))
+        return await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+
+    async def _abort(self, command):
+        # Runs while the caller is being cancelled, so it must not be cancelled itself
+        await asyncio.shield(self._call(self.session.write, command))
+
+    async def write(self, command, timeout=None):
+        return await self._call(self.session.write, command, timeout=timeout)
+
+    async def query(self, command, timeout=None):
+        return await self._call(self.session.query, command, timeout=timeout)
+
+    async def run_program(self, commands, timeout=None):
+        return await self._call(tsp_sweep.send_program, self.session, commands, timeout=timeout)
+
+    async def apply(self, settings, reset=False, timeout=None):
+        return await self._call(measurement_core.apply_settings, self.session, settings, reset, timeout=timeout)
+
+    async def configure(self, channels, current_limit=105e-3, timeout=None):
+        return await self._call(measurement_core.configure_instrument, self.session, channels, current_limit,
+                                timeout=timeout)
+
+    async def buffer_count(self, smu, buffer='nvbuffer1', timeout=None):
+        return await self._call(buffer_readback.buffer_count, self.session, smu, buffer, timeout=timeout)
+
+    async def read_buffer(self, smu, start, end, fields=buffer_readback.BUFFER_FIELDS, buffer='nvbuffer1',
+                          timeout=None):
+        return await self._call(buffer_readback.read_buffer, self.session, smu, start, end, fields, buffer,
+                                timeout=timeout)
+
+    async def run_sweep(self, smu, voltages, nplc=1, source_delay=0.05, reference_smu=None, on_points=None,
+                        poll_interval=0.02, timeout=None):
+        """Run a list sweep like tsp_sweep.run_sweep and return (voltages, currents, extras).
+
+        If the sweep takes longer than timeout seconds (by default twice the expected time plus 5 s) it is
+        aborted and asyncio.TimeoutError is raised; if the task is cancelled the sweep is aborted as well.
+        """
+        voltages = np.asarray(voltages, dtype=float)
+        extras = {}
+        if len(voltages) == 0:
+            return voltages, np.array([]), extras
+        commands = tsp_sweep.build_sweep_commands(smu, voltages, nplc, source_delay)
+        if reference_smu is not None:
+            commands += tsp_sweep.build_reference_commands(reference_smu, smu, len(voltages), nplc, source_delay)
+            commands.append(f'{reference_smu}.trigger.initiate()')
+        commands.append(f'{smu}.trigger.initiate()')
+        abort = f'{smu}.abort()' if reference_smu is None else f'{smu}.abort() {reference_smu}.abort()'
+        if timeout is None:
+            timeout = 2 * tsp_sweep.estimate_sweep_time(len(voltages), nplc, source_delay) + 5
+        names = [f'{smu}.nvbuffer1.{field}' for field in buffer_readback.BUFFER_FIELDS]
+        loop = asyncio.get_running_loop()
+
+        await self.run_program(commands)
+        deadline = loop.time() + timeout
+        chunks = []
+        read = 0
+        try:
+            while read < len(voltages):
+                count = min(await self.buffer_count(smu), len(voltages))
+                if count > read:
+                    chunk = await self._call(buffer_readback.read_buffer_attributes, self.session, read + 1, count,
+                                             names)
+                    chunks.append(chunk)
+                    if on_points is not None:
+                        on_points(voltages[read:read + len(chunk)], chunk[:, 0])
+                    read += len(chunk)
+                    continue
+                if loop.time() > deadline:
+                    raise asyncio.TimeoutError(f'Sweep timed out after {timeout:.1f} s with {read} of '
+                                               f'{len(voltages)} points')
+                await asyncio.sleep(poll_interval)
+            if reference_smu is not None:
+                while await self.buffer_count(reference_smu) < read:
+                    if loop.time() > deadline:
+                        raise asyncio.TimeoutError('The reference channel did not finish')
+                    await asyncio.sleep(poll_interval)
+                await self.write(f'{reference_smu}.trigger.measure.stimulus = 0')
+                reference = await self.read_buffer(reference_smu, 1, read, ('readings',))
+                extras['reference_currents'] = reference['readings']
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            await self._abort(abort)
+            raise
+
+        values = np.vstack(chunks)
+        extras['source_values'] = values[:, 1]
+        extras['timestamps'] = values[:, 2]
+        return voltages, values[:, 0], extras
+
+    async def stream(self, smu, rate, on_samples, poll_interval=0.1):
+        """Measure the current of smu at rate samples per second and pass (timestamps, currents) chunks to
+        on_samples until the task is cancelled."""
+        buffer = stream_buffer.STREAM_BUFFER
+        await self.run_program(stream_buffer.build_stream_commands(smu, rate) + [f'{smu}.trigger.initiate()'])
+        loop = asyncio.get_running_loop()
+        last_timestamp = -np.inf
+        last_count = 0
+        last_poll = loop.time()
+        try:
+            while True:
+                await asyncio.sleep(poll_interval)
+                now = loop.time()
+                count = await self.buffer_count(smu, buffer)
+                if count == 0:
+                    continue
+                # Read a window wide enough for every sample since the last poll (see CurrentStreamWorker)
+                expected = max(count - last_count, int(rate * (now - last_poll) * 2) + 16)
+                chunk = await self.read_buffer(smu, max(1, count - expected + 1), count, ('readings', 'timestamps'),
+                                               buffer)
+                last_count = count
+                last_poll = now
+                new = chunk['timestamps'] > last_timestamp
+                if np.any(new):
+                    last_timestamp = chunk['timestamps'][new][-1]
+                    on_samples(chunk['timestamps'][new], chunk['readings'][new])
+        finally:
+            await self._abort(f'{smu}.abort()')
+
+    def close(self):
+        """Stop the I/O thread once the queued commands are done (the session itself stays open)."""
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,317 @@
+# Benchmarks of the acquisition, analysis and persistence hot paths, run against the simulated SourceMeter
+#
+#   python benchmarks.py --latency 0.002 --output bench.json
+#   python benchmarks.py --compare bench.json
+#
+# Every metric is a throughput (higher is better) or, for names ending in _ms, a latency (lower is better).
+# Results are written as JSON so the runs of different versions can be compared with --compare.
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+import command_trace
+import diode_fit
+import iv_analysis
+import keithley_session
+import measurement_core
+import simulated_keithley
+import sweep_store
+
+MIN_FRAMES = 50  # Frame intervals needed before bench_frame_latency reports percentiles
+
+
+def timed(function, repeats=3):
+    """Median wall time of function() in seconds."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def simulated_session(latency=0.0, realtime=False, seed=0):
+    return keithley_session.KeithleySession(
+        simulated_keithley.SimulatedKeithley(latency=latency, realtime=realtime, seed=seed), 'Simulated 2614B')
+
+
+def sample_curves(count, points, seed=0):
+    """Noisy simulated IV curves (load convention) on a shared voltage grid, returned as 2-D arrays."""
+    rng = np.random.default_rng(seed)
+    voltages = np.linspace(-0.2, 0.9, points)
+    device = simulated_keithley.SimulatedDevice()
+    currents = np.array([device.steady_current(voltages, irradiance) for irradiance in rng.uniform(0.8, 1.2, count)])
+    currents += rng.normal(0, 1e-7, currents.shape)
+    return np.broadcast_to(voltages, currents.shape).copy(), currents
+
+
+def bench_sweeps(latency, points, modes):
+    """Points per second of IVWorker sweeps in each sweep mode, and how their time splits into bus, sleep
+    and host time."""
+    from IV_keithley import IVWorker
+    results = {}
+    for mode in modes:
+        session = command_trace.TracedSession(simulated_session(latency))
+        measurement_core.configure_instrument(session, ['a'])
+        session.trace.clear()
+        # The stepped mode waits 0.5 s at every point, so it only gets a short sweep
+        count = min(points, 5) if mode == 'Stepped' else points
+        settings = measurement_core.SweepSettings(-0.2, 0.9, 1.1 / count, 'Forward', mode, nplc=0.01,
+                                                  source_delay=0.0)
+        worker = IVWorker(session, settings)
+        measured = []
+        worker.data_acquired.connect(lambda data: measured.append(len(data[0])))
+        elapsed = timed(worker.run, repeats=1)
+        results[f'sweep.{mode.lower()}.points_per_s'] = sum(measured) / elapsed
+        stats = session.trace.stats()
+        commands = sum(totals['count'] for kind, totals in stats['kinds'].items() if kind != 'sleep')
+        results[f'sweep.{mode.lower()}.commands_per_point'] = commands / max(sum(measured), 1)
+        bus = sum(totals['bus'] for totals in stats['phases'].values())
+        asleep = sum(totals['sleep'] for totals in stats['phases'].values())
+        results[f'sweep.{mode.lower()}.bus_fraction'] = bus / elapsed
+        results[f'sweep.{mode.lower()}.sleep_fraction'] = asleep / elapsed
+        results[f'sweep.{mode.lower()}.host_fraction'] = max(elapsed - bus - asleep, 0) / elapsed
+    return results
+
+
+def bench_analysis(curves, points):
+    """Curves per second of the update_iv_plot analysis: figures of merit and the diode fit."""
+    voltages, currents = sample_curves(curves, points)
+    results = {}
+    elapsed = timed(lambda: [iv_analysis.figures_of_merit(v, i) for v, i in zip(voltages, currents)])
+    results['analysis.foms.curves_per_s'] = curves / elapsed
+    elapsed = timed(lambda: iv_analysis.figures_of_merit(voltages, currents))
+    results['analysis.foms_batch.curves_per_s'] = curves / elapsed
+    fits = min(curves, 50)
+    fitter = diode_fit.DiodeFitter()
+    elapsed = timed(lambda: [fitter.fit(v, i) for v, i in zip(voltages[:fits], currents[:fits])], repeats=1)
+    results['analysis.diode_fit.curves_per_s'] = fits / elapsed
+    return results
+
+
+def bench_table(sweeps, points):
+    """Rows per second for filling the IV table and reading every cell of it as the view does."""
+    from PyQt5.QtCore import Qt
+    import iv_table_model
+    voltages, currents = sample_curves(sweeps, points)
+    foms = iv_analysis.figures_of_merit(voltages[0], currents[0])
+    model = iv_table_model.IVTableModel()
+
+    def fill():
+        for k in range(sweeps):
+            model.add_sweep(voltages[k], currents[k], foms, f'Sweep {k + 1}')
+            for row in range(model.rowCount()):
+                for column in range(model.columnCount()):
+                    model.data(model.index(row, column), Qt.DisplayRole)
+
+    return {'table.fill.rows_per_s': sweeps * points / timed(fill, repeats=1)}
+
+
+def bench_save(sweeps, points):
+    """Rows per second of the Save Data text export and of appending sweeps to the HDF5 store."""
+    voltages, currents = sample_curves(sweeps, points)
+    foms = iv_analysis.figures_of_merit(voltages[0], currents[0])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'IV.txt')
+        export = timed(lambda: [sweep_store.export_txt(path, v, i, foms) for v, i in zip(voltages, currents)])
+        store = sweep_store.SweepStore(os.path.join(directory, 'bench.h5'))
+        append = timed(lambda: [store.append(v, i, {'foms': foms}, timestamps=v) for v, i in zip(voltages, currents)],
+                       repeats=1)
+        read = timed(store.read_all)
+    rows = sweeps * points
+    return {'save.export_txt.rows_per_s': rows / export, 'save.store_append.rows_per_s': rows / append,
+            'save.store_read_all.rows_per_s': rows / read}
+
+
+def bench_queue(latency, points, devices=24):
+    """Devices per second of a substrate measured through the simulated switch matrix: one device after
+    another with the analysis and the store in between (as the Start button did), and as a DeviceQueue."""
+    import device_queue
+    from scheduler import SweepJob
+    routes = {f'px{k}': f'1A{k:02d}' for k in range(1, devices + 1)}
+    settings = measurement_core.SweepSettings(start_voltage=-0.2, stop_voltage=0.9, step_voltage=1.1 / (points - 1),
+                                              nplc=0.01, source_delay=0.0)
+    jobs = [SweepJob(device_id, settings) for device_id in routes]
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ('serial', 'pipelined'):
+            simulator = simulated_keithley.SimulatedKeithley(latency=latency, seed=0)
+            session = keithley_session.KeithleySession(simulator, 'Simulated 2614B')
+            matrix = simulated_keithley.SimulatedSwitchMatrix(simulator,
+                                                              simulated_keithley.simulated_substrate(routes.values()))
+            switch = device_queue.SwitchMatrix(keithley_session.KeithleySession(matrix), routes)
+            store = sweep_store.SweepStore(os.path.join(directory, f'{name}.h5'))
+            if name == 'serial':
+                core = measurement_core.MeasurementCore(session)
+
+                def measure():
+                    for job in jobs:
+                        switch.select(job.device_id)
+                        measurement_core.configure_instrument(session, ['a'])
+                        for voltages, currents, extras in core.run(job.settings):
+                            foms, diode = device_queue.analyse(voltages, currents)
+                            store.append(voltages, currents, {'device': job.device_id, 'foms': foms, 'diode': diode})
+            else:
+                queue = device_queue.DeviceQueue(session, switch, jobs, store, resume=False)
+                measure = queue.run
+            results[f'queue.{name}.devices_per_s'] = devices / timed(measure, repeats=1)
+        results['queue.instrument_share'] = queue.stats()['instrument_share']
+    return results
+
+
+def bench_frame_latency(latency, points, frame_interval=0.01):
+    """Event-loop stalls of the GUI while a live sweep streams into the plots.
+
+    A timer asks for a frame every frame_interval; how late each tick arrives is how long the GUI thread was
+    busy with plotting, table and analysis work. A sweep too short for MIN_FRAMES frames reports only the
+    frame count, as its percentiles would come from a handful of ticks.
+    """
+    from PyQt5.QtCore import QTimer
+    from PyQt5.QtWidgets import QApplication
+    import IV_keithley
+    app = QApplication.instance() or QApplication([])
+    window = IV_keithley.KeithleyApp()
+    window.simulator_options = {'latency': latency, 'realtime': True}
+    window.useTestDataCheckbox.setChecked(True)
+    window.FFactorCheckbox.setChecked(False)
+    window.startVoltageEdit.setText('-0.2')
+    window.stopVoltageEdit.setText('0.9')
+    window.stepVoltageEdit.setText(str(1.1 / points))
+    window.directionComboBox.setCurrentText('Both')
+    window.nplcEdit.setText('0.01')
+    window.sourceDelayEdit.setText('0.001')
+    window.show()
+
+    ticks = []
+    timer = QTimer()
+    timer.timeout.connect(lambda: ticks.append(time.perf_counter()))
+    timer.start(int(frame_interval * 1000))
+    window.start_iv_measurement()
+    window.worker.finished.connect(app.quit)
+    app.exec_()
+    timer.stop()
+    window.close()
+
+    lateness = np.maximum(np.diff(ticks) - frame_interval, 0) * 1000
+    if len(lateness) < MIN_FRAMES:
+        print(f'gui.frame_latency: insufficient samples ({len(lateness)} frames, {MIN_FRAMES} needed); '
+              f'use more --points', file=sys.stderr)
+        return {'gui.frames': len(ticks)}
+    return {'gui.frame_latency.p50_ms': float(np.percentile(lateness, 50)),
+            'gui.frame_latency.p95_ms': float(np.percentile(lateness, 95)),
+            'gui.frame_latency.max_ms': float(np.max(lateness)),
+            'gui.frames': len(ticks)}
+
+
+# Run in a fresh interpreter by bench_startup; prints the phase times in seconds as JSON
+STARTUP_SCRIPT = """
+import json, os, time
+launched = float(os.environ['BENCH_LAUNCHED'])
+start = time.perf_counter()
+from PyQt5.QtWidgets import QApplication
+import IV_keithley
+imported = time.perf_counter()
+app = QApplication([])
+window = IV_keithley.KeithleyApp()
+window.show()
+app.processEvents()
+shown = time.perf_counter()
+total = time.time() - launched
+while window.discovery is None or not window.discovery.found.is_set():
+    app.processEvents()
+discovered = time.perf_counter()
+window.close()
+print(json.dumps({'total': total, 'import': imported - start, 'window': shown - imported, 'discovery': discovered - shown}))
+"""
+
+
+def bench_startup(repeats=3):
+    """Application start-up: process start to shown window, split into imports and window construction, and
+    the background VISA discovery that follows. Every run is a fresh interpreter, so nothing is cached."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(repeats):
+        # total runs from the launch of the process to the shown window, interpreter start-up included
+        env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get('QT_QPA_PLATFORM', 'offscreen'),
+                   BENCH_LAUNCHED=repr(time.time()))
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], capture_output=True, text=True,
+                                cwd=directory, env=env, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {f'startup.{name}_ms': float(np.median([run[name] for run in runs])) * 1000
+            for name in ('total', 'import', 'window', 'discovery')}
+
+
+def run_benchmarks(latency=0.0, points=200, curves=500, modes=('Instrument', 'Adaptive'), gui=True):
+    results = {}
+    results.update(bench_sweeps(latency, points, modes))
+    results.update(bench_analysis(curves, points))
+    results.update(bench_save(min(curves, 100), points))
+    results.update(bench_queue(latency, points))
+    if gui:
+        results.update(bench_table(min(curves, 100), points))
+        results.update(bench_frame_latency(latency, points))
+        results.update(bench_startup())
+    return results
+
+
+def describe_run(args):
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        revision = ''
+    return {'revision': revision, 'time': time.time(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'machine': platform.machine(), 'latency': args.latency,
+            'points': args.points, 'curves': args.curves}
+
+
+def compare(results, baseline):
+    """Print every metric with its change relative to a baseline run; slower metrics are flagged."""
+    for name, value in results.items():
+        if name not in baseline or not baseline[name]:
+            print(f'{name:40s} {value:14.6g}')
+            continue
+        change = value / baseline[name] - 1
+        worse = change > 0.1 if name.endswith('_ms') else change < -0.1
+        print(f"{name:40s} {value:14.6g} {change:+8.1%}{'  SLOWER' if worse else ''}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the IV program against the simulated SourceMeter.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Simulated bus latency per command (s)')
+    parser.add_argument('--points', type=int, default=200, help='Points per sweep')
+    parser.add_argument('--curves', type=int, default=500, help='Curves used by the analysis benchmarks')
+    parser.add_argument('--modes', nargs='+', default=['Instrument', 'Adaptive'],
+                        choices=measurement_core.SWEEP_MODES, help='Sweep modes to benchmark')
+    parser.add_argument('--no-gui', action='store_true', help='Skip the table and frame latency benchmarks')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    if not args.no_gui:
+        from PyQt5.QtWidgets import QApplication
+        app = QApplication.instance() or QApplication([])  # noqa: F841 (kept alive for the GUI benchmarks)
+
+    results = run_benchmarks(args.latency, args.points, args.curves, args.modes, not args.no_gui)
+    report = {'run': describe_run(args), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+    elif not args.output:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+# Bulk readback of SourceMeter reading buffers into NumPy arrays
+import numpy as np
+
+# Buffer attributes that can be read back, in the order they are requested from printbuffer
+BUFFER_FIELDS = ('readings', 'sourcevalues', 'timestamps')
+
+
+def supports_binary(keithley):
+    """Check whether the instrument handle can transfer binary blocks (real pyvisa resources can)."""
+    return getattr(keithley, 'binary_supported', hasattr(keithley, 'query_binary_values'))
+
+
+def printbuffer_command(start, end, names):
+    """Build a printbuffer call for the given entries (1-based, inclusive) of one or more buffer attributes."""
+    return f'printbuffer({start}, {end}, {", ".join(names)})'
+
+
+def read_buffer_attributes(keithley, start, end, names, binary=None, real32=False):
+    """Read entries start..end of several buffer attributes (e.g. 'smua.nvbuffer1.readings') in one transfer.
+
+    Returns a 2-D array with one column per attribute. With binary=True the instrument sends REAL32/REAL64
+    values that pyvisa unpacks straight into an array; the data format is switched back to ASCII in the same
+    command so later print() queries are unaffected.
+    """
+    if end < start:
+        return np.zeros((0, len(names)))
+    if binary is None:
+        binary = supports_binary(keithley)
+    command = printbuffer_command(start, end, names)
+
+    if binary:
+        data_format = 'format.REAL32' if real32 else 'format.REAL64'
+        values = keithley.query_binary_values(
+            f'format.data = {data_format} format.byteorder = format.LITTLEENDIAN {command} '
+            f'format.data = format.ASCII',
+            datatype='f' if real32 else 'd', is_big_endian=False, container=np.array)
+        values = np.asarray(values, dtype=float)
+    else:
+        response = keithley.query(command)
+        values = np.array(response.split(','), dtype=float)
+
+    # printbuffer interleaves the buffers entry by entry
+    return values[:len(values) - len(values) % len(names)].reshape(-1, len(names))
+
+
+def read_buffer(keithley, smu, start, end, fields=BUFFER_FIELDS, buffer='nvbuffer1', binary=None, real32=False):
+    """Read entries start..end (1-based, inclusive) of a reading buffer in one transfer.
+
+    Returns a dict with one NumPy array per requested field.
+    """
+    fields = tuple(fields)
+    names = [f'{smu}.{buffer}.{field}' for field in fields]
+    values = read_buffer_attributes(keithley, start, end, names, binary, real32)
+    return {field: values[:, i] for i, field in enumerate(fields)}
+
+
+def buffer_count(keithley, smu, buffer='nvbuffer1'):
+    """Return how many readings are stored in a buffer."""
+    return int(float(keithley.query(f'print({smu}.{buffer}.n)')))
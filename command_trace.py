@@ -0,0 +1,243 @@
+# Instrumentation of the instrument traffic: every command, its size and round-trip time, and host sleeps
+#
+# A TracedSession wraps a KeithleySession (or a bare resource) and records into a CommandTrace. Code marks
+# what it is doing with phase(keithley, name) and waits with sleep(keithley, seconds); on an untraced
+# session these are a no-op context and time.sleep. Phases nest, and time is charged to the innermost one,
+# so the per-phase totals split the wall time into bus time, sleeps and host time without double counting.
+import collections
+import contextlib
+import csv
+import json
+import threading
+import time
+import numpy as np
+
+# Latency histogram bin edges in seconds, logarithmic from 10 us to 10 s
+HISTOGRAM_EDGES = np.logspace(-5, 1, 25)
+MAX_EVENTS = 200000
+OTHER_PHASE = 'other'  # Commands sent outside any marked phase
+
+
+def phase(keithley, name):
+    """Context manager marking a phase of work on the instrument (no-op if it is not traced)."""
+    method = getattr(keithley, 'phase', None)
+    return method(name) if method is not None else contextlib.nullcontext()
+
+
+def sleep(keithley, seconds, interrupt=None):
+    """time.sleep that is recorded when the instrument is traced and ends early once the optional
+    threading.Event interrupt is set."""
+    method = getattr(keithley, 'sleep', None)
+    if method is not None:
+        method(seconds, interrupt)
+    elif interrupt is not None:
+        interrupt.wait(seconds)
+    else:
+        time.sleep(seconds)
+
+
+class TraceEvent:
+    __slots__ = ('start', 'duration', 'kind', 'command', 'bytes_out', 'bytes_in', 'phase', 'thread')
+
+    def __init__(self, start, duration, kind, command, bytes_out, bytes_in, phase, thread):
+        self.start = start
+        self.duration = duration
+        self.kind = kind  # 'write', 'query', 'binary', 'program' or 'sleep'
+        self.command = command
+        self.bytes_out = bytes_out
+        self.bytes_in = bytes_in
+        self.phase = phase
+        self.thread = thread
+
+
+class CommandTrace:
+    """Thread-safe record of instrument commands with running aggregates.
+
+    The newest MAX_EVENTS events are kept for export; the aggregates cover everything since the last clear().
+    """
+
+    def __init__(self, max_events=MAX_EVENTS):
+        self.events = collections.deque(maxlen=max_events)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.t0 = time.perf_counter()
+            self.events.clear()
+            self.histogram = np.zeros(len(HISTOGRAM_EDGES) + 1, dtype=int)
+            self.kinds = collections.defaultdict(lambda: {'count': 0, 'time': 0.0, 'bytes_out': 0, 'bytes_in': 0})
+            # Per phase: exclusive wall time, time on the bus, time asleep
+            self.phases = collections.defaultdict(lambda: {'wall': 0.0, 'bus': 0.0, 'sleep': 0.0, 'commands': 0})
+
+    # Phases
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+            self._local.switched = time.perf_counter()
+        return self._local.stack
+
+    def current_phase(self):
+        stack = self._stack()
+        return stack[-1] if stack else OTHER_PHASE
+
+    def _charge(self, now):
+        """Charge the time since the last phase change to the current phase of this thread."""
+        stack = self._stack()
+        if stack:
+            with self._lock:
+                self.phases[stack[-1]]['wall'] += now - self._local.switched
+        self._local.switched = now
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        stack = self._stack()
+        self._charge(time.perf_counter())
+        stack.append(name)
+        try:
+            yield
+        finally:
+            self._charge(time.perf_counter())
+            stack.pop()
+
+    # Recording
+
+    def record(self, kind, command, start, duration, bytes_out=0, bytes_in=0):
+        name = self.current_phase()
+        event = TraceEvent(start - self.t0, duration, kind, command, bytes_out, bytes_in, name,
+                           threading.current_thread().name)
+        with self._lock:
+            self.events.append(event)
+            totals = self.kinds[kind]
+            totals['count'] += 1
+            totals['time'] += duration
+            totals['bytes_out'] += bytes_out
+            totals['bytes_in'] += bytes_in
+            phase_totals = self.phases[name]
+            if kind == 'sleep':
+                phase_totals['sleep'] += duration
+            else:
+                phase_totals['bus'] += duration
+                phase_totals['commands'] += 1
+                self.histogram[np.searchsorted(HISTOGRAM_EDGES, duration)] += 1
+
+    # Reporting
+
+    def stats(self):
+        """Aggregates as plain data: per kind, per phase (with host time) and the latency histogram."""
+        with self._lock:
+            phases = {}
+            for name, totals in self.phases.items():
+                host = max(totals['wall'] - totals['bus'] - totals['sleep'], 0.0)
+                phases[name] = dict(totals, host=host)
+            return {'kinds': {kind: dict(totals) for kind, totals in self.kinds.items()},
+                    'phases': phases,
+                    'histogram': {'edges': HISTOGRAM_EDGES.tolist(), 'counts': self.histogram.tolist()}}
+
+    def latency_percentiles(self, percentiles=(50, 95, 99)):
+        with self._lock:
+            durations = [event.duration for event in self.events if event.kind != 'sleep']
+        if not durations:
+            return {p: float('nan') for p in percentiles}
+        return dict(zip(percentiles, np.percentile(durations, percentiles).tolist()))
+
+    def summary(self):
+        """Short text report of the per-phase totals for display."""
+        stats = self.stats()
+        lines = [f"{'Phase':<10}{'Wall s':>9}{'Bus s':>9}{'Sleep s':>9}{'Host s':>9}{'Cmds':>7}"]
+        for name, totals in sorted(stats['phases'].items(), key=lambda item: -item[1]['wall']):
+            lines.append(f"{name:<10}{totals['wall']:9.3f}{totals['bus']:9.3f}{totals['sleep']:9.3f}"
+                         f"{totals['host']:9.3f}{totals['commands']:7d}")
+        p50, p95, p99 = self.latency_percentiles().values()
+        lines.append(f'Round trip p50 {p50 * 1e3:.2f} ms, p95 {p95 * 1e3:.2f} ms, p99 {p99 * 1e3:.2f} ms')
+        return '\n'.join(lines)
+
+    def export(self, path):
+        """Write the events to a file: Chrome trace JSON (chrome://tracing, Perfetto) for .json, else CSV."""
+        with self._lock:
+            events = list(self.events)
+        if path.endswith('.json'):
+            trace = {'traceEvents': [{'name': event.command[:80], 'cat': f'{event.phase},{event.kind}', 'ph': 'X',
+                                      'ts': event.start * 1e6, 'dur': event.duration * 1e6, 'pid': 0,
+                                      'tid': event.thread,
+                                      'args': {'command': event.command, 'bytes_out': event.bytes_out,
+                                               'bytes_in': event.bytes_in}} for event in events],
+                     'otherData': {'stats': self.stats()}}
+            with open(path, 'w') as f:
+                json.dump(trace, f)
+        else:
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(TraceEvent.__slots__)
+                for event in events:
+                    writer.writerow([getattr(event, field) for field in TraceEvent.__slots__])
+
+
+class TracedSession:
+    """Drop-in wrapper of a session that records every command into a CommandTrace.
+
+    Attributes it does not define (lock, name, binary_supported, resource, ...) are those of the session.
+    """
+
+    def __init__(self, session, trace=None):
+        self.session = session
+        self.trace = trace if trace is not None else CommandTrace()
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def write(self, command):
+        start = time.perf_counter()
+        result = self.session.write(command)
+        self.trace.record('write', command, start, time.perf_counter() - start, len(command.encode()))
+        return result
+
+    def query(self, command):
+        start = time.perf_counter()
+        response = self.session.query(command)
+        self.trace.record('query', command, start, time.perf_counter() - start, len(command.encode()),
+                          len(response.encode()))
+        return response
+
+    def query_binary_values(self, command, **kwargs):
+        start = time.perf_counter()
+        values = self.session.query_binary_values(command, **kwargs)
+        size = np.dtype(kwargs.get('datatype', 'f')).itemsize * len(values)
+        self.trace.record('binary', command, start, time.perf_counter() - start, len(command.encode()), size)
+        return values
+
+    def run_program(self, commands):
+        start = time.perf_counter()
+        if hasattr(self.session, 'run_program'):
+            self.session.run_program(commands)
+        else:
+            for command in commands:
+                self.session.write(command)
+        self.trace.record('program', f'{len(commands)} lines: {commands[0][:60]}' if commands else '0 lines',
+                          start, time.perf_counter() - start, sum(len(command.encode()) for command in commands))
+
+    def apply(self, settings, reset=False):
+        start = time.perf_counter()
+        if hasattr(self.session, 'apply'):
+            commands = self.session.apply(settings, reset)
+        else:
+            # A bare resource has no shadow state, so everything is sent
+            commands = (['reset()'] if reset else []) + [f'{name} = {value}' for name, value in settings.items()]
+            self.session.write(' '.join(commands))
+        if commands:
+            line = ' '.join(commands)
+            self.trace.record('write', line, start, time.perf_counter() - start, len(line.encode()))
+        return commands
+
+    def sleep(self, seconds, interrupt=None):
+        start = time.perf_counter()
+        if interrupt is not None:
+            interrupt.wait(seconds)
+        else:
+            time.sleep(seconds)
+        self.trace.record('sleep', f'sleep {seconds:g}', start, time.perf_counter() - start)
+
+    def phase(self, name):
+        return self.trace.phase(name)
@@ -0,0 +1,60 @@
+# Buffered current streaming from one SMU channel, used for the F factor (lamp stability) measurement
+import time
+import numpy as np
+from PyQt5.QtCore import QThread, pyqtSignal
+
+import buffer_readback
+import command_trace
+import stream_buffer
+
+
+class CurrentStreamWorker(QThread):
+    """Keep an SMU measuring into its reading buffer and drain it in chunks.
+
+    Each chunk of new samples is emitted as (timestamps, currents) arrays; widgets are only touched by the
+    slots connected to the signal, which run in the GUI thread.
+    """
+    samples_acquired = pyqtSignal(object, object)
+
+    def __init__(self, keithley, channel='b', rate=50, poll_interval=0.1):
+        super().__init__()
+        self.keithley = keithley
+        self.smu = f'smu{channel}'
+        self.rate = rate
+        self.poll_interval = poll_interval
+        self._running = False
+
+    def run(self):
+        self._running = True
+        with command_trace.phase(self.keithley, 'stream'):
+            for command in stream_buffer.build_stream_commands(self.smu, self.rate):
+                self.keithley.write(command)
+            self.keithley.write(f'{self.smu}.trigger.initiate()')
+
+            last_count = 0
+            last_timestamp = -np.inf
+            last_poll = time.monotonic()
+            while self._running:
+                command_trace.sleep(self.keithley, self.poll_interval)
+                now = time.monotonic()
+                count = buffer_readback.buffer_count(self.keithley, self.smu, stream_buffer.STREAM_BUFFER)
+                if count == 0:
+                    continue
+                # Once the instrument buffer is full it drops the oldest readings, so the new ones are found
+                # by reading a window at the end of the buffer and keeping the unseen timestamps
+                expected = max(count - last_count, int(self.rate * (now - last_poll) * 2) + 16)
+                start = max(1, count - expected + 1)
+                chunk = buffer_readback.read_buffer(self.keithley, self.smu, start, count,
+                                                    fields=('readings', 'timestamps'),
+                                                    buffer=stream_buffer.STREAM_BUFFER)
+                last_count = count
+                last_poll = now
+                new = chunk['timestamps'] > last_timestamp
+                if np.any(new):
+                    last_timestamp = chunk['timestamps'][new][-1]
+                    self.samples_acquired.emit(chunk['timestamps'][new], chunk['readings'][new])
+
+            self.keithley.write(f'{self.smu}.abort()')
+
+    def stop(self):
+        self._running = False
@@ -0,0 +1,191 @@
+# Dark/light pairing: cached dark curves and the analysis of light curves against them
+#
+# A device's dark curve only depends on the device and the sweep setup, so it is measured once and kept in a
+# DarkCurveCache keyed by (device id, setup). Light sweeps of the same device and setup are then analysed
+# against the cached curve instead of measuring it again. By superposition a light curve is the dark curve
+# shifted by the photocurrent, so light - dark is flat over the working range; how far it deviates from
+# flat up to the maximum power point is reported along with the photocurrent and the dark shunt resistance.
+import collections
+import threading
+import time
+import numpy as np
+
+import iv_analysis
+
+DEFAULT_CAPACITY = 64
+SUPERPOSITION_TOLERANCE = 0.05  # Largest relative deviation of light - dark from the photocurrent that passes
+SHUNT_WINDOW = 0.05  # Volts around 0 V used for the dark shunt resistance
+MIN_SHUNT_POINTS = 3  # Points nearest 0 V fitted when the window holds fewer (coarse voltage steps)
+DARK_CURRENT_LIMIT = 5e-7  # Largest current at 0 V (A) of a curve taken as dark when no shutter darkened it
+
+
+def setup_key(settings):
+    """The part of the SweepSettings a dark curve depends on, as a hashable (and JSON-friendly) tuple."""
+    return (settings.channel, round(settings.start_voltage, 9), round(settings.stop_voltage, 9),
+            round(settings.step_voltage, 9), settings.sweep_mode, round(settings.nplc, 9),
+            round(settings.source_delay, 9))
+
+
+def is_dark(voltages, currents, limit=DARK_CURRENT_LIMIT):
+    """Whether no photocurrent flows: the current at 0 V is within limit (False if 0 V was not measured)."""
+    current = iv_analysis.short_circuit_current(voltages, currents)[0]
+    return bool(np.isfinite(current) and abs(current) <= limit)
+
+
+def shunt_resistance(voltages, currents, window=SHUNT_WINDOW):
+    """Resistance from a straight-line fit of the curve within +-window volts of 0 V.
+
+    When the voltage steps are too coarse for the window to hold MIN_SHUNT_POINTS points, the points nearest
+    0 V are fitted instead. NaN if the curve has fewer than 2 points.
+    """
+    voltages = np.asarray(voltages, dtype=float)
+    currents = np.asarray(currents, dtype=float)
+    near = np.abs(voltages) <= window
+    if np.count_nonzero(near) < MIN_SHUNT_POINTS:
+        near = np.zeros(len(voltages), dtype=bool)
+        near[np.argsort(np.abs(voltages), kind='stable')[:MIN_SHUNT_POINTS]] = True
+    if np.count_nonzero(near) < 2:
+        return float('nan')
+    v = voltages[near] - voltages[near].mean()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.sum(v * currents[near]) / np.sum(v * v)
+        return float(np.abs(1 / slope))
+
+
+class DarkCurve:
+    """A measured dark curve, sorted by voltage, with the quantities every pairing reuses."""
+
+    def __init__(self, voltages, currents, measured_at=None, sweep_id=None):
+        v, i = iv_analysis.sort_curves(voltages, currents)
+        self.voltages = v[0]
+        self.currents = i[0]
+        self.measured_at = time.time() if measured_at is None else measured_at
+        self.sweep_id = sweep_id  # Position in the SweepStore, if it was recorded
+        self.rsh = shunt_resistance(self.voltages, self.currents)
+
+
+class DarkCurveCache:
+    """Thread-safe LRU cache of dark curves keyed by device id and setup.
+
+    Curves older than max_age seconds (None: no limit) are treated as missing, so a stale dark curve is
+    measured again.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, max_age=None):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._curves = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._curves)
+
+    def _valid(self, curve, now):
+        return self.max_age is None or now - curve.measured_at <= self.max_age
+
+    def get(self, device_id, settings, now=None):
+        """Return the DarkCurve of the device for this setup, or None if there is no valid one."""
+        key = (device_id, setup_key(settings))
+        now = time.time() if now is None else now
+        with self._lock:
+            curve = self._curves.get(key)
+            if curve is not None and not self._valid(curve, now):
+                del self._curves[key]
+                curve = None
+            if curve is None:
+                self.misses += 1
+                return None
+            self._curves.move_to_end(key)
+            self.hits += 1
+            return curve
+
+    def contains(self, device_id, settings, now=None):
+        """Whether a valid curve is cached, without counting a hit or changing the LRU order."""
+        now = time.time() if now is None else now
+        with self._lock:
+            curve = self._curves.get((device_id, setup_key(settings)))
+            return curve is not None and self._valid(curve, now)
+
+    def put(self, device_id, settings, curve):
+        return self.put_key((device_id, setup_key(settings)), curve)
+
+    def put_key(self, key, curve):
+        with self._lock:
+            self._curves[key] = curve
+            self._curves.move_to_end(key)
+            while len(self._curves) > self.capacity:
+                self._curves.popitem(last=False)
+        return curve
+
+    def invalidate(self, device_id=None):
+        """Forget the dark curves of one device (all devices by default)."""
+        with self._lock:
+            for key in [key for key in self._curves if device_id is None or key[0] == device_id]:
+                del self._curves[key]
+
+    def load_store(self, store):
+        """Fill the cache with the newest valid dark curve of every (device, setup) recorded in a SweepStore.
+
+        Only sweeps whose metadata has illumination 'dark', a device and a setup are used. Returns the number
+        of curves loaded.
+        """
+        if len(store) == 0:
+            return 0
+        now = time.time()
+        newest = {}
+        for sweep_id, metadata in enumerate(store.metadata()):
+            if metadata.get('illumination') == 'dark' and metadata.get('device') and metadata.get('setup'):
+                newest[(metadata['device'], tuple(metadata['setup']))] = (sweep_id, metadata['time'])
+        # Oldest first, so the most recent curves end up as the most recently used
+        loaded = 0
+        for key, (sweep_id, measured_at) in sorted(newest.items(), key=lambda item: item[1][1])[-self.capacity:]:
+            if self.max_age is not None and now - measured_at > self.max_age:
+                continue
+            points = store.read(sweep_id, ('voltage', 'current'))
+            self.put_key(key, DarkCurve(points['voltage'], points['current'], measured_at, sweep_id))
+            loaded += 1
+        return loaded
+
+
+def pair_metrics(dark, voltages, currents, tolerance=SUPERPOSITION_TOLERANCE):
+    """Analyse one light curve or a batch of them (rows of 2-D arrays) against a DarkCurve.
+
+    Returns photocurrent (light - dark on the light curve's voltages, sorted by voltage), photo_isc (the
+    photocurrent at 0 V), superposition_deviation (largest |photocurrent - photo_isc| / |photo_isc| between
+    0 V and the light MPP voltage), superposition_ok, dark_rsh and dark_voc_current (the dark current at the light
+    Voc, which by superposition matches the photocurrent). Scalars are floats for a single curve.
+    """
+    single = np.ndim(currents) == 1
+    v, i = iv_analysis.sort_curves(voltages, currents)
+    if v.shape[1] == len(dark.voltages) and np.allclose(v, dark.voltages[None, :], rtol=0, atol=1e-9):
+        # Same grid as the dark curve (the usual case for one setup): a plain difference
+        photocurrent = i - dark.currents[None, :]
+    else:
+        photocurrent = i - np.array([np.interp(row, dark.voltages, dark.currents) for row in v])
+    photo_isc = iv_analysis.short_circuit_current(v, photocurrent)
+    voc = iv_analysis.open_circuit_voltage(v, i)
+    # Above the MPP the series resistance bends even an ideal cell's light curve away from the shifted dark
+    # curve (by about a third at Voc for 30 Ohm), so only 0 V to the MPP is checked
+    _, mpp_voltage, _ = iv_analysis.maximum_power_point(v, i)
+    working = (v >= 0) & (v <= mpp_voltage[:, None])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        deviation = np.abs(photocurrent - photo_isc[:, None]) / np.abs(photo_isc)[:, None]
+    deviation = np.where(working.any(axis=1), np.max(np.where(working, deviation, 0), axis=1), np.nan)
+    dark_voc_current = np.interp(voc, dark.voltages, dark.currents)
+    dark_voc_current = np.where(np.isfinite(voc), dark_voc_current, np.nan)
+    results = {'photocurrent': photocurrent, 'photo_isc': photo_isc, 'superposition_deviation': deviation,
+               'superposition_ok': deviation <= tolerance, 'dark_rsh': np.full(len(v), dark.rsh),
+               'dark_voc_current': dark_voc_current}
+    if single:
+        return {name: value[0] if name == 'photocurrent' else value[0].item() for name, value in results.items()}
+    return results
+
+
+def summary(metrics, dark):
+    """The scalar pairing results of one curve as plain values for metadata, logs and displays."""
+    return {'photo_isc': metrics['photo_isc'], 'superposition_deviation': metrics['superposition_deviation'],
+            'superposition_ok': metrics['superposition_ok'], 'dark_rsh': metrics['dark_rsh'],
+            'dark_voc_current': metrics['dark_voc_current'], 'dark_sweep_id': dark.sweep_id,
+            'dark_age': time.time() - dark.measured_at}
@@ -0,0 +1,251 @@
+# Device queues: the pixels of a substrate measured one after another through a switch matrix
+#
+# A DeviceQueue measures its devices in a pipeline, so the SourceMeter does not wait for the host between
+# devices. The measuring thread switches the matrix to a device, sweeps it and moves straight on to the next
+# one. Finished sweeps are analysed (figures of merit and the diode fit) on a process pool, and a writer
+# thread records the analysed devices to the SweepStore in the order they were measured. Every recorded
+# sweep is tagged with its device and the queue name, and the last sweep of a device marks it complete, so
+# an interrupted queue resumes with the devices it had not finished.
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import command_trace
+import dark_light
+import diode_fit
+import iv_analysis
+import measurement_core
+
+PIPELINE_DEPTH = 4  # Most devices measured ahead of the writer; bounds the memory of a long queue
+
+
+def parse_devices(text):
+    """Device ids and their routes from text such as 'px1=1A01, px2=1A02, px3'.
+
+    Returns a dict in the order given; a device without '=route' is routed by its id.
+    """
+    routes = {}
+    for entry in text.replace(';', ',').split(','):
+        device_id, _, route = entry.partition('=')
+        if device_id.strip():
+            routes[device_id.strip()] = route.strip() or device_id.strip()
+    return routes
+
+
+class SwitchMatrix:
+    """Connect devices to the SourceMeter through a switch matrix that runs TSP (such as a 707B or 3706A).
+
+    routes maps device ids to the channel list closed for each device; a device without a route is routed
+    by its id. select() closes a device's channels exclusively (opening every other one) and returns once
+    the relays have settled.
+    """
+
+    def __init__(self, session, routes=None, settle_time=0.0):
+        self.session = session
+        self.routes = dict(routes or {})
+        self.settle_time = settle_time
+
+    def route(self, device_id):
+        return self.routes.get(device_id, device_id)
+
+    def select(self, device_id):
+        with command_trace.phase(self.session, 'switch'):
+            # The query returns once the relays have moved
+            self.session.query(f'channel.exclusiveclose("{self.route(device_id)}") waitcomplete() print(1)')
+            if self.settle_time:
+                command_trace.sleep(self.session, self.settle_time)
+
+    def open_all(self):
+        self.session.write('channel.open("allslots")')
+
+
+def analyse(voltages, currents, irradiance=1000.0, area=1.0, fit=True):
+    """Figures of merit and, with fit, the single-diode parameters (None if the fit fails) of one sweep.
+
+    Runs in the analysis processes, so it only takes and returns plain data.
+    """
+    foms = iv_analysis.figures_of_merit(voltages, currents, irradiance, area)
+    diode = None
+    if fit and len(voltages) >= len(diode_fit.PARAMETER_NAMES):
+        try:
+            diode = diode_fit.fit_diode(voltages, currents)
+        except (ValueError, np.linalg.LinAlgError):
+            pass
+    return foms, diode
+
+
+def completed_devices(store, name):
+    """Ids of the devices that the store holds a complete measurement of from the queue `name`."""
+    if store is None or len(store) == 0:
+        return set()
+    return {metadata['device'] for metadata in store.metadata()
+            if metadata.get('queue') == name and metadata.get('queue_complete')}
+
+
+class DeviceResult:
+    """A measured, analysed and recorded device.
+
+    sweeps holds (voltages, currents, extras, foms, diode) per sweep direction and sweep_ids their positions
+    in the store (empty without a store).
+    """
+
+    def __init__(self, job, route, sweeps, sweep_ids):
+        self.job = job
+        self.route = route
+        self.sweeps = sweeps
+        self.sweep_ids = sweep_ids
+
+
+class DeviceQueue:
+    """Measure a list of SweepJobs on one SourceMeter, switching the matrix to each device in turn.
+
+    switch is a SwitchMatrix (None measures whatever is connected). Each device is measured once with its
+    job's settings, irradiance and area; repeats and delay are not used. With resume the devices the store
+    already holds complete measurements of under this queue name are skipped, so a resumable queue needs a
+    name of its own, such as the substrate id: pixel ids repeat from one substrate to the next. processes
+    sets the size of the analysis pool (None: one per CPU but one, which is left to the measuring thread; 0
+    analyses on the writer thread). Errors of single devices are collected in errors and do not stop the queue.
+    """
+
+    def __init__(self, keithley, switch, jobs, store=None, name=None, processes=None, fit=True, resume=True,
+                 current_limit=105e-3):
+        if resume and store is not None and not name:
+            raise ValueError('A queue that resumes from the store needs a name, such as the substrate id')
+        self.keithley = keithley
+        self.switch = switch
+        self.jobs = list(jobs)
+        self.store = store
+        self.name = name
+        self.processes = processes
+        self.fit = fit
+        self.resume = resume
+        self.current_limit = current_limit
+        self.core = measurement_core.MeasurementCore(keithley)
+        self.errors = []
+        self.skipped = 0
+        self.recorded = 0
+        # Seconds spent switching and measuring (the instrument's share), waiting for analyses, writing, in total
+        self.timings = {'switch': 0.0, 'measure': 0.0, 'analysis_wait': 0.0, 'write': 0.0, 'wall': 0.0}
+        self._stopped = threading.Event()
+
+    def pending(self):
+        """The jobs still to measure."""
+        done = completed_devices(self.store, self.name) if self.resume else set()
+        return [job for job in self.jobs if job.device_id not in done]
+
+    def stop(self):
+        self._stopped.set()
+        self.core.stop()
+
+    def stats(self):
+        wall = self.timings['wall']
+        instrument = self.timings['switch'] + self.timings['measure']
+        return dict(self.timings, devices=self.recorded, skipped=self.skipped,
+                    seconds_per_device=wall / self.recorded if self.recorded else float('nan'),
+                    instrument_share=instrument / wall if wall else float('nan'))
+
+    def run(self, on_result=None):
+        """Measure every pending device and return their DeviceResults.
+
+        on_result(DeviceResult) is called from the writer thread as each device is recorded. When the queue is
+        stopped the devices already measured are still analysed and recorded; the one cut short is not.
+        """
+        jobs = self.pending()
+        self.skipped = len(self.jobs) - len(jobs)
+        self._stopped.clear()
+        if not jobs:
+            return []
+        start = time.perf_counter()
+        # Forking a process that runs threads (the GUI, the writer) is not safe, so the workers are spawned
+        processes = self.processes if self.processes is not None else (os.cpu_count() or 1) - 1
+        pool = (ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+                if processes > 0 else None)
+        finished = queue.Queue(PIPELINE_DEPTH)
+        results = []
+        writer = threading.Thread(target=self._write, args=(finished, results, on_result),
+                                  name=f"{self.name or 'queue'}-writer", daemon=True)
+        writer.start()
+        try:
+            for job in jobs:
+                if self._stopped.is_set():
+                    break
+                sweeps = self._measure(job)
+                if self._stopped.is_set():
+                    break  # Cut short; a resumed queue measures the device again
+                analyses = [pool.submit(analyse, voltages, currents, job.irradiance, job.area, self.fit)
+                            if pool is not None else None for voltages, currents, _ in sweeps]
+                finished.put((job, sweeps, analyses))
+        finally:
+            finished.put(None)
+            writer.join()
+            if pool is not None:
+                pool.shutdown()
+            if self.switch is not None:
+                self.switch.open_all()
+            self.timings['wall'] += time.perf_counter() - start
+        return results
+
+    def _measure(self, job):
+        # The sweep turned the output off, so the matrix switches without current flowing
+        if self.switch is not None:
+            started = time.perf_counter()
+            self.switch.select(job.device_id)
+            self.timings['switch'] += time.perf_counter() - started
+        started = time.perf_counter()
+        measurement_core.configure_instrument(self.keithley, [job.settings.channel], self.current_limit)
+        sweeps = self.core.run(job.settings)
+        self.timings['measure'] += time.perf_counter() - started
+        return sweeps
+
+    def _write(self, finished, results, on_result):
+        while True:
+            item = finished.get()
+            if item is None:
+                return
+            job, sweeps, analyses = item
+            try:
+                result = self._record(job, sweeps, analyses)
+            except Exception:
+                self.errors.append((job.device_id, traceback.format_exc()))
+                continue
+            results.append(result)
+            self.recorded += 1
+            if on_result is not None:
+                on_result(result)
+
+    def _record(self, job, sweeps, analyses):
+        started = time.perf_counter()
+        analysed = []
+        for (voltages, currents, extras), analysis in zip(sweeps, analyses):
+            if analysis is not None:
+                foms, diode = analysis.result()
+            else:
+                foms, diode = analyse(voltages, currents, job.irradiance, job.area, self.fit)
+            analysed.append((voltages, currents, extras, foms, diode))
+        self.timings['analysis_wait'] += time.perf_counter() - started
+
+        started = time.perf_counter()
+        route = self.switch.route(job.device_id) if self.switch is not None else None
+        sweep_ids = []
+        if self.store is not None:
+            dark = job.illumination == 'dark'
+            # A device with a sweep cut short by the timeout is measured again when the queue resumes
+            complete = not any(extras.get('timed_out') for _, _, extras, _, _ in analysed)
+            for number, (voltages, currents, extras, foms, diode) in enumerate(analysed):
+                metadata = {'device': job.device_id, 'queue': self.name, 'route': route,
+                            'direction': extras.get('direction'), 'channel': extras.get('channel'),
+                            'irradiance': 0.0 if dark else job.irradiance, 'area': job.area,
+                            'instrument': getattr(self.keithley, 'name', ''), 'foms': foms, 'diode': diode,
+                            'hysteresis_index': extras.get('hysteresis_index'), 'illumination': job.illumination,
+                            'setup': dark_light.setup_key(job.settings), **job.metadata,
+                            'timed_out': extras.get('timed_out', False),
+                            'queue_complete': complete and number == len(analysed) - 1}
+                sweep_ids.append(self.store.append(voltages, currents, metadata, extras.get('timestamps'),
+                                                   extras.get('settle_times'), extras.get('reference_currents')))
+        self.timings['write'] += time.perf_counter() - started
+        return DeviceResult(job, route, analysed, sweep_ids)
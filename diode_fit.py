@@ -0,0 +1,148 @@
+# Single-diode model fitting (Iph, I0, Rs, Rsh, n) for IV curves
+#
+# The model is written in the generator convention
+#     I = Iph - I0 * (exp((V + I*Rs) / (n*Vt)) - 1) - (V + I*Rs) / Rsh
+# and solved explicitly for I with the Lambert W function. Measured curves use the load convention of the
+# SourceMeter (current is negative while the cell generates), so the model current is negated before it is
+# compared with the data.
+from concurrent.futures import ProcessPoolExecutor
+import os
+import numpy as np
+from scipy import constants
+from scipy.optimize import least_squares
+from scipy.special import wrightomega
+
+import iv_analysis
+
+PARAMETER_NAMES = ('iph', 'i0', 'rs', 'rsh', 'n')
+
+
+def thermal_voltage(temperature=298.15):
+    return constants.k * temperature / constants.e
+
+
+def diode_current(voltages, iph, i0, rs, rsh, n, temperature=298.15):
+    """Generator-convention current of the single-diode model, solved explicitly with Lambert W."""
+    v = np.asarray(voltages, dtype=float)
+    a = n * thermal_voltage(temperature)
+    # W(x * exp(y)) is evaluated as wrightomega(log(x) + y) so large exponents do not overflow
+    log_argument = (np.log(rs * rsh * i0 / (a * (rs + rsh)))
+                    + rsh * (rs * iph + rs * i0 + v) / (a * (rs + rsh)))
+    w = np.real(wrightomega(log_argument))
+    return (rsh * (iph + i0) - v) / (rs + rsh) - a / rs * w
+
+
+def _unpack(x):
+    iph, log_i0, log_rs, log_rsh, n = x
+    return iph, np.exp(log_i0), np.exp(log_rs), np.exp(log_rsh), n
+
+
+def _residuals(x, voltages, currents, temperature):
+    return -diode_current(voltages, *_unpack(x), temperature=temperature) - currents
+
+
+def _jacobian(x, voltages, currents, temperature):
+    """Analytic Jacobian of the residuals from implicit differentiation of the diode equation."""
+    iph, i0, rs, rsh, n = _unpack(x)
+    a = n * thermal_voltage(temperature)
+    current = diode_current(voltages, iph, i0, rs, rsh, n, temperature)
+    vd = voltages + current * rs
+    diode = np.exp(np.minimum(np.log(i0) + vd / a, 700))  # I0 * exp(Vd / a)
+    # Partial derivatives of F(I, p) = Iph - I0 (exp(Vd/a) - 1) - Vd/Rsh - I
+    df_di = -diode * rs / a - rs / rsh - 1
+    df_dp = np.column_stack([
+        np.ones_like(vd),                            # Iph
+        -(diode - i0),                               # log I0
+        rs * (-diode * current / a - current / rsh),  # log Rs
+        vd / rsh,                                    # log Rsh
+        diode * vd / (a * n),                        # n
+    ])
+    # dI/dp = -dF/dp / dF/dI and the residual is -I - I_measured
+    return df_dp / df_di[:, None]
+
+
+def initial_guess(voltages, currents, temperature=298.15):
+    """Rough parameters from the shape of a measured (load convention) curve."""
+    voltages = np.asarray(voltages, dtype=float)
+    currents = np.asarray(currents, dtype=float)
+    foms = iv_analysis.figures_of_merit(voltages, currents)
+    iph = -foms['isc'] if np.isfinite(foms['isc']) else -currents[np.argmin(np.abs(voltages))]
+    voc = foms['voc'] if np.isfinite(foms['voc']) else np.max(voltages)
+    order = np.argsort(voltages)
+    v, i = voltages[order], currents[order]
+
+    # Shunt resistance from the slope below 0 V, series resistance from the slope at the high voltage end
+    reverse = v <= min(0.0, v[min(2, len(v) - 1)])
+    slope = np.polyfit(v[reverse], i[reverse], 1)[0] if np.sum(reverse) > 1 else 0
+    rsh = 1 / slope if slope > 0 else 1e4
+    slope = (i[-1] - i[-2]) / (v[-1] - v[-2]) if len(v) > 1 else 0
+    rs = max(0.5 / slope, 1e-3) if slope > 0 else 1.0
+    n = 1.5
+    i0 = max(abs(iph), 1e-12) / np.expm1(voc / (n * thermal_voltage(temperature)))
+    return {'iph': iph, 'i0': max(i0, 1e-30), 'rs': rs, 'rsh': max(rsh, 10 * rs), 'n': n}
+
+
+def fit_diode(voltages, currents, guess=None, temperature=298.15):
+    """Fit the single-diode model to one measured curve (load convention).
+
+    guess is a dict of starting parameters, e.g. the result of the previous curve. Returns a dict with the
+    fitted parameters, the RMS current error and whether the optimizer converged.
+    """
+    voltages = np.asarray(voltages, dtype=float)
+    currents = np.asarray(currents, dtype=float)
+    if guess is None:
+        guess = initial_guess(voltages, currents, temperature)
+    lower, upper = np.array([-np.inf, -80, -15, -5, 0.5]), np.array([np.inf, 0, 15, 25, 5])
+    x0 = [guess['iph'], np.log(guess['i0']), np.log(guess['rs']), np.log(guess['rsh']), guess['n']]
+    x0 = np.clip(x0, lower + 1e-9, upper - 1e-9)
+    result = least_squares(_residuals, x0, jac=_jacobian, args=(voltages, currents, temperature),
+                           bounds=(lower, upper), x_scale='jac')
+    parameters = dict(zip(PARAMETER_NAMES, _unpack(result.x)))
+    parameters = {name: float(value) for name, value in parameters.items()}
+    parameters['rmse'] = float(np.sqrt(np.mean(result.fun ** 2)))
+    parameters['success'] = bool(result.success)
+    return parameters
+
+
+class DiodeFitter:
+    """Fit curves one after another, starting each fit from the parameters of the previous good fit."""
+
+    def __init__(self, temperature=298.15):
+        self.temperature = temperature
+        self.last_parameters = None
+
+    def fit(self, voltages, currents):
+        guess = self.last_parameters
+        result = fit_diode(voltages, currents, guess, self.temperature)
+        if guess is not None and not result['success']:
+            # The previous device was too different; start again from the curve itself
+            result = fit_diode(voltages, currents, None, self.temperature)
+        if result['success']:
+            self.last_parameters = result
+        return result
+
+
+def _fit_chunk(args):
+    curves, temperature = args
+    fitter = DiodeFitter(temperature)
+    return [fitter.fit(voltages, currents) for voltages, currents in curves]
+
+
+def fit_batch(curves, processes=None, temperature=298.15):
+    """Fit many (voltages, currents) curves on a process pool.
+
+    The curves are split into one contiguous chunk per process so that neighbouring curves (usually the same
+    device or similar devices) still warm-start each other.
+    """
+    curves = list(curves)
+    if not curves:
+        return []
+    processes = processes or os.cpu_count() or 1
+    with ProcessPoolExecutor(processes) as pool:
+        chunks = max(1, min(len(curves), processes))
+        bounds = np.linspace(0, len(curves), chunks + 1).astype(int)
+        jobs = [(curves[start:end], temperature) for start, end in zip(bounds[:-1], bounds[1:])]
+        results = []
+        for chunk_results in pool.map(_fit_chunk, jobs):
+            results.extend(chunk_results)
+    return results
@@ -0,0 +1,190 @@
+# Figure-of-merit extraction for IV curves (no GUI dependencies)
+#
+# All functions work on a single curve (1-D arrays) or on a batch of curves stored as rows of 2-D arrays.
+# Voc and Isc are found with local quadratic interpolation and the maximum power point on a monotone cubic
+# (PCHIP) through the current, so the results do not snap to the nearest grid point and coarse sweeps give
+# nearly the same numbers as dense ones without overshooting the measured points.
+import numpy as np
+
+FOM_NAMES = ('voc', 'isc', 'ff', 'max_power', 'mpp_voltage', 'mpp_current', 'pce')
+MPP_SAMPLES = 65  # Points per interval at which the interpolated power is evaluated around the peak
+
+
+def sort_curves(voltages, currents):
+    """Return the curves as 2-D float arrays sorted by voltage along each row."""
+    voltages = np.atleast_2d(np.asarray(voltages, dtype=float))
+    currents = np.atleast_2d(np.asarray(currents, dtype=float))
+    voltages = np.broadcast_to(voltages, currents.shape)
+    order = np.argsort(voltages, axis=1, kind='stable')
+    return np.take_along_axis(voltages, order, axis=1), np.take_along_axis(currents, order, axis=1)
+
+
+def _three_point_window(index, n):
+    """Indices of the three neighbouring points used for quadratic interpolation around index."""
+    first = np.clip(index - 1, 0, max(n - 3, 0))
+    return first[:, None] + np.arange(min(n, 3))[None, :]
+
+
+def _quadratic_at(x, y, x0):
+    """Evaluate the parabola through three points per row (x, y of shape (m, 3)) at x0 (shape (m,))."""
+    if x.shape[1] < 3:
+        # Too few points for a parabola, fall back to a straight line
+        slope = (y[:, -1] - y[:, 0]) / (x[:, -1] - x[:, 0])
+        return y[:, 0] + slope * (x0 - x[:, 0])
+    x_a, x_b, x_c = x[:, 0], x[:, 1], x[:, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        l_a = (x0 - x_b) * (x0 - x_c) / ((x_a - x_b) * (x_a - x_c))
+        l_b = (x0 - x_a) * (x0 - x_c) / ((x_b - x_a) * (x_b - x_c))
+        l_c = (x0 - x_a) * (x0 - x_b) / ((x_c - x_a) * (x_c - x_b))
+    return y[:, 0] * l_a + y[:, 1] * l_b + y[:, 2] * l_c
+
+
+def _pchip_slopes(x, y):
+    """Derivatives of the monotone piecewise cubic (Fritsch-Carlson PCHIP) through the points of each row."""
+    h = np.diff(x, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = np.diff(y, axis=1) / h
+        if x.shape[1] < 3:
+            return np.concatenate([delta, delta], axis=1)
+        # Inside: weighted harmonic mean of the neighbouring secants, flat at a local extremum
+        w_1 = 2 * h[:, 1:] + h[:, :-1]
+        w_2 = h[:, 1:] + 2 * h[:, :-1]
+        inner = (w_1 + w_2) / (w_1 / delta[:, :-1] + w_2 / delta[:, 1:])
+        inner = np.where(delta[:, :-1] * delta[:, 1:] > 0, inner, 0.0)
+        ends = []
+        for h_0, h_1, delta_0, delta_1 in ((h[:, 0], h[:, 1], delta[:, 0], delta[:, 1]),
+                                           (h[:, -1], h[:, -2], delta[:, -1], delta[:, -2])):
+            end = ((2 * h_0 + h_1) * delta_0 - h_0 * delta_1) / (h_0 + h_1)
+            end = np.where(np.sign(end) != np.sign(delta_0), 0.0, end)
+            ends.append(np.where((np.sign(delta_0) != np.sign(delta_1)) & (np.abs(end) > 3 * np.abs(delta_0)),
+                                 3 * delta_0, end))
+    slopes = np.concatenate([ends[0][:, None], inner, ends[1][:, None]], axis=1)
+    return np.where(np.isfinite(slopes), slopes, 0.0)
+
+
+def short_circuit_current(voltages, currents):
+    """Current at 0 V for each curve (NaN if 0 V is outside the sweep)."""
+    v, i = sort_curves(voltages, currents)
+    n = v.shape[1]
+    index = np.clip(np.sum(v < 0, axis=1), 0, n - 1)
+    window = _three_point_window(index, n)
+    isc = _quadratic_at(np.take_along_axis(v, window, 1), np.take_along_axis(i, window, 1), np.zeros(len(v)))
+    inside = (v[:, 0] <= 0) & (v[:, -1] >= 0)
+    return np.where(inside, isc, np.nan)
+
+
+def open_circuit_voltage(voltages, currents):
+    """Voltage where the current changes sign, searched from 0 V upwards (NaN if there is no crossing).
+
+    The crossing is located by interpolating V as a function of I around the sign change.
+    """
+    v, i = sort_curves(voltages, currents)
+    n = v.shape[1]
+    rows = np.arange(len(v))
+    sign_change = (np.sign(i[:, :-1]) != np.sign(i[:, 1:])) | (i[:, :-1] == 0)
+    sign_change &= v[:, 1:] >= 0
+    found = np.any(sign_change, axis=1)
+    index = np.argmax(sign_change, axis=1)
+    # Use the point of the pair that is closest to zero current as the centre of the window
+    closer = np.abs(i[rows, np.minimum(index + 1, n - 1)]) < np.abs(i[rows, index])
+    window = _three_point_window(index + closer, n)
+    voc = _quadratic_at(np.take_along_axis(i, window, 1), np.take_along_axis(v, window, 1), np.zeros(len(v)))
+    # Fall back to linear interpolation if the inverse parabola leaves the bracketing interval
+    v_low, v_high = v[rows, index], v[rows, np.minimum(index + 1, n - 1)]
+    i_low, i_high = i[rows, index], i[rows, np.minimum(index + 1, n - 1)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        linear = np.where(i_high != i_low, v_low - i_low * (v_high - v_low) / (i_high - i_low), v_low)
+    voc = np.where((voc >= v_low) & (voc <= v_high), voc, linear)
+    return np.where(found, voc, np.nan)
+
+
+def generated_power(voltages, currents, isc=None):
+    """Power delivered by the device, positive in the generating quadrant whatever the current sign convention."""
+    v, i = sort_curves(voltages, currents)
+    if isc is None:
+        isc = short_circuit_current(v, i)
+    sign = np.where(np.isnan(isc) | (isc == 0), -1.0, np.sign(isc))
+    return sign[:, None] * v * i
+
+
+def maximum_power_point(voltages, currents, isc=None, samples=MPP_SAMPLES):
+    """Return (max_power, mpp_voltage, mpp_current) for each curve.
+
+    The current is interpolated with a PCHIP, which follows the knee of the curve without overshooting the
+    measured points, and the power is maximised over samples points per interval on both sides of the
+    largest measured power. max_power is never below the largest measured power.
+    """
+    v, i = sort_curves(voltages, currents)
+    if isc is None:
+        isc = short_circuit_current(v, i)
+    power = generated_power(v, i, isc)
+    n = v.shape[1]
+    rows = np.arange(len(v))[:, None]
+    slopes = _pchip_slopes(v, i)
+    peak = np.argmax(power, axis=1)
+    # The intervals left and right of the peak, as (rows, 2 * samples) arrays of interval indices
+    interval = np.clip(peak[:, None] + np.repeat([-1, 0], samples)[None, :], 0, max(n - 2, 0))
+    t = np.tile(np.linspace(0, 1, samples), 2)[None, :]
+    x_0, x_1 = v[rows, interval], v[rows, np.minimum(interval + 1, n - 1)]
+    y_0, y_1 = i[rows, interval], i[rows, np.minimum(interval + 1, n - 1)]
+    width = x_1 - x_0
+    # Cubic Hermite basis
+    current = (y_0 * (2 * t ** 3 - 3 * t ** 2 + 1) + slopes[rows, interval] * width * (t ** 3 - 2 * t ** 2 + t)
+               + y_1 * (3 * t ** 2 - 2 * t ** 3)
+               + slopes[rows, np.minimum(interval + 1, n - 1)] * width * (t ** 3 - t ** 2))
+    voltage = x_0 + t * width
+    sign = np.where(np.isnan(isc) | (isc == 0), -1.0, np.sign(isc))
+    best = np.argmax(sign[:, None] * voltage * current, axis=1)
+    mpp_voltage = voltage[rows[:, 0], best]
+    mpp_current = current[rows[:, 0], best]
+    max_power = sign * mpp_voltage * mpp_current
+    return max_power, mpp_voltage, mpp_current
+
+
+def figures_of_merit(voltages, currents, irradiance=1000.0, area=1.0):
+    """Compute Voc, Isc, FF, Pmax, Vmp, Imp and PCE (%) for one curve or a batch of curves.
+
+    voltages may be 1-D (shared grid) or 2-D; currents is 1-D for a single curve or 2-D with one curve per
+    row. Returns a dict of floats for a single curve and a dict of arrays for a batch.
+    """
+    single = np.ndim(currents) == 1
+    v, i = sort_curves(voltages, currents)
+    if v.shape[1] < 2:
+        results = {name: np.full(len(v), np.nan) for name in FOM_NAMES}
+        return {name: float(value[0]) for name, value in results.items()} if single else results
+    isc = short_circuit_current(v, i)
+    voc = open_circuit_voltage(v, i)
+    max_power, mpp_voltage, mpp_current = maximum_power_point(v, i, isc)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ff = max_power / np.abs(voc * isc)
+        pce = max_power / (np.asarray(irradiance, dtype=float) * np.asarray(area, dtype=float)) * 100
+    results = {'voc': voc, 'isc': isc, 'ff': ff, 'max_power': max_power, 'mpp_voltage': mpp_voltage,
+               'mpp_current': mpp_current, 'pce': np.broadcast_to(pce, voc.shape)}
+    if single:
+        return {name: float(value[0]) for name, value in results.items()}
+    return results
+
+
+def hysteresis_index(forward_voltages, forward_currents, reverse_voltages, reverse_currents, points=200):
+    """Hysteresis of a forward and a reverse scan of the same device.
+
+    Returns (power_index, area_index): (Pmax_reverse - Pmax_forward) / Pmax_reverse, and the area between the
+    two curves from 0 V to the reverse Voc relative to the area under the reverse curve. Both are 0 for a
+    device without hysteresis and positive when the reverse scan performs better.
+    """
+    forward = figures_of_merit(forward_voltages, forward_currents)
+    reverse = figures_of_merit(reverse_voltages, reverse_currents)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        power_index = (reverse['max_power'] - forward['max_power']) / reverse['max_power']
+    if not np.isfinite(reverse['voc']) or reverse['voc'] <= 0:
+        return float(power_index), float('nan')
+    # Generated current is positive for either current sign convention
+    sign = -1.0 if np.isnan(reverse['isc']) or reverse['isc'] == 0 else np.sign(reverse['isc'])
+    grid = np.linspace(0, reverse['voc'], points)
+    v, i = sort_curves(forward_voltages, forward_currents)
+    forward_current = sign * np.interp(grid, v[0], i[0])
+    v, i = sort_curves(reverse_voltages, reverse_currents)
+    reverse_current = sign * np.interp(grid, v[0], i[0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        area_index = np.mean(reverse_current - forward_current) / np.mean(reverse_current)
+    return float(power_index), float(area_index)
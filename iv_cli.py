@@ -0,0 +1,264 @@
+# Command-line runner for unattended IV measurements described by a recipe file
+#
+# A recipe is a JSON file such as
+#   {
+#     "instruments": {"left": "USB0::0x05E6::0x2614::4577888::INSTR",
+#                     "right": "USB0::0x05E6::0x2614::4577889::INSTR"},
+#     "store": "overnight.h5",
+#     "irradiance": 1000, "area": 4.84e-6,
+#     "sweep": {"start_voltage": -0.2, "stop_voltage": 1.0, "step_voltage": 0.02, "direction": "Both"},
+#     "devices": [
+#       {"id": "cell-1", "instrument": "left", "repeats": 3, "delay": 60},
+#       {"id": "cell-2", "instrument": "right", "channel": "b", "sweep": {"sweep_mode": "Adaptive"}}
+#     ]
+#   }
+# Keys under "sweep" are the fields of measurement_core.SweepSettings; a device's "sweep" overrides the
+# recipe defaults. "repeats" measures the device several times with "delay" seconds between repeats.
+# A device with "mpp": {"duration": 3600, "sweep_interval": 600, ...} (fields of mpp_tracker.MppSettings) is
+# held at its maximum power point instead; its averaged tracking rows go to the store's series/<id> group.
+# A device with "dark": true is paired with its dark curve: the curve is measured (before any light sweep, with
+# the shutter on digio line "shutter_line" closed, which such a recipe must give) unless the store already
+# holds one for the same setup that is younger than "dark_max_age" seconds. Light sweeps of the device are
+# then analysed against it (photocurrent, superposition check) and the results go into their metadata.
+# Instead of "instruments" a recipe may give a single "resource"; "instruments": "auto" uses every
+# SourceMeter found on the bus, named by resource string. Devices on different instruments or channels are
+# measured in parallel, devices on the same channel one after another. With --simulate every instrument is
+# replaced by a simulated SourceMeter, so a recipe can be tried out without hardware.
+# A recipe with "switch" (the VISA resource of a switch matrix) measures its devices as a device queue on one
+# instrument instead: each device gives the "route" that connects it, e.g. {"id": "px3", "route": "1A03"},
+# and the devices are measured one after another (on the instrument of the first device) while the finished
+# ones are analysed on "processes" processes and recorded; "switch_settle" waits that many seconds after
+# every switch. Such a recipe names its queue with "queue" (e.g. the substrate id); devices the store already
+# holds from that queue are skipped, so an interrupted queue resumes where it stopped (--restart measures
+# every device again). With --simulate the
+# switch connects the pixels of a simulated substrate.
+import argparse
+import json
+import sys
+import numpy as np
+
+import command_trace
+import dark_light
+import device_queue
+import keithley_session
+import measurement_core
+import mpp_tracker
+import simulated_keithley
+import sweep_store
+from scheduler import InstrumentScheduler, MppBlock, SweepJob
+
+
+def load_recipe(path):
+    with open(path) as f:
+        recipe = json.load(f)
+    if not recipe.get('devices'):
+        raise ValueError('The recipe does not list any devices')
+    if any(device.get('dark') for device in recipe['devices']) and recipe.get('shutter_line') is None:
+        # Without a shutter the dark and the light curves would be measured under the same light
+        raise ValueError('Devices with "dark": true need the "shutter_line" of the shutter that darkens them')
+    if recipe.get('switch') and not recipe.get('queue'):
+        # Pixel ids repeat from one substrate to the next, so the queue name is what tells them apart on resume
+        raise ValueError('A recipe with a "switch" needs a "queue" name, such as the substrate id')
+    return recipe
+
+
+def device_settings(recipe, device):
+    """SweepSettings of a device: recipe defaults updated with the device's own values."""
+    values = dict(recipe.get('sweep', {}))
+    values.update(device.get('sweep', {}))
+    if 'channel' in device:
+        values['channel'] = device['channel']
+    return measurement_core.SweepSettings.from_dict(values)
+
+
+def recipe_instruments(recipe, resource=None):
+    """Map instrument names to VISA resource names."""
+    instruments = recipe.get('instruments')
+    if instruments == 'auto':
+        return {name: name for name in measurement_core.find_keithleys()}
+    if instruments:
+        return dict(instruments)
+    return {'default': resource or recipe.get('resource', measurement_core.DEFAULT_RESOURCE)}
+
+
+def run_recipe(recipe, sessions, store=None, log=print):
+    """Measure every device of the recipe on the given sessions and return the number of results recorded."""
+    scheduler = InstrumentScheduler(sessions, recipe.get('current_limit', 105e-3), recipe.get('shutter_line'))
+    dark_curves = dark_light.DarkCurveCache(max_age=recipe.get('dark_max_age'))
+    if store is not None:
+        dark_curves.load_store(store)
+    for device in recipe['devices']:
+        settings = device_settings(recipe, device)
+        instrument = device.get('instrument', next(iter(sessions)))
+        if device.get('dark') and not dark_curves.contains(device['id'], settings):
+            scheduler.add_job(instrument, SweepJob(device['id'], settings, illumination='dark'))
+        job = SweepJob(device['id'], settings, device.get('repeats', 1),
+                       device.get('delay', 0.0), device.get('irradiance', recipe.get('irradiance', 1000.0)),
+                       device.get('area', recipe.get('area', 1.0)),
+                       mpp=mpp_tracker.MppSettings.from_dict(device['mpp']) if 'mpp' in device else None)
+        scheduler.add_job(instrument, job)
+
+    def record(result):
+        if isinstance(result, MppBlock):
+            if store is not None:
+                store.append_series(result.job.device_id, result.rows)
+            rows = result.rows
+            log(f"{result.job.device_id} MPP t={rows['time'][-1]:.0f} s: {rows['voltage'][-1]:.4f} V, "
+                f"{rows['power'][-1]:.4e} W")
+            return
+        job, extras, foms = result.job, result.extras, result.foms
+        dark = job.illumination == 'dark'
+        pair = None
+        if not dark:
+            dark_curve = dark_curves.get(job.device_id, job.settings)
+            if dark_curve is not None:
+                pair = dark_light.summary(dark_light.pair_metrics(dark_curve, result.voltages, result.currents),
+                                          dark_curve)
+        sweep_id = None
+        if store is not None:
+            metadata = {'device': job.device_id, 'repeat': result.repeat, 'direction': extras.get('direction'),
+                        'channel': extras.get('channel'), 'irradiance': 0.0 if dark else job.irradiance,
+                        'area': job.area, 'instrument': getattr(sessions[result.instrument], 'name', result.instrument),
+                        'foms': foms, 'hysteresis_index': extras.get('hysteresis_index'),
+                        'illumination': job.illumination, 'setup': dark_light.setup_key(job.settings),
+                        'dark_pair': pair, 'timed_out': extras.get('timed_out', False)}
+            sweep_id = store.append(result.voltages, result.currents, metadata, extras.get('timestamps'),
+                                    extras.get('settle_times'), extras.get('reference_currents'))
+        if dark:
+            dark_curve = dark_curves.put(job.device_id, job.settings,
+                                         dark_light.DarkCurve(result.voltages, result.currents, sweep_id=sweep_id))
+            log(f"{job.device_id} dark {extras.get('direction')}: {len(result.voltages)} points, "
+                f"Rsh {dark_curve.rsh:.4g} Ohm{timeout_note(result.voltages, extras)}")
+            return
+        hysteresis = f", HI {extras['hysteresis_index']:.4f}" if 'hysteresis_index' in extras else ''
+        settling = ''
+        if len(extras.get('settle_times', [])):
+            # Adaptive sweeps: how long the points took to settle, and how many ran out of time
+            unsettled = np.count_nonzero(~extras['settled'])
+            settling = (f", settle mean {np.mean(extras['settle_times']):.3f} s, max "
+                        f"{np.max(extras['settle_times']):.3f} s" + (f', {unsettled} unsettled' if unsettled else ''))
+        paired = (f", Iph {pair['photo_isc']:.4e} A, superposition {pair['superposition_deviation']:.1%}"
+                  if pair is not None else '')
+        log(f"{job.device_id} #{result.repeat + 1} {extras.get('direction')}: {len(result.voltages)} points, "
+            f"Voc {foms['voc']:.4f} V, Isc {foms['isc']:.4e} A, FF {foms['ff']:.3f}, PCE {foms['pce']:.3f} %"
+            f"{hysteresis}{settling}{paired}{timeout_note(result.voltages, extras)}")
+
+    results = scheduler.run(record)
+    for instrument, error in scheduler.errors:
+        log(f'{instrument} failed:\n{error}')
+    return len(results)
+
+
+def timeout_note(voltages, extras):
+    """', TIMED OUT after n of m points' for a sweep the instrument did not finish in time, else ''."""
+    if not extras.get('timed_out'):
+        return ''
+    return f", TIMED OUT after {len(voltages)} of {extras['requested_points']} points"
+
+
+def run_queue(recipe, session, switch, store=None, resume=True, log=print):
+    """Measure the devices of a recipe with a switch matrix as a DeviceQueue; return the number of sweeps recorded."""
+    routes = {device['id']: device.get('route', device['id']) for device in recipe['devices']}
+    jobs = [SweepJob(device['id'], device_settings(recipe, device),
+                     irradiance=device.get('irradiance', recipe.get('irradiance', 1000.0)),
+                     area=device.get('area', recipe.get('area', 1.0))) for device in recipe['devices']]
+    matrix = device_queue.SwitchMatrix(switch, routes, recipe.get('switch_settle', 0.0))
+    queue = device_queue.DeviceQueue(session, matrix, jobs, store, recipe['queue'],
+                                     recipe.get('processes'), recipe.get('fit', True), resume,
+                                     recipe.get('current_limit', 105e-3))
+
+    def record(result):
+        for voltages, currents, extras, foms, diode in result.sweeps:
+            fit = f", Rs {diode['rs']:.4g} Ohm, Rsh {diode['rsh']:.4g} Ohm" if diode is not None else ''
+            log(f"{result.job.device_id} ({result.route}, {queue.recorded}/{len(jobs) - queue.skipped}) "
+                f"{extras.get('direction')}: Voc {foms['voc']:.4f} V, Isc {foms['isc']:.4e} A, FF {foms['ff']:.3f}, "
+                f"PCE {foms['pce']:.3f} %{fit}{timeout_note(voltages, extras)}")
+
+    if resume and queue.pending() != queue.jobs:
+        log(f"Resuming queue '{queue.name}': {len(queue.jobs) - len(queue.pending())} devices already recorded")
+    results = queue.run(record)
+    for device_id, error in queue.errors:
+        log(f'{device_id} failed:\n{error}')
+    stats = queue.stats()
+    if results:
+        log(f"{stats['devices']} devices in {stats['wall']:.1f} s ({stats['seconds_per_device']:.2f} s per device), "
+            f"instrument busy {stats['instrument_share']:.0%} of the time")
+    return sum(len(result.sweeps) for result in results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run IV measurements from a recipe file without the GUI.')
+    parser.add_argument('recipe', nargs='?', help='JSON recipe listing the devices and sweep settings')
+    parser.add_argument('--resource', help='VISA resource name (overrides the recipe)')
+    parser.add_argument('--store', help='HDF5 file the sweeps are appended to (overrides the recipe)')
+    parser.add_argument('--discover', action='store_true', help='List the connected SourceMeters and exit')
+    parser.add_argument('--simulate', action='store_true', help='Measure on simulated SourceMeters')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Bus latency of the simulated SourceMeters per command in seconds')
+    parser.add_argument('--restart', action='store_true',
+                        help='Measure every device of a device queue again instead of resuming it')
+    parser.add_argument('--trace', help='Record every instrument command and write the trace to this file '
+                                        '(.json for chrome://tracing, otherwise CSV)')
+    args = parser.parse_args(argv)
+
+    if args.discover:
+        for resource in measurement_core.find_keithleys():
+            print(resource)
+        return 0
+    if args.recipe is None:
+        parser.error('a recipe file is required')
+
+    recipe = load_recipe(args.recipe)
+    store_path = args.store or recipe.get('store')
+    store = sweep_store.SweepStore(store_path) if store_path else None
+
+    if args.simulate:
+        instruments = recipe.get('instruments')
+        names = instruments if isinstance(instruments, dict) else ['simulated']
+        sessions = {name: keithley_session.KeithleySession(
+            simulated_keithley.SimulatedKeithley(latency=args.latency), f'Simulated 2614B ({name})')
+            for name in names}
+    else:
+        sessions = {name: measurement_core.open_session(resource)
+                    for name, resource in recipe_instruments(recipe, args.resource).items()}
+    switch = None
+    queue_instrument = recipe['devices'][0].get('instrument', next(iter(sessions)))
+    if recipe.get('switch'):
+        if args.simulate:
+            keithley = sessions[queue_instrument]
+            routes = [device.get('route', device['id']) for device in recipe['devices']]
+            smu = f"smu{device_settings(recipe, recipe['devices'][0]).channel}"
+            pixels = simulated_keithley.simulated_substrate(routes, seed=0)
+            switch = keithley_session.KeithleySession(
+                simulated_keithley.SimulatedSwitchMatrix(keithley.resource, pixels, smu), 'Simulated switch matrix')
+        else:
+            switch = measurement_core.open_session(recipe['switch'])
+    trace = command_trace.CommandTrace() if args.trace else None
+    if trace is not None:
+        sessions = {name: command_trace.TracedSession(session, trace) for name, session in sessions.items()}
+        if switch is not None:
+            switch = command_trace.TracedSession(switch, trace)
+    try:
+        if switch is not None:
+            sweeps = run_queue(recipe, sessions[queue_instrument], switch, store, not args.restart)
+        else:
+            sweeps = run_recipe(recipe, sessions, store)
+    except KeyboardInterrupt:
+        print('Interrupted, turning the outputs off', file=sys.stderr)
+        for keithley in sessions.values():
+            keithley.write('smua.source.output = smua.OUTPUT_OFF smub.source.output = smub.OUTPUT_OFF')
+        return 1
+    finally:
+        for keithley in sessions.values():
+            keithley.close()
+        if switch is not None:
+            switch.close()
+        if trace is not None:
+            trace.export(args.trace)
+            print(trace.summary())
+    print(f'Recorded {sweeps} sweeps')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
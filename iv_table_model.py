@@ -0,0 +1,79 @@
+# Table model that shows IV sweeps straight from their NumPy arrays
+import numpy as np
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, Qt
+
+HEADERS = ['Voltage (V)', 'Current (A)', 'Voc', 'Isc', 'FF', 'Mpp', 'Vmp', 'Imp', 'PCE']
+# Figure-of-merit keys (see iv_analysis.figures_of_merit) shown in row 0 of the columns after V and I
+FOM_COLUMNS = ['voc', 'isc', 'ff', 'max_power', 'mpp_voltage', 'mpp_current', 'pce']
+
+
+class IVTableModel(QAbstractTableModel):
+    """Read-only model over a list of sweeps, showing one sweep at a time.
+
+    Cells are formatted only when the view asks for them, so a sweep with tens of thousands of points costs
+    no more than its two arrays.
+    """
+
+    def __init__(self, max_sweeps=200, parent=None):
+        super().__init__(parent)
+        self.max_sweeps = max_sweeps
+        self.sweeps = []
+        self.current = -1
+
+    def add_sweep(self, voltages, currents, foms, label):
+        """Store a sweep and show it. Returns its index."""
+        if len(self.sweeps) >= self.max_sweeps:
+            self.sweeps.pop(0)
+        self.sweeps.append({'label': label, 'voltages': np.asarray(voltages, dtype=float),
+                            'currents': np.asarray(currents, dtype=float), 'foms': dict(foms)})
+        self.set_current(len(self.sweeps) - 1)
+        return self.current
+
+    def set_current(self, index):
+        self.beginResetModel()
+        self.current = index if 0 <= index < len(self.sweeps) else -1
+        self.endResetModel()
+
+    def current_sweep(self):
+        return self.sweeps[self.current] if self.current >= 0 else None
+
+    def labels(self):
+        return [sweep['label'] for sweep in self.sweeps]
+
+    def clear(self):
+        self.beginResetModel()
+        self.sweeps = []
+        self.current = -1
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        sweep = self.current_sweep()
+        if parent.isValid() or sweep is None:
+            return 0
+        return len(sweep['voltages'])
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        sweep = self.current_sweep()
+        row, column = index.row(), index.column()
+        if column == 0:
+            return f"{sweep['voltages'][row]:.6g}"
+        if column == 1:
+            return f"{sweep['currents'][row]:.6g}"
+        if row == 0:
+            value = sweep['foms'].get(FOM_COLUMNS[column - 2])
+            if value is None:
+                return None
+            return f'{value:.3f}' if FOM_COLUMNS[column - 2] == 'pce' else f'{value:.6g}'
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return HEADERS[section]
+        return str(section + 1)
@@ -0,0 +1,68 @@
+# Single shared session to the SourceMeter
+import threading
+
+# Settings that sweeps (and the MPP tracker) change behind the shadow state's back; apply() always sends them
+VOLATILE_SETTINGS = ('.source.levelv', '.measure.nplc')
+
+
+class KeithleySession:
+    """Own the VISA resource of one SourceMeter and serialize every access to it.
+
+    All workers (IV sweeps, current streaming) share one session instead of opening the resource twice.
+    Single write/query calls are atomic; use `with session.lock:` to keep a sequence of commands together.
+    Settings written through apply() are remembered in a shadow copy of the instrument state, so repeating a
+    configuration only sends what changed.
+    """
+
+    def __init__(self, resource, name=''):
+        self.resource = resource
+        self.name = name
+        self.lock = threading.RLock()
+        # Only real pyvisa resources can transfer binary blocks
+        self.binary_supported = hasattr(resource, 'query_binary_values')
+        self.state = {}  # TSP attribute -> value last assigned through apply()
+        self.reset_done = False
+
+    def write(self, command):
+        with self.lock:
+            return self.resource.write(command)
+
+    def query(self, command):
+        with self.lock:
+            return self.resource.query(command)
+
+    def query_binary_values(self, command, **kwargs):
+        with self.lock:
+            return self.resource.query_binary_values(command, **kwargs)
+
+    def run_program(self, commands):
+        """Send a list of TSP lines without other threads' commands in between."""
+        with self.lock:
+            for command in commands:
+                self.resource.write(command)
+
+    def apply(self, settings, reset=False):
+        """Assign TSP attributes, skipping those that already have the value, and return the commands sent.
+
+        settings maps attributes such as 'smua.source.limiti' to values; the assignments go out as one line in
+        the given order. With reset=True the line starts with reset() if the instrument has not been reset
+        since the session was opened, and the shadow state starts over.
+        """
+        with self.lock:
+            commands = []
+            if reset and not self.reset_done:
+                commands.append('reset()')
+                self.state.clear()
+            changed = {name: str(value) for name, value in settings.items()
+                       if name.endswith(VOLATILE_SETTINGS) or self.state.get(name) != str(value)}
+            commands += [f'{name} = {value}' for name, value in changed.items()]
+            if commands:
+                self.resource.write(' '.join(commands))
+                self.reset_done = self.reset_done or reset
+                self.state.update(changed)
+            return commands
+
+    def close(self):
+        with self.lock:
+            if hasattr(self.resource, 'close'):
+                self.resource.close()
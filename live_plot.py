@@ -0,0 +1,66 @@
+# Incrementally updated plot curves for data that arrives point by point
+import numpy as np
+import pyqtgraph as pg
+from PyQt5.QtCore import QTimer
+from PyQt5.QtGui import QGuiApplication
+
+
+class LiveCurve:
+    """One reusable curve on a plot, backed by preallocated arrays that grow by doubling.
+
+    append() only stores the data; the curve is redrawn by redraw(), which the owner calls from a timer so
+    the number of redraws never depends on how fast points arrive.
+    """
+
+    def __init__(self, plot_widget, pen, capacity=1024):
+        self.plot_widget = plot_widget
+        self.item = pg.PlotDataItem(pen=pen)
+        self.x = np.empty(capacity)
+        self.y = np.empty(capacity)
+        self.size = 0
+        self.dirty = False
+        self.attach()
+
+    def attach(self):
+        """Put the curve (back) on its plot, e.g. after the plot was cleared."""
+        if self.item.scene() is None:
+            self.plot_widget.addItem(self.item)
+
+    def append(self, x, y):
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        needed = self.size + len(x)
+        if needed > len(self.x):
+            capacity = max(needed, 2 * len(self.x))
+            self.x = np.concatenate([self.x[:self.size], np.empty(capacity - self.size)])
+            self.y = np.concatenate([self.y[:self.size], np.empty(capacity - self.size)])
+        self.x[self.size:needed] = x
+        self.y[self.size:needed] = y
+        self.size = needed
+        self.dirty = True
+
+    def clear(self):
+        self.size = 0
+        self.dirty = True
+
+    def redraw(self):
+        if self.dirty:
+            self.item.setData(self.x[:self.size], self.y[:self.size])
+            self.dirty = False
+
+
+def display_refresh_rate(default=60.0):
+    """Refresh rate of the primary screen in Hz."""
+    screen = QGuiApplication.primaryScreen()
+    rate = screen.refreshRate() if screen is not None else 0
+    return rate if rate > 0 else default
+
+
+def make_redraw_timer(parent, callback, max_rate=30.0):
+    """Start a timer that calls callback at most max_rate times per second (and never above the display rate)."""
+    rate = min(max_rate, display_refresh_rate())
+    timer = QTimer(parent)
+    timer.setInterval(int(1000 / rate))
+    timer.timeout.connect(callback)
+    timer.start()
+    return timer
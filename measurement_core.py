@@ -0,0 +1,277 @@
+# GUI-free measurement core shared by the Qt application and the command-line runner
+import re
+import threading
+import numpy as np
+
+import adaptive_grid
+import command_trace
+import iv_analysis
+import keithley_session
+import settling
+import tsp_sweep
+
+SWEEP_MODES = ('Instrument', 'Stepped', 'Adaptive')
+DIRECTIONS = ('Forward', 'Reverse', 'Both', 'Hysteresis')
+DEFAULT_RESOURCE = 'USB0::0x05E6::0x2614::4577888::INSTR'
+# Keithley (vendor 0x05E6) Series 2600 SourceMeters on USB, e.g. USB0::0x05E6::0x2614::4577888::INSTR
+KEITHLEY_26XX_PATTERN = re.compile(r'^USB\d*::0x05E6::0x26[0-9A-F]{2}[A-Z]?::[^:]+::INSTR$', re.IGNORECASE)
+
+
+def find_keithleys(resource_manager=None, pattern=KEITHLEY_26XX_PATTERN):
+    """Return the VISA resource names of every connected SourceMeter matching the pattern."""
+    if resource_manager is None:
+        import pyvisa
+        resource_manager = pyvisa.ResourceManager()
+    return sorted(resource for resource in resource_manager.list_resources() if pattern.match(resource))
+
+
+def open_session(resource_name=DEFAULT_RESOURCE, resource_manager=None):
+    """Open a SourceMeter by VISA resource name and wrap it in a KeithleySession."""
+    if resource_manager is None:
+        import pyvisa
+        resource_manager = pyvisa.ResourceManager()
+    return keithley_session.KeithleySession(resource_manager.open_resource(resource_name), resource_name)
+
+
+def apply_settings(keithley, settings, reset=False):
+    """Send TSP assignments as one line; a session skips the ones already in effect (see KeithleySession.apply)."""
+    if hasattr(keithley, 'apply'):
+        return keithley.apply(settings, reset)
+    commands = (['reset()'] if reset else []) + [f'{name} = {value}' for name, value in settings.items()]
+    keithley.write(' '.join(commands))
+    return commands
+
+
+def configure_instrument(keithley, channels, current_limit=105e-3):
+    """Set every listed channel ('a', 'b') to source 0 V with the output on.
+
+    The instrument is reset the first time a session is configured; after that only the settings that
+    changed are sent, so configuring before every sweep does not reset the instrument. MeasurementCore.run
+    ends every sweep with the output off (a switch matrix then switches without current flowing), so in
+    practice the next configuration sends only the output on.
+    """
+    settings = {}
+    for channel in dict.fromkeys(channels):
+        smu = f'smu{channel}'
+        settings[f'{smu}.source.func'] = f'{smu}.OUTPUT_DCVOLTS'
+        settings[f'{smu}.source.levelv'] = 0
+        settings[f'{smu}.source.limiti'] = current_limit
+        settings[f'{smu}.measure.autozero'] = f'{smu}.AUTOZERO_ONCE'
+        settings[f'{smu}.source.output'] = f'{smu}.OUTPUT_ON'
+    with command_trace.phase(keithley, 'configure'):
+        return apply_settings(keithley, settings, reset=True)
+
+
+def set_shutter(keithley, line, open_shutter):
+    """Drive the light shutter wired to digital I/O line `line` (high opens it)."""
+    keithley.write(f'digio.writebit({line}, {1 if open_shutter else 0})')
+
+
+def voltage_steps(start_voltage, stop_voltage, step_voltage):
+    """Voltages from start to stop in steps of step_voltage with both ends included (the last step may be
+    shorter)."""
+    if stop_voltage == start_voltage:
+        return np.array([float(start_voltage)])
+    step = abs(step_voltage) * np.sign(stop_voltage - start_voltage)
+    count = int(np.floor((stop_voltage - start_voltage) / step + 1e-9))
+    voltages = start_voltage + step * np.arange(count + 1)
+    if np.isclose(voltages[-1], stop_voltage, rtol=0, atol=1e-9):
+        voltages[-1] = stop_voltage
+    else:
+        voltages = np.append(voltages, stop_voltage)
+    return voltages
+
+
+def sweep_voltages(start_voltage, stop_voltage, step_voltage, direction, dwell_points=0):
+    """Return the (direction, voltages) pairs measured for a Forward, Reverse, Both or Hysteresis sweep.
+
+    A Hysteresis sweep is one continuous scan: start to stop, dwell_points more readings at the stop voltage,
+    and back to start. Use split_hysteresis_scan() to cut its results into the two directions.
+    """
+    forward = voltage_steps(start_voltage, stop_voltage, step_voltage)
+    if direction == 'Hysteresis':
+        return [('Hysteresis', np.concatenate([forward, np.full(dwell_points, forward[-1]), forward[::-1]]))]
+    sweeps = []
+    if direction in ['Forward', 'Both']:
+        sweeps.append(('Forward', forward))
+    if direction in ['Reverse', 'Both']:
+        sweeps.append(('Reverse', forward[::-1].copy()))
+    return sweeps
+
+
+def split_hysteresis_scan(voltages, currents, extras, forward_points, dwell_points=0):
+    """Cut the (possibly aborted) results of a Hysteresis scan into Forward and Reverse sweeps.
+
+    Point arrays in extras are cut the same way and the dwell readings are dropped. Both extras get the
+    hysteresis indices of the pair (see iv_analysis.hysteresis_index) when the two directions are complete.
+    """
+    measured = len(currents)
+    parts = [('Forward', slice(0, min(measured, forward_points)))]
+    if measured > forward_points + dwell_points:
+        parts.append(('Reverse', slice(forward_points + dwell_points, measured)))
+    sweeps = []
+    for direction, part in parts:
+        part_extras = {name: value[part] if isinstance(value, np.ndarray) and len(value) == measured else value
+                       for name, value in extras.items()}
+        sweeps.append((direction, voltages[part], currents[part], part_extras))
+    if len(sweeps) == 2 and len(sweeps[1][1]) == forward_points:
+        power_index, area_index = iv_analysis.hysteresis_index(sweeps[0][1], sweeps[0][2], sweeps[1][1],
+                                                               sweeps[1][2])
+        for sweep in sweeps:
+            sweep[3]['hysteresis_index'] = power_index
+            sweep[3]['hysteresis_area_index'] = area_index
+    return sweeps
+
+
+class SweepSettings:
+    """Parameters of one IV measurement."""
+
+    def __init__(self, start_voltage=-1.0, stop_voltage=1.0, step_voltage=0.05, direction='Forward',
+                 sweep_mode='Instrument', channel='a', nplc=1.0, source_delay=0.05, settle_tolerance=0.005,
+                 max_settle_time=2.0, reference_channel=None, dwell_time=0.0, refine_points=0):
+        self.start_voltage = start_voltage
+        self.stop_voltage = stop_voltage
+        self.step_voltage = step_voltage
+        self.direction = direction
+        self.sweep_mode = sweep_mode  # 'Instrument' runs the sweep with the TSP trigger model, 'Stepped' point by point
+        self.channel = channel
+        self.nplc = nplc
+        self.source_delay = source_delay
+        self.settle_tolerance = settle_tolerance  # Relative current tolerance used by the 'Adaptive' mode
+        self.max_settle_time = max_settle_time
+        # Channel of the reference cell sampled at each point of an 'Instrument' sweep
+        self.reference_channel = reference_channel
+        self.dwell_time = dwell_time  # Seconds held at the stop voltage between the two halves of a Hysteresis scan
+        # Point budget of a refined sweep (see adaptive_grid); 0 measures every step. Not used by Hysteresis scans
+        self.refine_points = refine_points
+
+    def dwell_points(self):
+        """Number of extra readings at the turning point that make up the dwell of a Hysteresis scan."""
+        if self.dwell_time <= 0:
+            return 0
+        point_time = max(self.source_delay, 0) + self.nplc / 50 if self.sweep_mode == 'Instrument' else 0.5
+        return int(np.ceil(self.dwell_time / point_time))
+
+    @classmethod
+    def from_dict(cls, values):
+        settings = cls()
+        for name, value in values.items():
+            if not hasattr(settings, name):
+                raise ValueError(f'Unknown sweep setting: {name}')
+            setattr(settings, name, value)
+        return settings
+
+
+class MeasurementCore:
+    """Runs IV sweeps on a session without any GUI.
+
+    Progress is reported through optional callbacks: on_sweep_started(direction), on_points(voltages, currents)
+    and on_sweep_finished(voltages, currents, extras). is_running() is polled to stop early, and stop() also
+    cuts short any wait in progress.
+    """
+
+    def __init__(self, keithley):
+        self.keithley = keithley
+        self._running = False
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._running = False
+        self._stopped.set()
+
+    def is_running(self):
+        return self._running
+
+    def run(self, settings, on_sweep_started=None, on_points=None, on_sweep_finished=None):
+        """Measure every direction of the settings and return a list of (voltages, currents, extras)."""
+        self._running = True
+        self._stopped.clear()
+        smu = f'smu{settings.channel}'
+        if settings.sweep_mode != 'Instrument':
+            # The previous sweep ended with the output off and may have left another integration time; the
+            # trigger model sets both by itself
+            apply_settings(self.keithley, {f'{smu}.measure.nplc': settings.nplc, f'{smu}.source.levelv': 0,
+                                           f'{smu}.source.output': f'{smu}.OUTPUT_ON'})
+        dwell_points = settings.dwell_points()
+        results = []
+        for direction, voltage_values in sweep_voltages(settings.start_voltage, settings.stop_voltage,
+                                                        settings.step_voltage, settings.direction, dwell_points):
+            if not self._running:
+                break
+            if on_sweep_started is not None:
+                on_sweep_started(direction)
+            with command_trace.phase(self.keithley, 'sweep'):
+                if settings.refine_points and direction != 'Hysteresis':
+                    voltages, currents, extras = self.measure_refined(settings, smu, voltage_values, on_points)
+                else:
+                    voltages, currents, extras = self.measure_sweep(settings, smu, voltage_values, on_points)
+            if direction == 'Hysteresis':
+                # The continuous scan is reported as its Forward and Reverse halves
+                forward_points = (len(voltage_values) - dwell_points) // 2
+                sweeps = split_hysteresis_scan(voltages, currents, extras, forward_points, dwell_points)
+            else:
+                sweeps = [(direction, voltages, currents, extras)]
+            for direction, voltages, currents, extras in sweeps:
+                extras['direction'] = direction
+                extras['channel'] = smu
+                results.append((voltages, currents, extras))
+                if on_sweep_finished is not None:
+                    on_sweep_finished(voltages, currents, extras)
+
+        apply_settings(self.keithley, {f'{smu}.source.output': f'{smu}.OUTPUT_OFF'})  # Turn off the output
+        self._running = False
+        return results
+
+    def measure_refined(self, settings, smu, voltage_values, on_points=None):
+        """Measure at most settings.refine_points of the voltages, placed by adaptive_grid.refined_sweep.
+
+        Only the evenly spaced first pass is reported to on_points; the refined curve arrives as a whole.
+        """
+        timed_out = []
+
+        def measure(values, first_pass):
+            voltages, currents, extras = self.measure_sweep(settings, smu, values, on_points if first_pass else None)
+            timed_out.append(extras.get('timed_out', False))
+            return voltages, currents, extras
+
+        voltages, currents, extras = adaptive_grid.refined_sweep(measure, voltage_values, settings.refine_points,
+                                                                 self.is_running)
+        if any(timed_out):
+            # A pass cut short by the timeout leaves a gap in the merged curve
+            extras.update(timed_out=True, requested_points=min(settings.refine_points, len(voltage_values)))
+        return voltages, currents, extras
+
+    def measure_sweep(self, settings, smu, voltage_values, on_points=None):
+        if settings.sweep_mode == 'Instrument':
+            reference_smu = f'smu{settings.reference_channel}' if settings.reference_channel else None
+            return tsp_sweep.run_sweep(self.keithley, smu, voltage_values, settings.nplc, settings.source_delay,
+                                       is_running=self.is_running, reference_smu=reference_smu,
+                                       on_points=on_points)
+
+        current_values = []
+        settle_times = []
+        settled_points = []
+        for voltage in voltage_values:
+            if not self._running:
+                break
+            if settings.sweep_mode == 'Adaptive':
+                current, settle_time, settled = settling.measure_settled(
+                    self.keithley, smu, voltage, settings.settle_tolerance, max_wait=settings.max_settle_time)
+                settle_times.append(settle_time)
+                settled_points.append(settled)
+            else:
+                self.keithley.write(f'{smu}.source.levelv = {voltage}')
+                command_trace.sleep(self.keithley, 0.5, self._stopped)  # Let the system stabilize
+                current = float(self.keithley.query(f'print({smu}.measure.i())'))
+            current_values.append(current)
+            if on_points is not None:
+                on_points([voltage], [current])
+
+        extras = {}
+        if settings.sweep_mode == 'Adaptive':
+            extras['settle_times'] = np.array(settle_times)
+            extras['settled'] = np.array(settled_points, dtype=bool)  # False where max_settle_time ran out
+        else:
+            command_trace.sleep(self.keithley, 0.5, self._stopped)  # Let the system stabilize after the sweep
+        return voltage_values[:len(current_values)], np.array(current_values), extras
+
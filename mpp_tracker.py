@@ -0,0 +1,206 @@
+# Maximum power point tracking for long stability measurements
+#
+# The tracker holds the device near its maximum power point with perturb and observe in a tight host loop:
+# every update is a single round trip that sets the new voltage and reads the current. Full IV sweeps run on
+# a schedule (through the trigger model) and re-centre the tracker on the MPP they find. Readings are
+# averaged over fixed time windows and handed out in blocks, so a run of any length needs constant memory.
+import time
+import numpy as np
+
+import command_trace
+import iv_analysis
+import measurement_core
+import tsp_sweep
+
+SERIES_COLUMNS = ('time', 'voltage', 'current', 'power', 'power_min', 'power_max', 'samples')
+
+
+class MppSettings:
+    """Parameters of an MPP tracking run. Periodic sweeps use the tracker's SweepSettings (same channel)."""
+
+    def __init__(self, step=0.005, min_step=0.001, max_step=0.02, nplc=1.0, average_window=1.0,
+                 block_rows=60, sweep_interval=600.0, duration=None, start_voltage=None, min_voltage=0.0,
+                 max_voltage=None):
+        self.step = step  # Initial perturbation in V; it grows while power rises and shrinks when it falls
+        self.min_step = min_step
+        self.max_step = max_step
+        self.nplc = nplc
+        self.average_window = average_window  # Seconds of readings averaged into one stored row
+        self.block_rows = block_rows  # Rows handed to on_block at a time
+        self.sweep_interval = sweep_interval  # Seconds between IV sweeps; 0 or None sweeps only at the start
+        self.duration = duration  # Seconds to track; None tracks until stopped
+        self.start_voltage = start_voltage  # None starts at the MPP of the first sweep
+        self.min_voltage = min_voltage
+        self.max_voltage = max_voltage  # None limits tracking to the Voc of the last sweep
+
+    @classmethod
+    def from_dict(cls, values):
+        settings = cls()
+        for name, value in values.items():
+            if not hasattr(settings, name):
+                raise ValueError(f'Unknown MPP setting: {name}')
+            setattr(settings, name, value)
+        return settings
+
+
+class WindowAverager:
+    """Average (time, voltage, current, power) readings over fixed time windows."""
+
+    def __init__(self, window):
+        self.window = window
+        self._reset(None)
+
+    def _reset(self, start):
+        self.start = start
+        self.count = 0
+        self.sums = np.zeros(4)
+        self.power_min = np.inf
+        self.power_max = -np.inf
+
+    def add(self, t, voltage, current, power):
+        """Add a reading; return the finished row (a dict of SERIES_COLUMNS) when a window completes."""
+        row = None
+        if self.start is not None and t - self.start >= self.window:
+            row = self.flush()
+        if self.start is None:
+            self.start = t
+        self.count += 1
+        self.sums += (t, voltage, current, power)
+        self.power_min = min(self.power_min, power)
+        self.power_max = max(self.power_max, power)
+        return row
+
+    def flush(self):
+        """Return the row of the readings collected so far (None if there are none) and start a new window."""
+        if self.count == 0:
+            return None
+        mean = self.sums / self.count
+        row = dict(zip(SERIES_COLUMNS, (*mean, self.power_min, self.power_max, self.count)))
+        self._reset(None)
+        return row
+
+
+def perturb_and_observe(voltage, power, last_power, direction, step, settings):
+    """One perturb-and-observe update: return the next (voltage, direction, step).
+
+    The voltage keeps moving while the power rises; when it falls the direction reverses and the step halves,
+    so the tracker settles into a small oscillation around the MPP and speeds up again when the MPP moves.
+    """
+    if power < last_power:
+        direction = -direction
+        step = max(step / 2, settings.min_step)
+    else:
+        step = min(step * 1.5, settings.max_step)
+    return voltage + direction * step, direction, step
+
+
+class MppTracker:
+    """Track the MPP of one channel with periodic IV sweeps.
+
+    Callbacks: on_update(row) for every averaged row, on_block(block) with a dict of arrays every
+    settings.block_rows rows (and at the end), on_sweep(voltages, currents, extras) after every IV sweep.
+    """
+
+    def __init__(self, keithley, settings, sweep_settings, on_update=None, on_block=None, on_sweep=None):
+        self.keithley = keithley
+        self.settings = settings
+        self.sweep_settings = sweep_settings
+        self.on_update = on_update
+        self.on_block = on_block
+        self.on_sweep = on_sweep
+        self.smu = f'smu{sweep_settings.channel}'
+        self.sign = -1.0  # Generated power is sign * V * I; set from the sweeps' Isc
+        self.voc = None
+        self.updates = 0
+        self._running = False
+
+    def stop(self):
+        self._running = False
+
+    def is_running(self):
+        return self._running
+
+    def sweep(self):
+        """Run one IV sweep and return the MPP voltage it found (None if there is none)."""
+        settings = self.sweep_settings
+        voltages = measurement_core.voltage_steps(settings.start_voltage, settings.stop_voltage,
+                                                  settings.step_voltage)
+        with command_trace.phase(self.keithley, 'sweep'):
+            voltages, currents, extras = tsp_sweep.run_sweep(self.keithley, self.smu, voltages, settings.nplc,
+                                                             settings.source_delay, is_running=self.is_running)
+        extras.update(direction='Forward', channel=self.smu, mode='MPP')
+        if self.on_sweep is not None:
+            self.on_sweep(voltages, currents, extras)
+        foms = iv_analysis.figures_of_merit(voltages, currents)
+        if np.isfinite(foms['isc']) and foms['isc'] != 0:
+            self.sign = float(np.sign(foms['isc']))
+        if np.isfinite(foms['voc']):
+            self.voc = foms['voc']
+        return foms['mpp_voltage'] if np.isfinite(foms['mpp_voltage']) else None
+
+    def _track_settings(self):
+        # Sweeps program their own integration time, so tracking sets it again afterwards
+        self.keithley.write(f'{self.smu}.measure.nplc = {self.settings.nplc}')
+
+    def run(self):
+        settings = self.settings
+        self._running = True
+        averager = WindowAverager(settings.average_window)
+        rows = []
+
+        def emit(row):
+            if row is None:
+                return
+            rows.append(row)
+            if self.on_update is not None:
+                self.on_update(row)
+            if len(rows) >= settings.block_rows:
+                flush()
+
+        def flush():
+            if rows and self.on_block is not None:
+                self.on_block({column: np.array([row[column] for row in rows]) for column in SERIES_COLUMNS})
+            rows.clear()
+
+        start = time.monotonic()
+        try:
+            voltage = settings.start_voltage
+            if voltage is None or settings.sweep_interval:
+                mpp_voltage = self.sweep()
+                voltage = voltage if voltage is not None else mpp_voltage
+            if voltage is None:
+                voltage = 0.0
+            next_sweep = start + settings.sweep_interval if settings.sweep_interval else np.inf
+            self._track_settings()
+            direction, step, last_power = 1.0, settings.step, -np.inf
+            with command_trace.phase(self.keithley, 'track'):
+                while self.is_running():
+                    now = time.monotonic()
+                    if settings.duration is not None and now - start >= settings.duration:
+                        break
+                    if now >= next_sweep:
+                        emit(averager.flush())
+                        mpp_voltage = self.sweep()
+                        if mpp_voltage is not None:
+                            voltage, direction, step, last_power = mpp_voltage, 1.0, settings.step, -np.inf
+                        next_sweep = time.monotonic() + settings.sweep_interval
+                        self._track_settings()
+                        continue
+                    # One round trip per update: set the voltage and read the current together
+                    current = float(self.keithley.query(
+                        f'{self.smu}.source.levelv = {tsp_sweep.format_value(voltage)} print({self.smu}.measure.i())'))
+                    power = self.sign * voltage * current
+                    self.updates += 1
+                    emit(averager.add(time.monotonic() - start, voltage, current, power))
+                    maximum = settings.max_voltage if settings.max_voltage is not None else self.voc
+                    voltage, direction, step = perturb_and_observe(voltage, power, last_power, direction, step,
+                                                                   settings)
+                    voltage = float(np.clip(voltage, settings.min_voltage,
+                                            maximum if maximum is not None else np.inf))
+                    last_power = power
+        finally:
+            # Stopped, finished or failed: the device is not left biased at the last MPP voltage
+            measurement_core.apply_settings(self.keithley, {f'{self.smu}.source.output': f'{self.smu}.OUTPUT_OFF'})
+            emit(averager.flush())
+            flush()
+            self._running = False
@@ -0,0 +1,188 @@
+# Plotting many curves and long series without slowing the GUI down
+#
+# CurveOverlay keeps the arrays of the last `capacity` measured curves (and of every pinned one) but draws
+# only an overlay of them: the pinned curves plus the most recent ones, up to max_curves. StoredSeriesCurve draws a time series straight from
+# a SweepStore, reading only the rows in view and reducing them to about the plot's width, so a stability
+# log with millions of rows pans and zooms as fast as a short one. Every curve drawn here clips to the view
+# and is downsampled by pyqtgraph with its peak method, which keeps the spikes of each pixel column.
+import collections
+import numpy as np
+import pyqtgraph as pg
+from PyQt5.QtCore import QTimer
+
+DEFAULT_MAX_CURVES = 20
+DEFAULT_CAPACITY = 200  # Curves whose arrays are kept, as many as the sweep table holds
+MAX_DRAWN_POINTS = 4000  # Points drawn for a stored series; about two per pixel column of a wide plot
+OVERVIEW_BIN = 256  # Rows per min/max bin of a stored series' overview
+RAW_READ_LIMIT = 200000  # Most rows read from disk for one view; wider views are drawn from the overview
+READ_CHUNK = 1 << 20  # Rows read at a time while the overview is built
+
+
+def fast_item(plot_widget, pen, x=None, y=None):
+    """Add a curve to plot_widget that only draws what is in view, reduced to the resolution of the screen."""
+    # The item is put on the plot before it gets data, as clipping needs the view to exist
+    item = plot_widget.plot(pen=pen)
+    item.setClipToView(True)
+    item.setDownsampling(auto=True, method='peak')
+    if x is not None:
+        item.setData(x, y)
+    return item
+
+
+def peak_decimate(x, y, bins):
+    """Reduce (x, y) to the minimum and maximum of each of `bins` equal slices, in order.
+
+    Returns at most 2 * bins points, so spikes survive however far the data are reduced.
+    """
+    if len(y) <= 2 * bins:
+        return x, y
+    size = len(y) // bins
+    count = size * bins
+    blocks = y[:count].reshape(bins, size)
+    low = np.argmin(blocks, axis=1)
+    high = np.argmax(blocks, axis=1)
+    starts = np.arange(bins) * size
+    # Keep the pair of each slice in time order
+    indices = np.sort(np.stack([starts + low, starts + high], axis=1), axis=1).ravel()
+    if count < len(y):
+        indices = np.append(indices, [count + np.argmin(y[count:]), count + np.argmax(y[count:])])
+        indices = np.sort(indices)
+    return x[indices], y[indices]
+
+
+class CurveOverlay:
+    """Curves of several plots (e.g. IV and power) stored by key, with a capped set of them drawn.
+
+    add() stores one curve per plot under a key. The overlay is the pinned keys plus the most recently
+    added ones, max_curves in total; curves that leave the overlay are taken off the plots but keep their
+    arrays, so pinning them again redraws them without any new data. Beyond capacity stored curves the
+    oldest unpinned ones are dropped, so long runs (MPP tracking, device queues) keep bounded memory.
+    """
+
+    def __init__(self, plot_widgets, max_curves=DEFAULT_MAX_CURVES, capacity=DEFAULT_CAPACITY):
+        self.plot_widgets = plot_widgets
+        self.max_curves = max_curves
+        self.capacity = capacity
+        self.datasets = collections.OrderedDict()  # key -> [(x, y, pen)] with one entry per plot
+        self.items = {}  # key -> [PlotDataItem] of the drawn curves
+        self.pinned = []
+
+    def add(self, key, curves):
+        self.datasets[key] = curves
+        self.datasets.move_to_end(key)
+        if key in self.items:
+            self._remove(key)
+        unpinned = [old for old in self.datasets if old not in self.pinned]
+        for old in unpinned[:max(len(self.datasets) - self.capacity, 0)]:
+            del self.datasets[old]
+            if old in self.items:
+                self._remove(old)
+        self.refresh()
+
+    def overlay(self):
+        """Keys drawn: the pinned ones first, then the newest, up to max_curves."""
+        pinned = [key for key in self.pinned if key in self.datasets][:self.max_curves]
+        newest = [key for key in reversed(self.datasets) if key not in pinned]
+        return pinned + newest[:self.max_curves - len(pinned)]
+
+    def set_max_curves(self, max_curves):
+        self.max_curves = max(int(max_curves), 1)
+        self.refresh()
+
+    def pin(self, key):
+        if key not in self.pinned:
+            self.pinned.append(key)
+        self.refresh()
+
+    def unpin(self, key):
+        if key in self.pinned:
+            self.pinned.remove(key)
+        self.refresh()
+
+    def clear(self):
+        for key in list(self.items):
+            self._remove(key)
+        self.datasets.clear()
+        self.pinned.clear()
+
+    def _remove(self, key):
+        for plot_widget, item in zip(self.plot_widgets, self.items.pop(key)):
+            plot_widget.removeItem(item)
+
+    def refresh(self):
+        shown = self.overlay()
+        for key in [key for key in self.items if key not in shown]:
+            self._remove(key)
+        for key in shown:
+            if key not in self.items:
+                self.items[key] = [fast_item(plot_widget, pen, x, y)
+                                   for plot_widget, (x, y, pen) in zip(self.plot_widgets, self.datasets[key])]
+
+
+class StoredSeriesCurve:
+    """One column of a SweepStore time series drawn against its 'time' column, read lazily from disk.
+
+    The time column is loaded once to locate the view; the values are read only for the rows in view. When
+    more rows are in view than can be drawn, a min/max overview (built on first need, OVERVIEW_BIN rows per
+    bin) stands in for them, so no view ever reads more than a bounded number of rows.
+    """
+
+    def __init__(self, plot_widget, store, name, column='power', pen=None, max_points=MAX_DRAWN_POINTS):
+        self.plot_widget = plot_widget
+        self.store = store
+        self.name = name
+        self.column = column
+        self.max_points = max_points
+        self.times = store.read_series(name, ['time'])['time']
+        self._overview = None
+        self.item = pg.PlotDataItem(pen=pen if pen is not None else pg.mkPen('g', width=1))
+        plot_widget.addItem(self.item)
+        # Views change many times per second while panning; the data follow once it pauses
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(30)
+        self._timer.timeout.connect(self.update_view)
+        plot_widget.sigXRangeChanged.connect(self._timer.start)
+        self.update_view(full=True)
+
+    def overview(self):
+        """(times, minima, maxima) of every OVERVIEW_BIN rows, computed once by reading the series in chunks."""
+        if self._overview is None:
+            minima, maxima = [], []
+            for start in range(0, len(self.times), READ_CHUNK):
+                values = self.store.read_series(self.name, [self.column], start, start + READ_CHUNK)[self.column]
+                bins = -(-len(values) // OVERVIEW_BIN)
+                padded = np.full(bins * OVERVIEW_BIN, np.nan)
+                padded[:len(values)] = values
+                padded = padded.reshape(bins, OVERVIEW_BIN)
+                minima.append(np.nanmin(padded, axis=1))
+                maxima.append(np.nanmax(padded, axis=1))
+            self._overview = (self.times[::OVERVIEW_BIN], np.concatenate(minima), np.concatenate(maxima))
+        return self._overview
+
+    def visible_rows(self, full=False):
+        if full or len(self.times) == 0:
+            return 0, len(self.times)
+        x_min, x_max = self.plot_widget.getViewBox().viewRange()[0]
+        start = max(int(np.searchsorted(self.times, x_min)) - 1, 0)
+        stop = min(int(np.searchsorted(self.times, x_max, side='right')) + 1, len(self.times))
+        return start, stop
+
+    def update_view(self, full=False):
+        start, stop = self.visible_rows(full)
+        if stop - start <= RAW_READ_LIMIT:
+            # Few enough rows to read them and reduce them exactly
+            values = self.store.read_series(self.name, [self.column], start, stop)[self.column]
+            x, y = peak_decimate(self.times[start:stop], values, self.max_points // 2)
+        else:
+            times, minima, maxima = self.overview()
+            first, last = start // OVERVIEW_BIN, -(-stop // OVERVIEW_BIN)
+            x = np.repeat(times[first:last], 2)
+            y = np.stack([minima[first:last], maxima[first:last]], axis=1).ravel()
+            x, y = peak_decimate(x, y, self.max_points // 2)
+        self.item.setData(x, y)
+
+    def remove(self):
+        self.plot_widget.sigXRangeChanged.disconnect(self._timer.start)
+        self._timer.stop()
+        self.plot_widget.removeItem(self.item)
@@ -0,0 +1,185 @@
+# Run independent sweep queues on several SourceMeters (and their channels) at the same time
+import functools
+import queue
+import threading
+import traceback
+
+import iv_analysis
+import measurement_core
+import mpp_tracker
+
+
+class SweepJob:
+    """One device to measure: its sweep settings, how often, and how to analyse it.
+
+    With mpp (MppSettings) the device is held at its maximum power point instead, with the sweep settings
+    used for the periodic IV sweeps. illumination is 'light' or 'dark'.
+    """
+
+    def __init__(self, device_id, settings, repeats=1, delay=0.0, irradiance=1000.0, area=1.0, metadata=None,
+                 mpp=None, illumination='light'):
+        self.device_id = device_id
+        self.settings = settings
+        self.repeats = repeats
+        self.delay = delay
+        self.irradiance = irradiance
+        self.area = area
+        self.metadata = metadata or {}
+        self.mpp = mpp
+        self.illumination = illumination
+
+
+class SweepResult:
+    """A finished sweep as it comes out of the scheduler."""
+
+    def __init__(self, instrument, job, repeat, voltages, currents, extras, foms):
+        self.instrument = instrument
+        self.job = job
+        self.repeat = repeat
+        self.voltages = voltages
+        self.currents = currents
+        self.extras = extras
+        self.foms = foms
+
+
+class MppBlock:
+    """A block of averaged MPP tracking rows (dict of mpp_tracker.SERIES_COLUMNS arrays) from the scheduler."""
+
+    def __init__(self, instrument, job, repeat, rows):
+        self.instrument = instrument
+        self.job = job
+        self.repeat = repeat
+        self.rows = rows
+
+
+class InstrumentScheduler:
+    """Measure job queues in parallel, one worker thread per instrument channel.
+
+    Every instrument is one KeithleySession; the workers of its two channels share it, and the session lock
+    keeps their commands apart while both trigger models run at the same time. Finished sweeps (and MPP
+    tracking blocks) from all workers are collected into a single stream read with results().
+
+    The channels of an instrument share its light: all of its dark jobs run first, and its light jobs start
+    once every channel is done with them. The shutter on digital I/O line shutter_line is closed for the dark
+    jobs and opened for the light ones, so dark jobs need a shutter_line: without one nothing would change
+    the light between the two phases.
+    """
+
+    def __init__(self, sessions, current_limit=105e-3, shutter_line=None):
+        self.sessions = dict(sessions)  # instrument name -> KeithleySession
+        self.current_limit = current_limit
+        self.shutter_line = shutter_line
+        self.queues = {}  # (instrument, channel) -> list of SweepJob
+        self.cores = {}
+        self.trackers = {}
+        self.errors = []
+        self._results = queue.Queue()
+        self._threads = []
+        self._barriers = []
+        self._stopped = threading.Event()
+
+    def add_job(self, instrument, job):
+        if instrument not in self.sessions:
+            raise ValueError(f'Unknown instrument: {instrument}')
+        if job.illumination == 'dark' and self.shutter_line is None:
+            raise ValueError(f'Dark job of {job.device_id} needs a shutter_line to darken the device')
+        self.queues.setdefault((instrument, job.settings.channel), []).append(job)
+
+    def start(self):
+        # Each instrument is reset and configured once for all of its channels before any sweep starts
+        barriers = {}
+        for instrument, session in self.sessions.items():
+            channels = [channel for name, channel in self.queues if name == instrument]
+            if channels:
+                measurement_core.configure_instrument(session, channels, self.current_limit)
+                dark = any(job.illumination == 'dark' for (name, _), jobs in self.queues.items()
+                           if name == instrument for job in jobs)
+                if self.shutter_line is not None:
+                    measurement_core.set_shutter(session, self.shutter_line, not dark)
+                # The last channel to finish its dark jobs opens the shutter for the light ones
+                barriers[instrument] = threading.Barrier(len(channels),
+                                                         action=functools.partial(self._open_shutter, session))
+        self._barriers = list(barriers.values())
+        for (instrument, channel), jobs in self.queues.items():
+            core = measurement_core.MeasurementCore(self.sessions[instrument])
+            self.cores[(instrument, channel)] = core
+            thread = threading.Thread(target=self._work, args=(instrument, core, jobs, barriers[instrument]),
+                                      name=f'{instrument}-smu{channel}', daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _open_shutter(self, session):
+        if self.shutter_line is not None and not self._stopped.is_set():
+            measurement_core.set_shutter(session, self.shutter_line, True)
+
+    def _work(self, instrument, core, jobs, barrier):
+        try:
+            self._run_jobs(instrument, core, [job for job in jobs if job.illumination == 'dark'])
+            barrier.wait()
+            self._run_jobs(instrument, core, [job for job in jobs if job.illumination != 'dark'])
+        except threading.BrokenBarrierError:
+            pass  # Another channel of the instrument failed, or the scheduler was stopped
+        except Exception:
+            self.errors.append((instrument, traceback.format_exc()))
+            barrier.abort()
+        finally:
+            self._results.put(None)  # Tells results() that this worker is done
+
+    def _run_jobs(self, instrument, core, jobs):
+        for job in jobs:
+            for repeat in range(job.repeats):
+                if self._stopped.is_set():
+                    return
+
+                def finished(voltages, currents, extras, job=job, repeat=repeat):
+                    foms = iv_analysis.figures_of_merit(voltages, currents, job.irradiance, job.area)
+                    self._results.put(SweepResult(instrument, job, repeat, voltages, currents, extras, foms))
+
+                # Sweeps end with the output off; this turns the job's channel back on (and sends nothing else
+                # that is already in effect)
+                measurement_core.configure_instrument(core.keithley, [job.settings.channel], self.current_limit)
+                if job.mpp is not None:
+                    self._track(instrument, core, job, repeat, finished)
+                else:
+                    core.run(job.settings, on_sweep_finished=finished)
+                if repeat < job.repeats - 1 and self._stopped.wait(job.delay):
+                    return
+
+    def _track(self, instrument, core, job, repeat, on_sweep):
+        tracker = mpp_tracker.MppTracker(
+            core.keithley, job.mpp, job.settings, on_sweep=on_sweep,
+            on_block=lambda rows: self._results.put(MppBlock(instrument, job, repeat, rows)))
+        self.trackers[(instrument, job.settings.channel)] = tracker
+        if self._stopped.is_set():
+            return
+        tracker.run()  # Switches the output off however it ends
+
+    def results(self):
+        """Yield SweepResults and MppBlocks from all workers as they arrive, until every worker is done."""
+        remaining = len(self._threads)
+        while remaining:
+            result = self._results.get()
+            if result is None:
+                remaining -= 1
+            else:
+                yield result
+
+    def stop(self):
+        self._stopped.set()
+        for barrier in self._barriers:
+            barrier.abort()
+        for worker in [*self.cores.values(), *self.trackers.values()]:
+            worker.stop()
+
+    def run(self, on_result=None):
+        """Start all workers and pass every result to on_result. Returns the list of results."""
+        self.start()
+        collected = []
+        try:
+            for result in self.results():
+                collected.append(result)
+                if on_result is not None:
+                    on_result(result)
+        finally:
+            self.stop()
+        return collected
@@ -0,0 +1,36 @@
+# Adaptive settling for point-by-point sweeps
+import time
+import numpy as np
+
+import command_trace
+
+
+def is_settled(readings, rel_tol, abs_tol):
+    """Check whether a window of current readings agrees within the tolerance."""
+    readings = np.asarray(readings)
+    spread = readings.max() - readings.min()
+    return spread <= max(abs_tol, rel_tol * abs(readings.mean()))
+
+
+def measure_settled(keithley, smu, voltage, rel_tol=0.005, abs_tol=1e-9, max_wait=2.0, window=3, interval=0.0):
+    """Set the source voltage and keep reading the current until it is stable.
+
+    The level is set and the first reading is taken in the same command. Readings continue until the last
+    `window` values agree within max(abs_tol, rel_tol * |mean|) or max_wait seconds have passed.
+    Returns the mean current of the last window, the settle time in seconds and whether it settled.
+    """
+    start = time.monotonic()
+    with command_trace.phase(keithley, 'settle'):
+        readings = [float(keithley.query(f'{smu}.source.levelv = {voltage} print({smu}.measure.i())'))]
+        settled = False
+        while True:
+            if len(readings) >= window and is_settled(readings[-window:], rel_tol, abs_tol):
+                settled = True
+                break
+            if time.monotonic() - start >= max_wait:
+                break
+            if interval > 0:
+                command_trace.sleep(keithley, interval)
+            readings.append(float(keithley.query(f'print({smu}.measure.i())')))
+    settle_time = time.monotonic() - start
+    return float(np.mean(readings[-window:])), settle_time, settled
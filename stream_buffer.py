@@ -0,0 +1,55 @@
+# Qt-free parts of the current streaming: the trigger program that measures continuously into a reading
+# buffer, and a ring buffer for the samples. Shared by the QThread worker (current_stream) and the asyncio
+# driver, which must not need Qt.
+import numpy as np
+
+STREAM_BUFFER = 'nvbuffer2'
+
+
+class RingBuffer:
+    """Preallocated ring buffer for (time, value) samples."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.values = np.zeros(capacity)
+        self.size = 0
+        self.index = 0  # Position the next sample is written to
+
+    def extend(self, times, values):
+        times = np.asarray(times, dtype=float)[-self.capacity:]
+        values = np.asarray(values, dtype=float)[-self.capacity:]
+        count = len(values)
+        first = min(count, self.capacity - self.index)
+        self.times[self.index:self.index + first] = times[:first]
+        self.values[self.index:self.index + first] = values[:first]
+        self.times[:count - first] = times[first:]
+        self.values[:count - first] = values[first:]
+        self.index = (self.index + count) % self.capacity
+        self.size = min(self.size + count, self.capacity)
+
+    def get(self):
+        """Return the stored samples in chronological order."""
+        if self.size < self.capacity:
+            return self.times[:self.size].copy(), self.values[:self.size].copy()
+        return np.roll(self.times, -self.index), np.roll(self.values, -self.index)
+
+    def clear(self):
+        self.size = 0
+        self.index = 0
+
+
+def build_stream_commands(smu, rate):
+    """Build the TSP lines that make the trigger model measure current continuously at the given rate."""
+    return [
+        f'{smu}.abort() {smu}.{STREAM_BUFFER}.clear() {smu}.{STREAM_BUFFER}.appendmode = 1 '
+        f'{smu}.{STREAM_BUFFER}.collecttimestamps = 1 {smu}.{STREAM_BUFFER}.fillmode = {smu}.FILL_WINDOW',
+        # Keep the integration time inside one sample period
+        f'{smu}.measure.nplc = math.min(1, 0.5 * localnode.linefreq / {rate})',
+        f'trigger.timer[1].reset() trigger.timer[1].delay = {1 / rate:.9g} trigger.timer[1].count = 0 '
+        f'trigger.timer[1].passthrough = true trigger.timer[1].stimulus = {smu}.trigger.ARMED_EVENT_ID',
+        f'{smu}.trigger.source.action = {smu}.DISABLE {smu}.trigger.measure.action = {smu}.ENABLE '
+        f'{smu}.trigger.measure.i({smu}.{STREAM_BUFFER}) '
+        f'{smu}.trigger.measure.stimulus = trigger.timer[1].EVENT_ID '
+        f'{smu}.trigger.endpulse.action = {smu}.SOURCE_HOLD {smu}.trigger.count = 0 {smu}.trigger.arm.count = 1',
+    ]
@@ -0,0 +1,164 @@
+# Columnar HDF5 store for IV sweeps plus an append-only run log
+#
+# Layout of the HDF5 file:
+#   points/<column>   one resizable, compressed 1-D dataset per point column, all sweeps concatenated
+#   sweeps/offset     index of each sweep's first point in the point columns
+#   sweeps/length     number of points of each sweep
+#   sweeps/meta       JSON metadata of each sweep (direction, channel, irradiance, area, factors, FoMs, ...)
+#   series/<name>/<column>  resizable, compressed time series such as the rows of an MPP tracking run
+# Every appended sweep is also written as one line to a JSON-lines run log next to the HDF5 file; values that
+# are not finite (a figure of merit of a curve without a Voc crossing) are written as null, as JSON has no NaN.
+import json
+import os
+import time
+import h5py
+import numpy as np
+
+POINT_COLUMNS = ('voltage', 'current', 'timestamp', 'settle_time', 'reference_current')
+CHUNK_POINTS = 4096
+
+
+def finite_json(value):
+    """value with every NaN or infinite float in its dicts, lists and tuples replaced by None."""
+    if isinstance(value, float):
+        return value if np.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: finite_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [finite_json(item) for item in value]
+    return value
+
+
+class SweepStore:
+    """Append sweeps to an HDF5 file and read them back as NumPy arrays."""
+
+    def __init__(self, path, run_log=None):
+        self.path = path
+        self.run_log = run_log if run_log is not None else os.path.splitext(path)[0] + '_runlog.jsonl'
+
+    def _create(self, f):
+        for column in POINT_COLUMNS:
+            f.create_dataset(f'points/{column}', shape=(0,), maxshape=(None,), dtype='f8',
+                             chunks=(CHUNK_POINTS,), compression='gzip', compression_opts=4, shuffle=True)
+        f.create_dataset('sweeps/offset', shape=(0,), maxshape=(None,), dtype='i8', chunks=(1024,))
+        f.create_dataset('sweeps/length', shape=(0,), maxshape=(None,), dtype='i8', chunks=(1024,))
+        f.create_dataset('sweeps/meta', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(),
+                         chunks=(1024,), compression='gzip')
+
+    def append(self, voltages, currents, metadata=None, timestamps=None, settle_times=None,
+               reference_currents=None):
+        """Append one sweep and return its sweep id (its position in the store).
+
+        Point columns that were not measured are stored as NaN.
+        """
+        voltages = np.asarray(voltages, dtype=float)
+        count = len(voltages)
+        columns = {'voltage': voltages, 'current': currents, 'timestamp': timestamps,
+                   'settle_time': settle_times, 'reference_current': reference_currents}
+        metadata = dict(metadata or {})
+        metadata.setdefault('time', time.time())
+
+        with h5py.File(self.path, 'a') as f:
+            if 'points' not in f:
+                self._create(f)
+            offset = f['points/voltage'].shape[0]
+            for column in POINT_COLUMNS:
+                values = columns[column]
+                values = np.full(count, np.nan) if values is None or len(values) != count else values
+                dataset = f[f'points/{column}']
+                dataset.resize((offset + count,))
+                dataset[offset:] = np.asarray(values, dtype=float)
+            sweep_id = f['sweeps/offset'].shape[0]
+            for name, value in (('offset', offset), ('length', count), ('meta', json.dumps(metadata))):
+                dataset = f[f'sweeps/{name}']
+                dataset.resize((sweep_id + 1,))
+                dataset[sweep_id] = value
+
+        with open(self.run_log, 'a') as log:
+            log.write(json.dumps(finite_json({'sweep_id': sweep_id, 'file': os.path.basename(self.path),
+                                              'points': count, **metadata}), allow_nan=False) + '\n')
+        return sweep_id
+
+    def append_series(self, name, columns):
+        """Append rows to the time series `name`; columns maps column names to equal-length 1-D arrays."""
+        with h5py.File(self.path, 'a') as f:
+            group = f.require_group(f'series/{name}')
+            for column, values in columns.items():
+                values = np.asarray(values, dtype=float)
+                if column not in group:
+                    group.create_dataset(column, shape=(0,), maxshape=(None,), dtype='f8', chunks=(CHUNK_POINTS,),
+                                         compression='gzip', compression_opts=4, shuffle=True)
+                dataset = group[column]
+                offset = dataset.shape[0]
+                dataset.resize((offset + len(values),))
+                dataset[offset:] = values
+
+    def series_names(self):
+        if not os.path.exists(self.path):
+            return []
+        with h5py.File(self.path, 'r') as f:
+            return list(f['series']) if 'series' in f else []
+
+    def read_series(self, name, columns=None, start=None, stop=None):
+        """Return columns (all by default) of the time series `name` as a dict of arrays, optionally only
+        rows start to stop, which are the only ones read from disk."""
+        with h5py.File(self.path, 'r') as f:
+            group = f[f'series/{name}']
+            return {column: group[column][start:stop] for column in (columns or list(group))}
+
+    def series_length(self, name):
+        with h5py.File(self.path, 'r') as f:
+            group = f[f'series/{name}']
+            return group[next(iter(group))].shape[0] if len(group) else 0
+
+    def __len__(self):
+        if not os.path.exists(self.path):
+            return 0
+        with h5py.File(self.path, 'r') as f:
+            return f['sweeps/offset'].shape[0] if 'sweeps' in f else 0
+
+    def metadata(self, sweep_ids=None):
+        """Return the metadata dicts of the given sweeps (all sweeps by default)."""
+        with h5py.File(self.path, 'r') as f:
+            meta = f['sweeps/meta'].asstr()[()]
+        if sweep_ids is not None:
+            meta = meta[np.atleast_1d(sweep_ids)]
+        return [json.loads(entry) for entry in meta]
+
+    def read(self, sweep_id, columns=POINT_COLUMNS):
+        """Return the point columns of one sweep as a dict of arrays."""
+        with h5py.File(self.path, 'r') as f:
+            offset = int(f['sweeps/offset'][sweep_id])
+            length = int(f['sweeps/length'][sweep_id])
+            return {column: f[f'points/{column}'][offset:offset + length] for column in columns}
+
+    def read_all(self, columns=POINT_COLUMNS):
+        """Load every sweep at once.
+
+        Returns (points, offsets, lengths): a dict of concatenated point columns and the start and length of
+        each sweep in them, so sweep k is points[column][offsets[k]:offsets[k] + lengths[k]].
+        """
+        with h5py.File(self.path, 'r') as f:
+            points = {column: f[f'points/{column}'][()] for column in columns}
+            return points, f['sweeps/offset'][()], f['sweeps/length'][()]
+
+    def read_padded(self, column='current'):
+        """Return one column of every sweep as rows of a NaN-padded 2-D array (for batch analysis)."""
+        points, offsets, lengths = self.read_all((column,))
+        rows = np.full((len(offsets), lengths.max() if len(lengths) else 0), np.nan)
+        # Sweeps are stored back to back, so filling the mask row by row puts every point in place
+        rows[np.arange(rows.shape[1])[None, :] < lengths[:, None]] = points[column][:lengths.sum()]
+        return rows
+
+
+def export_txt(path, voltages, currents, foms=None):
+    """Write a sweep as the tab-separated text file used by the Save Data button."""
+    with open(path, 'w') as f:
+        f.write('Voltage\tCurrent\n')
+        np.savetxt(f, np.column_stack([voltages, currents]), fmt='%.10g', delimiter='\t')
+        if foms is not None:
+            parameters = [('Voc', 'voc'), ('Isc', 'isc'), ('FF', 'ff'), ('Max_Power', 'max_power'),
+                          ('MPP_Voltage', 'mpp_voltage'), ('MPP_Current', 'mpp_current'), ('PCE', 'pce')]
+            for param, key in parameters:
+                value = foms[key]
+                f.write(f'{param}: {value:.3f}\n' if key == 'pce' else f'{param}: {value}\n')
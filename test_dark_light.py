@@ -0,0 +1,16 @@
+import numpy as np
+
+import dark_light
+import simulated_keithley
+
+
+def test_is_dark_rejects_a_curve_with_photocurrent():
+    voltages = np.arange(-0.2, 0.8, 0.02)
+    device = simulated_keithley.SimulatedDevice()
+    rng = np.random.default_rng(0)
+    dark = device.steady_current(voltages, irradiance=0.0) + rng.normal(0, device.noise, len(voltages))
+    # A dimly lit bench still drives a photocurrent of a thousandth of full sun
+    dim = device.steady_current(voltages, irradiance=1e-3)
+    assert dark_light.is_dark(voltages, dark)
+    assert not dark_light.is_dark(voltages, dim)
+    assert not dark_light.is_dark(voltages[voltages > 0.1], dark[voltages > 0.1])
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+import iv_analysis
+import simulated_keithley
+
+
+def dense_max_power(device):
+    voltages = np.linspace(0, 0.8, 80001)
+    return np.max(-voltages * device.steady_current(voltages))
+
+
+@pytest.mark.parametrize('rs', [5.0, 30.0, 100.0])
+@pytest.mark.parametrize('step, tolerance', [(0.1, 0.02), (0.05, 0.005)])
+def test_coarse_sweeps_give_the_dense_maximum_power(rs, step, tolerance):
+    device = simulated_keithley.SimulatedDevice(rs=rs)
+    true_power = dense_max_power(device)
+    for offset in np.linspace(0, step, 5)[:-1]:
+        voltages = np.arange(-0.2 + offset, 0.9, step)
+        foms = iv_analysis.figures_of_merit(voltages, device.steady_current(voltages))
+        assert foms['max_power'] == pytest.approx(true_power, rel=tolerance)
+        # Never below the best measured point, and consistent with the reported operating point
+        assert foms['max_power'] >= np.max(-voltages * device.steady_current(voltages))
+        assert foms['max_power'] == pytest.approx(-foms['mpp_voltage'] * foms['mpp_current'])
+
+
+def test_coarse_fill_factor_does_not_overshoot():
+    device = simulated_keithley.SimulatedDevice()
+    dense = np.linspace(-0.2, 0.9, 1101)
+    coarse = np.arange(-0.2, 0.9, 0.1)
+    ff_dense = iv_analysis.figures_of_merit(dense, device.steady_current(dense))['ff']
+    ff_coarse = iv_analysis.figures_of_merit(coarse, device.steady_current(coarse))['ff']
+    assert ff_coarse <= ff_dense + 1e-3
+    assert ff_coarse == pytest.approx(ff_dense, rel=0.03)
+
+
+def test_batches_match_single_curves():
+    device = simulated_keithley.SimulatedDevice()
+    voltages = np.arange(0, 0.8, 0.05)
+    currents = np.array([device.steady_current(voltages) * scale for scale in (0.9, 1.0, 1.1)])
+    batch = iv_analysis.figures_of_merit(voltages, currents)
+    for row, current in enumerate(currents):
+        single = iv_analysis.figures_of_merit(voltages, current)
+        for name in iv_analysis.FOM_NAMES:
+            assert batch[name][row] == pytest.approx(single[name])
@@ -0,0 +1,30 @@
+import numpy as np
+
+import keithley_session
+import measurement_core
+import simulated_keithley
+
+
+def test_stepped_sweeps_in_a_row_measure_with_the_output_on():
+    session = keithley_session.KeithleySession(simulated_keithley.SimulatedKeithley(seed=0), 'Simulated 2614B')
+    measurement_core.configure_instrument(session, ['a'])
+    core = measurement_core.MeasurementCore(session)
+    settings = measurement_core.SweepSettings(start_voltage=0.0, stop_voltage=0.6, step_voltage=0.3,
+                                              sweep_mode='Stepped', nplc=0.01)
+    first = core.run(settings)
+    second = core.run(settings)
+    # The cell delivers about 1.3 mA at 0 V; with the output off only noise would be read
+    for (voltages, currents, extras) in first + second:
+        assert currents[0] < -1e-3
+    np.testing.assert_allclose(second[0][1], first[0][1], rtol=0.05)
+
+
+def test_adaptive_sweeps_integrate_with_their_own_nplc():
+    instrument = simulated_keithley.SimulatedKeithley(realtime=False, seed=0)
+    session = keithley_session.KeithleySession(instrument, 'Simulated 2614B')
+    measurement_core.configure_instrument(session, ['a'])
+    core = measurement_core.MeasurementCore(session)
+    for sweep_mode, nplc in (('Adaptive', 5.0), ('Instrument', 0.01), ('Adaptive', 5.0)):
+        core.run(measurement_core.SweepSettings(start_voltage=0.0, stop_voltage=0.2, step_voltage=0.1,
+                                                sweep_mode=sweep_mode, nplc=nplc, source_delay=0.0))
+        assert instrument.smus['smua'].nplc == nplc
@@ -0,0 +1,22 @@
+import threading
+
+import keithley_session
+import measurement_core
+import mpp_tracker
+import simulated_keithley
+
+
+def test_stopping_the_tracker_turns_the_output_off():
+    instrument = simulated_keithley.SimulatedKeithley(seed=0)
+    session = keithley_session.KeithleySession(instrument, 'Simulated 2614B')
+    measurement_core.configure_instrument(session, ['a'])
+    settings = mpp_tracker.MppSettings(nplc=0.01, average_window=0.05, sweep_interval=0)
+    sweep_settings = measurement_core.SweepSettings(start_voltage=0.0, stop_voltage=0.7, step_voltage=0.05,
+                                                    nplc=0.01, source_delay=0.0)
+    tracker = mpp_tracker.MppTracker(session, settings, sweep_settings)
+    timer = threading.Timer(0.5, tracker.stop)
+    timer.start()
+    tracker.run()
+    timer.join()
+    assert tracker.updates > 0
+    assert not instrument.smus['smua'].output
@@ -0,0 +1,26 @@
+import os
+
+import numpy as np
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+import pyqtgraph as pg  # noqa: E402
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+
+import plot_manager  # noqa: E402
+
+app = QApplication.instance() or QApplication([])
+
+
+def test_overlay_keeps_at_most_capacity_curves_but_every_pinned_one():
+    plot_widget = pg.PlotWidget()
+    overlay = plot_manager.CurveOverlay([plot_widget], max_curves=3, capacity=10)
+    x = np.linspace(0, 1, 5)
+    overlay.add('sweep 0', [(x, x, None)])
+    overlay.pin('sweep 0')
+    for number in range(1, 50):
+        overlay.add(f'sweep {number}', [(x, x * number, None)])
+    assert len(overlay.datasets) == 10
+    assert list(overlay.datasets) == ['sweep 0'] + [f'sweep {number}' for number in range(41, 50)]
+    assert overlay.overlay() == ['sweep 0', 'sweep 49', 'sweep 48']
+    assert sorted(overlay.items) == sorted(overlay.overlay())
+    assert len(plot_widget.listDataItems()) == 3
@@ -0,0 +1,28 @@
+import json
+
+import numpy as np
+
+import iv_analysis
+import sweep_store
+
+
+def strict_json(token):
+    raise ValueError(f'{token} is not valid JSON')
+
+
+def test_run_log_lines_are_valid_json_when_figures_of_merit_are_nan(tmp_path):
+    store = sweep_store.SweepStore(str(tmp_path / 'sweeps.h5'))
+    voltages = np.linspace(0, 0.3, 4)
+    currents = -1e-3 + 1e-3 * voltages  # No Voc crossing, so Voc, FF and PCE are NaN
+    foms = iv_analysis.figures_of_merit(voltages, currents)
+    assert np.isnan(foms['voc'])
+    store.append(voltages, currents, {'foms': foms, 'setup': ('a', 0.0, float('inf'))})
+
+    with open(store.run_log) as log:
+        lines = log.read().splitlines()
+    entry = json.loads(lines[0], parse_constant=strict_json)
+    assert entry['foms']['voc'] is None
+    assert entry['foms']['isc'] == foms['isc']
+    assert entry['setup'] == ['a', 0.0, None]
+    # The HDF5 metadata keeps the NaN values
+    assert np.isnan(store.metadata()[0]['foms']['voc'])
@@ -0,0 +1,33 @@
+import numpy as np
+
+import keithley_session
+import measurement_core
+import simulated_keithley
+import tsp_sweep
+
+
+def simulated_session():
+    session = keithley_session.KeithleySession(simulated_keithley.SimulatedKeithley(seed=0), 'Simulated 2614B')
+    measurement_core.configure_instrument(session, ['a'])
+    return session
+
+
+def test_a_timed_out_sweep_is_flagged_with_its_partial_data(capsys):
+    voltages = np.linspace(0, 0.6, 50)
+    # 50 points of at least 70 ms each cannot finish within 0.5 s
+    measured, currents, extras = tsp_sweep.run_sweep(simulated_session(), 'smua', voltages, nplc=1,
+                                                     source_delay=0.05, timeout=0.5)
+    assert extras['timed_out']
+    assert extras['requested_points'] == 50
+    assert 0 < len(measured) < 50
+    assert len(currents) == len(measured) == len(extras['timestamps'])
+    np.testing.assert_array_equal(measured, voltages[:len(measured)])
+    assert capsys.readouterr().out == ''
+
+
+def test_a_finished_sweep_is_not_flagged():
+    voltages = np.linspace(0, 0.6, 5)
+    measured, currents, extras = tsp_sweep.run_sweep(simulated_session(), 'smua', voltages, nplc=0.01,
+                                                     source_delay=0.0)
+    assert 'timed_out' not in extras
+    assert len(measured) == 5
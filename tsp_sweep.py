@@ -0,0 +1,169 @@
+# Helpers for running a whole IV sweep on the SourceMeter with the TSP trigger model
+import time
+import numpy as np
+import buffer_readback
+import command_trace
+
+# Number of voltage values sent per line when the sweep list is uploaded
+LIST_CHUNK_SIZE = 100
+
+
+def format_value(value):
+    """Format a number the way it is sent to the instrument."""
+    return f'{float(value):.9g}'
+
+
+def build_sweep_commands(smu, voltages, nplc=1, source_delay=0.05):
+    """Build the TSP lines that load a voltage list sweep into the trigger model of the given smu."""
+    # One list per channel, so sweeps on smua and smub can be loaded independently
+    name = f'_ivsweep_{smu}'
+    commands = [f'{name} = {{}}']
+    for i in range(0, len(voltages), LIST_CHUNK_SIZE):
+        chunk = ','.join(format_value(v) for v in voltages[i:i + LIST_CHUNK_SIZE])
+        commands.append(f'for _, v in ipairs({{{chunk}}}) do table.insert({name}, v) end')
+
+    # Everything else fits on a single line, so it is sent as one chunk
+    setup = [
+        f'{smu}.nvbuffer1.clear()',
+        f'{smu}.nvbuffer1.collectsourcevalues = 1',
+        f'{smu}.nvbuffer1.collecttimestamps = 1',
+        f'{smu}.measure.nplc = {format_value(nplc)}',
+        f'{smu}.source.delay = {format_value(source_delay)}',
+        f'{smu}.trigger.source.listv({name})',
+        f'{smu}.trigger.source.action = {smu}.ENABLE',
+        f'{smu}.trigger.measure.i({smu}.nvbuffer1)',
+        f'{smu}.trigger.measure.action = {smu}.ENABLE',
+        f'{smu}.trigger.endpulse.action = {smu}.SOURCE_HOLD',
+        f'{smu}.trigger.endsweep.action = {smu}.SOURCE_IDLE',
+        f'{smu}.trigger.count = {len(voltages)}',
+        f'{smu}.trigger.arm.count = 1',
+        f'{smu}.source.output = {smu}.OUTPUT_ON',
+    ]
+    commands.append(' '.join(setup))
+    return commands
+
+
+def build_reference_commands(reference_smu, smu, points, nplc=1, source_delay=0.05):
+    """Build the TSP line that makes reference_smu measure current once for every source step of smu.
+
+    The reference measurement is triggered by the source step of the swept channel and waits the same
+    source delay, so both readings of a point are taken at the same moment.
+    """
+    ref = reference_smu
+    setup = [
+        f'{ref}.abort()',
+        f'{ref}.nvbuffer1.clear()',
+        f'{ref}.nvbuffer1.collecttimestamps = 1',
+        f'{ref}.measure.nplc = {format_value(nplc)}',
+        f'{ref}.measure.delay = {format_value(source_delay)}',
+        f'{ref}.trigger.source.action = {ref}.DISABLE',
+        f'{ref}.trigger.measure.i({ref}.nvbuffer1)',
+        f'{ref}.trigger.measure.action = {ref}.ENABLE',
+        f'{ref}.trigger.measure.stimulus = {smu}.trigger.SOURCE_COMPLETE_EVENT_ID',
+        f'{ref}.trigger.endpulse.action = {ref}.SOURCE_HOLD',
+        f'{ref}.trigger.count = {points}',
+        f'{ref}.trigger.arm.count = 1',
+    ]
+    return [' '.join(setup)]
+
+
+def send_program(keithley, commands):
+    """Send TSP lines as one block when the handle is a shared session."""
+    if hasattr(keithley, 'run_program'):
+        keithley.run_program(commands)
+    else:
+        for command in commands:
+            keithley.write(command)
+
+
+def estimate_sweep_time(points, nplc=1, source_delay=0.05, line_frequency=50):
+    """Rough upper bound for how long the instrument needs for a sweep, in seconds."""
+    return points * (max(source_delay, 0) + nplc / line_frequency + 0.01)
+
+
+def run_sweep(keithley, smu, voltages, nplc=1, source_delay=0.05, is_running=None, poll_interval=0.05,
+              timeout=None, binary=None, reference_smu=None, on_points=None):
+    """Run a voltage list sweep on the instrument and return the voltages, currents and buffer extras.
+
+    The trigger model runs in the background on the SourceMeter, so the host only polls the reading
+    count. If is_running returns False the sweep is aborted and the points measured so far are returned.
+    The same happens when the sweep takes longer than timeout; extras['timed_out'] is then True and
+    extras['requested_points'] the length of the voltage list, so callers can tell the curve is incomplete.
+    The extras dict holds the source values and timestamps recorded in the buffer. If reference_smu is
+    given, that channel measures the reference cell at every point and its currents are returned in
+    extras['reference_currents']. If on_points is given, new readings are fetched while the sweep runs
+    and passed to it as (voltages, currents) chunks.
+    """
+    voltages = np.asarray(voltages, dtype=float)
+    extras = {'source_values': np.array([]), 'timestamps': np.array([])}
+    if reference_smu is not None:
+        extras['reference_currents'] = np.array([])
+    if len(voltages) == 0:
+        return voltages, np.array([]), extras
+
+    commands = build_sweep_commands(smu, voltages, nplc, source_delay)
+    if reference_smu is not None:
+        # The reference channel has to be armed before the swept channel starts
+        commands += build_reference_commands(reference_smu, smu, len(voltages), nplc, source_delay)
+        commands.append(f'{reference_smu}.trigger.initiate()')
+    commands.append(f'{smu}.trigger.initiate()')
+    with command_trace.phase(keithley, 'program'):
+        send_program(keithley, commands)
+
+    if timeout is None:
+        timeout = 2 * estimate_sweep_time(len(voltages), nplc, source_delay) + 5
+    abort = f'{smu}.abort()' if reference_smu is None else f'{smu}.abort() {reference_smu}.abort()'
+    names = [f'{smu}.nvbuffer1.{field}' for field in buffer_readback.BUFFER_FIELDS]
+    chunks = []
+    read = 0  # Number of readings already fetched
+
+    def fetch(count):
+        nonlocal read
+        if count > read:
+            with command_trace.phase(keithley, 'readback'):
+                chunk = buffer_readback.read_buffer_attributes(keithley, read + 1, count, names, binary)
+            chunks.append(chunk)
+            if on_points is not None:
+                on_points(voltages[read:read + len(chunk)], chunk[:, 0])
+            read += len(chunk)
+
+    deadline = time.monotonic() + timeout
+    count = 0
+    timed_out = False
+    with command_trace.phase(keithley, 'acquire'):
+        while True:
+            count = min(buffer_readback.buffer_count(keithley, smu), len(voltages))
+            if count >= len(voltages):
+                break
+            if is_running is not None and not is_running():
+                keithley.write(abort)
+                count = min(buffer_readback.buffer_count(keithley, smu), len(voltages))
+                break
+            if time.monotonic() > deadline:
+                keithley.write(abort)
+                timed_out = True
+                break
+            if on_points is not None:
+                fetch(count)
+            command_trace.sleep(keithley, poll_interval)
+        fetch(count)
+    values = np.vstack(chunks) if chunks else np.zeros((0, len(names)))
+
+    if reference_smu is not None:
+        with command_trace.phase(keithley, 'readback'):
+            # The reference reading of the last point may still be in progress
+            while buffer_readback.buffer_count(keithley, reference_smu) < count and time.monotonic() < deadline:
+                command_trace.sleep(keithley, poll_interval)
+            reference_count = min(count, buffer_readback.buffer_count(keithley, reference_smu))
+            keithley.write(f'{reference_smu}.trigger.measure.stimulus = 0')
+            reference = buffer_readback.read_buffer(keithley, reference_smu, 1, reference_count, ('readings',),
+                                                    binary=binary)
+        values = values[:reference_count]
+        extras['reference_currents'] = reference['readings']
+
+    currents = values[:, 0]
+    extras['source_values'] = values[:, 1]
+    extras['timestamps'] = values[:, 2]
+    if timed_out:
+        extras.update(timed_out=True, requested_points=len(voltages))
+    return voltages[:len(currents)], currents, extras